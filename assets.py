@@ -0,0 +1,219 @@
+import hashlib
+import os
+import re
+import shutil
+from html.parser import HTMLParser
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+
+
+# stylesheets are concatenated in this order, which is the order base.html used to link them
+STYLESHEETS = ('materialize.min.css', 'public.css')
+# rules for these selectors are inlined into the page so the status is styled even if the stylesheet never arrives
+CRITICAL_SELECTORS = ('.sd-status', '.sd-maintenance')
+STYLESHEET_NAME = 'site'
+
+STRING_OR_SPACE = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|\s+')
+PSEUDO = re.compile(r'::?[a-zA-Z-]+(\((?:[^()]|\([^()]*\))*\))?')
+ATTRIBUTE = re.compile(r'\[[^\]]*\]')
+CLASS = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+ID = re.compile(r'#(-?[_a-zA-Z][\w-]*)')
+TAG = re.compile(r'[a-zA-Z][\w-]*')
+COMBINATOR = re.compile(r'[\s>+~]+')
+
+
+class Used(NamedTuple):
+    tags: Set[str]
+    classes: Set[str]
+    ids: Set[str]
+
+
+class Block(NamedTuple):
+    prelude: str
+    # None for statements such as @charset
+    body: Optional[str]
+
+
+class Stylesheet(NamedTuple):
+    css: str
+    critical: str
+
+
+class Assets(NamedTuple):
+    # the hashed stylesheet file name and the css to inline in the page
+    stylesheet: str
+    critical_css: str
+
+
+class UsedCollector(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.used = Used(set(), set(), set())
+
+    def handle_starttag(self, tag, attrs):
+        self.used.tags.add(tag.lower())
+        for name, value in attrs:
+            if name == 'class' and value:
+                self.used.classes.update(value.split())
+            elif name == 'id' and value:
+                self.used.ids.add(value)
+
+
+def collect_used(pages: Iterable[str]) -> Used:
+    collector = UsedCollector()
+    for page in pages:
+        collector.feed(page)
+    # the document root always exists even when a template leaves it implicit
+    collector.used.tags.update(('html', 'head', 'body'))
+    return collector.used
+
+
+def split_blocks(css: str) -> List[Block]:
+    blocks, depth, start, body_start, quote = [], 0, 0, 0, None
+    index = 0
+    while index < len(css):
+        char = css[index]
+        if quote:
+            if char == '\\':
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif css.startswith('/*', index):
+            index = css.find('*/', index + 2) + 1 or len(css)
+        elif char == '{':
+            if depth == 0:
+                body_start = index
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                blocks.append(Block(css[start:body_start].strip(), css[body_start + 1:index]))
+                start = index + 1
+        elif char == ';' and depth == 0:
+            blocks.append(Block(css[start:index].strip(), None))
+            start = index + 1
+        index += 1
+    return blocks
+
+
+def strip_comments(css: str) -> str:
+    return re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+
+
+def minify(text: str, declarations: bool = False) -> str:
+    # a colon can be a descendant pseudo-class in a selector, so only declarations lose the space before one
+    punctuation = r'[;:,{}]' if declarations else r'[,>+~{}]'
+    text = STRING_OR_SPACE.sub(lambda match: match.group(1) or ' ', text).strip()
+    return re.sub(rf'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|\s*({punctuation})\s*',
+                  lambda match: match.group(1) or match.group(2), text)
+
+
+def selector_is_used(selector: str, used: Used) -> bool:
+    # pseudo-classes and attribute selectors only narrow a match, so they are ignored
+    simple = ATTRIBUTE.sub('', PSEUDO.sub('', selector))
+    if not all(name in used.classes for name in CLASS.findall(simple)):
+        return False
+    if not all(name in used.ids for name in ID.findall(simple)):
+        return False
+    for compound in COMBINATOR.split(simple.strip()):
+        tag = TAG.match(compound)
+        if tag and tag.group().lower() not in used.tags:
+            return False
+    return True
+
+
+def is_critical(selector: str) -> bool:
+    # also matches the BEM elements, e.g. .sd-status__message
+    return any(name in selector for name in CRITICAL_SELECTORS)
+
+
+def purge(blocks: List[Block], used: Used) -> Tuple[List[str], List[str], List[Tuple[str, str]]]:
+    # returns the minified rules to keep, those to inline and any keyframes to decide on later
+    rules, critical, keyframes = [], [], []
+    for block in blocks:
+        if block.body is None:
+            rules.append(minify(block.prelude) + ';')
+        elif block.prelude.startswith(('@media', '@supports')):
+            inner, inner_critical, inner_keyframes = purge(split_blocks(block.body), used)
+            prelude = STRING_OR_SPACE.sub(lambda match: match.group(1) or ' ', block.prelude)
+            if inner:
+                rules.append(f'{prelude}{{{"".join(inner)}}}')
+            if inner_critical:
+                critical.append(f'{prelude}{{{"".join(inner_critical)}}}')
+            keyframes.extend(inner_keyframes)
+        elif re.match(r'@(-\w+-)?keyframes', block.prelude):
+            keyframes.append((block.prelude, minify(block.body, declarations=True)))
+        elif block.prelude.startswith('@'):
+            rules.append(f'{minify(block.prelude)}{{{minify(block.body, declarations=True)}}}')
+        else:
+            selectors = [minify(selector) for selector in block.prelude.split(',')]
+            selectors = [selector for selector in selectors if selector_is_used(selector, used)]
+            if not selectors:
+                continue
+            declarations = minify(block.body, declarations=True).rstrip(';')
+            rule = f'{",".join(selectors)}{{{declarations}}}'
+            if all(is_critical(selector) for selector in selectors):
+                critical.append(rule)
+            else:
+                rules.append(rule)
+    return rules, critical, keyframes
+
+
+def build_stylesheet(sources: Iterable[str], pages: Iterable[str]) -> Stylesheet:
+    used = collect_used(pages)
+    css = ''.join(sources)
+    # licence comments (/*! ... */) are kept at the top
+    licences = re.findall(r'/\*!.*?\*/', css, flags=re.DOTALL)
+    rules, critical, keyframes = purge(split_blocks(strip_comments(css)), used)
+
+    # keyframes are only kept when a surviving rule animates with them
+    kept = ''.join(rules + critical)
+    for prelude, body in keyframes:
+        name = prelude.split()[-1]
+        if re.search(rf'animation[^;}}]*[:\s,]{re.escape(name)}(?![\w-])', kept):
+            rules.append(f'{minify(prelude)}{{{body}}}')
+
+    return Stylesheet('\n'.join(licences + ['']) + ''.join(rules), ''.join(critical))
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def is_hashed(file_name: str) -> bool:
+    return re.fullmatch(r'[\w-]+\.[0-9a-f]{12}\.\w+', file_name) is not None
+
+
+def write_hashed(directory: str, name: str, extension: str, content: str) -> str:
+    # a file name that changes with its content can be cached forever
+    data = content.encode()
+    file_name = f'{name}.{content_hash(data)}.{extension}'
+    target = os.path.join(directory, file_name)
+    if not os.path.exists(target):
+        temporary = target + '.tmp'
+        with open(temporary, 'wb') as fobj:
+            fobj.write(data)
+        os.replace(temporary, target)
+    return file_name
+
+
+def build_assets(static_dir: str, output_dir: str, pages: Iterable[str]) -> Assets:
+    # stylesheets are purged against the pages and merged, other assets are copied as they are
+    os.makedirs(output_dir, exist_ok=True)
+    for name in sorted(os.listdir(static_dir)):
+        source = os.path.join(static_dir, name)
+        if name.endswith('.css') or not os.path.isfile(source):
+            continue
+        shutil.copyfile(source, os.path.join(output_dir, name))
+
+    sources = []
+    for name in STYLESHEETS:
+        with open(os.path.join(static_dir, name)) as fobj:
+            sources.append(fobj.read())
+    stylesheet = build_stylesheet(sources, pages)
+    file_name = write_hashed(output_dir, STYLESHEET_NAME, 'css', stylesheet.css)
+    for name in os.listdir(output_dir):
+        if is_hashed(name) and name != file_name:
+            os.remove(os.path.join(output_dir, name))
+    return Assets(file_name, stylesheet.critical)
@@ -0,0 +1,307 @@
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from benchmarks.fakes import (FakeDynamoDB, FakeS3, FakeSES, FakeSession, FakeSite, FakeSSM, FakeTorProxy,
+                              FakeWebhook, FaultInjector, Faults)
+from securedrop import build_pages
+from src.config import OPTIONAL_PARAMETERS, PARAMETER_PATH, SHARED_PARAMETERS, STAGE_PARAMETERS
+from src.history import ResultSink
+from src.monitor import (check_once, create_config, create_dispatcher, create_history, create_history_store,
+                         create_scheduler, publish_pages)
+from src.probe import QuorumClient, TorClient, parse_quorum
+from src.publish import variant_key
+from src.scheduler import Clock, Outcome
+
+# Runs the whole monitor cycle (configuration, probe, history, status page and notifications)
+# against in-process stand-ins for Tor, the onion, DynamoDB (or the SQLite history store), S3,
+# SES, SSM and the chat webhook, with latency, errors and timeouts injected into them, and
+# compares the results with benchmarks/baseline.json.
+#
+#   python -m benchmarks.bench_cycle
+#   python -m benchmarks.bench_cycle --update-baseline
+#
+# cycle is the wall time of a healthy run. detect is how long the check that starts as the
+# onion goes down takes to confirm it, and publish how long from the start of that run until
+# the maintenance page is uploaded. Waits between attempts are skipped but counted, so those two are the times the
+# monitor would take for real; a cron or daemon interval comes on top.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+ONION = 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion'
+STAGE = 'CODE'
+BUCKET = 'securedrop-public-CODE'
+PAGE = '<html><head><title>The Guardian | SecureDrop</title></head><body></body></html>'
+METADATA = json.dumps({'sd_version': '2.6.0', 'v3_source_url': f'http://{ONION}'})
+
+
+class Scenario(NamedTuple):
+    name: str
+    tor: Faults = Faults()
+    aws: Faults = Faults()
+    webhook: Faults = Faults()
+    # seconds the onion takes to answer
+    delay: float = 0.05
+    # dynamodb or sqlite
+    history: str = 'dynamodb'
+    # upload, copy or redirect
+    publish: str = 'upload'
+    # probe from several vantage points, e.g. 2/3
+    quorum: str = ''
+    # further Tor instances for the vantage points, after the one with the tor faults
+    extra_tor: Tuple[Faults, ...] = ()
+
+
+FLAKY_TOR = Faults(error_rate=0.3, timeout_rate=0.1, timeout=2.5)
+SCENARIOS = (
+    Scenario('baseline'),
+    Scenario('sqlite', history='sqlite'),
+    Scenario('pointer', publish='copy'),
+    Scenario('slow', tor=Faults(latency=0.2), aws=Faults(latency=0.05), webhook=Faults(latency=0.2), delay=0.5),
+    Scenario('flaky', tor=FLAKY_TOR, aws=Faults(error_rate=0.1, timeout_rate=0.02), webhook=Faults(error_rate=0.3)),
+    # the flaky Tor of the flaky scenario outvoted by two healthy ones
+    Scenario('quorum', tor=FLAKY_TOR, quorum='2/3', extra_tor=(Faults(), Faults())),
+)
+
+
+class VirtualClock(Clock):
+    # real time plus every wait that was skipped
+    def __init__(self):
+        self.skipped = 0.0
+
+    def now(self) -> float:
+        return time.monotonic() + self.skipped
+
+    def sleep(self, seconds: float) -> None:
+        self.skipped += seconds
+
+
+def parameters(webhook: str) -> Dict[str, str]:
+    path = PARAMETER_PATH.format(stage=STAGE)
+    # the optional parameters are left unset, apart from those below
+    values = {path + name: 'x' for key, name in STAGE_PARAMETERS.items() if key not in OPTIONAL_PARAMETERS}
+    values.update({
+        path + STAGE_PARAMETERS['BUCKET_NAME']: BUCKET,
+        path + STAGE_PARAMETERS['PRODMON_WEBHOOK']: webhook,
+        path + STAGE_PARAMETERS['TOR_ISOLATION']: 'shared',
+        path + STAGE_PARAMETERS['TOR_RESTART']: 'never',
+        path + STAGE_PARAMETERS['TOR_CONTROL']: 'never',
+        path + STAGE_PARAMETERS['SECUREDROP_MIN_VERSION']: '2.0.0',
+        path + STAGE_PARAMETERS['HEALTHCHECK_SLOW']: '10',
+        SHARED_PARAMETERS['SECUREDROP_URL']: ONION,
+        SHARED_PARAMETERS['SECUREDROP_URL_HUMAN']: 'theguardian.securedrop.tor.onion',
+    })
+    return values
+
+
+@contextlib.contextmanager
+def working_directory() -> Iterator[str]:
+    # the monitor keeps its caches and build output in the working directory
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(previous)
+
+
+class Harness:
+    def __init__(self, scenario: Scenario, seed: int = 1):
+        self.scenario = scenario
+        self.clock = VirtualClock()
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.site = FakeSite(PAGE, delay=scenario.delay, metadata=METADATA)
+        self.proxy = FakeTorProxy({ONION: self.site}, scenario.tor, self.rng)
+        # the instances share the sites, so that an outage shows on all of them
+        self.proxies = [self.proxy] + [FakeTorProxy(self.proxy.sites, faults, self.rng) for faults in scenario.extra_tor]
+        self.webhook = FakeWebhook(scenario.webhook, self.rng)
+        self.s3 = self.inject(FakeS3())
+        self.dynamodb = self.inject(FakeDynamoDB())
+        self.ses = self.inject(FakeSES())
+        self.ssm: Optional[FaultInjector] = None
+        self.session: Optional[FakeSession] = None
+        self.errors = 0
+
+    def inject(self, fake) -> FaultInjector:
+        return FaultInjector(fake, self.scenario.aws, self.rng, sleep=self.clock.sleep, clock=self.clock.now)
+
+    def __enter__(self):
+        for proxy in self.proxies:
+            proxy.start()
+        self.webhook.__enter__()
+        self.ssm = self.inject(FakeSSM(parameters(self.webhook.url)))
+        self.session = FakeSession(s3=self.s3, dynamodb=self.dynamodb, ses=self.ses, ssm=self.ssm)
+        return self
+
+    def __exit__(self, *exc):
+        self.webhook.__exit__(*exc)
+        for proxy in self.proxies:
+            proxy.stop()
+
+    def probe_client(self):
+        if self.scenario.quorum:
+            return QuorumClient(*parse_quorum(self.scenario.quorum), proxies=[proxy.address for proxy in self.proxies])
+        return TorClient(self.proxy.address)
+
+    def cycle(self) -> Optional[Outcome]:
+        # one cron run: configuration, pages, checks and status; None if it did not complete
+        try:
+            config = create_config(self.session, STAGE)
+            config.update(CHECK_INTERVAL='60', HEALTHCHECK_TIMEOUT='5', HISTORY_STORE=self.scenario.history,
+                          PUBLISH_MODE=self.scenario.publish, TOR_QUORUM=self.scenario.quorum)
+            if build_pages(config['SECUREDROP_URL'], config['SECUREDROP_URL_HUMAN'], STAGE):
+                publish_pages(self.session, config)
+            store = create_history_store(self.session, config)
+            with self.probe_client() as client, create_dispatcher(self.session, config) as notifier, \
+                    ResultSink(store, sleep=self.clock.sleep) as sink:
+                history = create_history(store, config)
+                # a seeded scheduler, so that the backoff jitter is the same on every run
+                scheduler = create_scheduler(config, allow_restart=False, clock=self.clock, rng=random.Random(self.seed))
+                outcome = check_once(self.session, config, client, notifier, sink, history, restart=None,
+                                     scheduler=scheduler)
+                history.reconcile()
+            store.close()
+            return outcome
+        except (BotoCoreError, ClientError) as err:
+            self.errors += 1
+            print(f'  cycle failed: {err}', file=sys.stderr)
+            return None
+
+    def published(self, since: float, page: str) -> Optional[float]:
+        # when the status page was first replaced with, or pointed at, the given one after since
+        variant = variant_key(page.encode())
+        for at, operation, kwargs in self.s3.log:
+            if at < since or kwargs.get('Key') != 'index2.html':
+                continue
+            if operation == 'copy_object' and kwargs['CopySource']['Key'] == variant:
+                return at - since
+            if operation == 'put_object' and kwargs.get('WebsiteRedirectLocation', '').endswith(variant):
+                return at - since
+            if operation == 'put_object':
+                body = kwargs['Body']
+                if kwargs.get('ContentEncoding') == 'gzip':
+                    body = gzip.decompress(body)
+                if body == page.encode():
+                    return at - since
+        return None
+
+    def run(self, cycles: int = 5) -> Dict[str, Optional[float]]:
+        # the first cycle builds the pages and publishes the status, the rest are steady state
+        self.cycle()
+        timings = []
+        false_alarms = 0
+        for _ in range(cycles):
+            start = time.perf_counter()
+            outcome = self.cycle()
+            timings.append(time.perf_counter() - start)
+            # the onion is up throughout, so anything else is down to the injected faults
+            false_alarms += outcome is not None and not outcome.healthy
+
+        self.proxy.sites[ONION] = self.site._replace(status=503, body='Service Unavailable')
+        start = self.clock.now()
+        outcome = self.cycle()
+        # the scheduler times the check from its first attempt
+        detect = outcome.elapsed if outcome is not None and not outcome.healthy else None
+        with open(os.path.join('build', 'maintenance.html')) as fobj:
+            publish = self.published(start, fobj.read())
+        return {
+            'cycle': statistics.median(timings),
+            'detect': detect,
+            'publish': publish,
+            'errors': self.errors,
+            'false_alarms': false_alarms,
+            'notifications': len(self.webhook.received),
+        }
+
+
+def run_scenarios(scenarios=SCENARIOS, cycles: int = 5) -> Dict[str, Dict[str, Optional[float]]]:
+    results = {}
+    for scenario in scenarios:
+        with working_directory(), Harness(scenario) as harness:
+            results[scenario.name] = harness.run(cycles)
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.25, slack: float = 0.05) -> List[str]:
+    # timings more than tolerance (plus slack seconds, for noise) above the baseline, outages
+    # that were detected or published in the baseline but no longer are, and more failed cycles
+    regressions = []
+    for scenario, metrics in results.items():
+        # scenarios without a baseline yet are new, not regressions
+        expected_metrics = baseline.get(scenario)
+        if expected_metrics is None:
+            continue
+        for metric in ('cycle', 'detect', 'publish'):
+            value, expected = metrics.get(metric), expected_metrics.get(metric)
+            if expected is None:
+                continue
+            if value is None:
+                regressions.append(f'{scenario} {metric}: never happened, baseline {expected:.3f}s')
+            elif value > expected * (1 + tolerance) + slack:
+                regressions.append(f'{scenario} {metric}: {value:.3f}s, baseline {expected:.3f}s')
+        for metric in ('errors', 'false_alarms'):
+            value, expected = metrics.get(metric, 0), expected_metrics.get(metric, 0)
+            if value > expected:
+                regressions.append(f'{scenario} {metric}: {value}, baseline {expected}')
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Dict:
+    try:
+        with open(path) as fobj:
+            return json.load(fobj)
+    except FileNotFoundError:
+        return {}
+
+
+def report(results: Dict, baseline: Dict) -> None:
+    def seconds(value):
+        return f'{value:.3f}' if value is not None else '-'
+
+    print(f'{"scenario":<10} {"cycle (s)":>10} {"detect (s)":>11} {"publish (s)":>12} {"errors":>7} '
+          f'{"false alarms":>13} {"baseline":>24}')
+    for scenario, metrics in results.items():
+        expected = baseline.get(scenario, {})
+        print(f'{scenario:<10} {seconds(metrics["cycle"]):>10} {seconds(metrics["detect"]):>11} '
+              f'{seconds(metrics["publish"]):>12} {metrics["errors"]:>7} {metrics["false_alarms"]:>13} '
+              f'{" / ".join(seconds(expected.get(name)) for name in ("cycle", "detect", "publish")):>24}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the monitor cycle against local stand-ins.')
+    parser.add_argument('--cycles', type=int, default=5, help='healthy cycles to time per scenario')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--update-baseline', action='store_true', help=f'write the results to {BASELINE_PATH}')
+    args = parser.parse_args()
+
+    # the monitor logs every step of every cycle, and the injected faults as errors
+    logging.getLogger('securecontact').setLevel(logging.CRITICAL)
+    results = run_scenarios(cycles=args.cycles)
+    baseline = load_baseline()
+    report(results, baseline)
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as fobj:
+            json.dump(results, fobj, indent=2, sort_keys=True)
+            fobj.write('\n')
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import copy
+import decimal
+import numbers
+import timeit
+from collections.abc import Iterable, Mapping, Set
+from typing import Dict
+
+from src.dynamo import dump_to_dynamodb, load_from_dynamodb
+
+# Compares dump_to_dynamodb with the serializer it replaced on large nested items.
+#
+#   python -m benchmarks.bench_dynamo
+
+
+def legacy_dump_to_dynamodb(item):
+    context = decimal.Context(
+        Emin=-128, Emax=126, rounding=None, prec=38,
+        traps=[decimal.Clamped, decimal.Overflow, decimal.Underflow]
+    )
+    if isinstance(item, (str, bytes, bool)):
+        return item
+    if isinstance(item, numbers.Number):
+        return context.create_decimal(item)
+    elif isinstance(item, Dict):
+        for key, value in item.items():
+            item[key] = legacy_dump_to_dynamodb(value)
+        return item
+    elif isinstance(item, Mapping):
+        return {key: legacy_dump_to_dynamodb(value) for key, value in item.items()}
+    elif isinstance(item, Set):
+        return set(map(legacy_dump_to_dynamodb, item))
+    elif isinstance(item, Iterable):
+        return list(map(legacy_dump_to_dynamodb, item))
+    return item
+
+
+def create_large_item(attempts: int = 200) -> dict:
+    return {
+        'CheckTime': 1570701600,
+        'ExpirationTime': 1571306400,
+        'Outcome': 'True',
+        'Attempts': [
+            {
+                'Attempt': attempt,
+                'Latency': attempt * 0.125,
+                'Healthy': attempt % 3 == 0,
+                'Failure': None if attempt % 3 == 0 else 'timeout',
+                'Timings': {'connect': 1.5, 'tls': 0.0, 'first_byte': 0.75, 'total': 2.5},
+                'Targets': ['a.onion', 'b.onion'],
+            }
+            for attempt in range(attempts)
+        ]
+    }
+
+
+def main(repeat: int = 50):
+    item = create_large_item()
+    # the legacy serializer converts dicts in place, so it gets a fresh copy for every run
+    copies = [copy.deepcopy(item) for _ in range(repeat)]
+    legacy = timeit.timeit(lambda: legacy_dump_to_dynamodb(copies.pop()), number=repeat)
+    current = timeit.timeit(lambda: dump_to_dynamodb(item), number=repeat)
+    dumped = dump_to_dynamodb(item)
+    load = timeit.timeit(lambda: load_from_dynamodb(dumped), number=repeat)
+
+    print(f'{"legacy dump":<14} {legacy / repeat * 1000:8.3f} ms per item')
+    print(f'{"dump":<14} {current / repeat * 1000:8.3f} ms per item ({legacy / current:.1f}x faster)')
+    print(f'{"load":<14} {load / repeat * 1000:8.3f} ms per item')
+
+
+if __name__ == '__main__':
+    main()
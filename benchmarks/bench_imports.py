@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+# Measures what importing each entry point costs, as reported by python -X importtime.
+#
+#   python -m benchmarks.bench_imports
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ('src.monitor', 'src.notifications', 'src.config', 'securedrop')
+# loaded on first use only, so runs that never need them never pay for them
+HEAVY_MODULES = ('boto3', 'botocore.client', 'requests', 'jinja2', 'cryptography')
+# generous, the point is to notice when boto3 (about 150ms on its own) comes back
+IMPORT_BUDGET = 120 * 1000
+
+
+def import_times(module: str) -> Dict[str, int]:
+    # module -> cumulative import time in microseconds, in a fresh interpreter
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def loaded_modules(module: str) -> List[str]:
+    # everything in sys.modules after importing module, in a fresh interpreter
+    result = subprocess.run([sys.executable, '-c', f'import sys, {module}; print(*sys.modules, sep="\\n")'], cwd=ROOT,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return result.stdout.split()
+
+
+def main() -> int:
+    over = 0
+    for module in ENTRY_POINTS:
+        times = import_times(module)
+        heavy = [name for name in HEAVY_MODULES if name in times]
+        over += times[module] > IMPORT_BUDGET
+        print(f'{module:20} {times[module] / 1000:8.1f}ms{"  over budget" if times[module] > IMPORT_BUDGET else ""}  '
+              f'heavy modules: {", ".join(heavy) or "none"}')
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
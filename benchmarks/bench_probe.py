@@ -0,0 +1,29 @@
+import time
+
+from benchmarks.fakes import FakeSite, FakeTorProxy
+from src.probe import probe_targets
+
+# Measures how the wall time of one sweep scales with the number of targets.
+# Every fake onion answers after PROBE_DELAY seconds, so a sequential loop would take
+# roughly targets * PROBE_DELAY while a concurrent sweep should stay close to PROBE_DELAY.
+#
+#   python -m benchmarks.bench_probe
+
+PROBE_DELAY = 0.2
+
+
+def main():
+    sites = {f'mirror{i}.onion': FakeSite(delay=PROBE_DELAY) for i in range(64)}
+    with FakeTorProxy(sites) as proxy:
+        print(f'{"targets":>8} {"sweep (s)":>10} {"sequential (s)":>15}')
+        for count in (1, 2, 4, 8, 16, 32, 64):
+            targets = list(sites)[:count]
+            start = time.perf_counter()
+            results = probe_targets(targets, proxy=proxy.address, limit=count)
+            elapsed = time.perf_counter() - start
+            assert all(results)
+            print(f'{count:>8} {elapsed:>10.3f} {count * PROBE_DELAY:>15.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,549 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+
+# In-process stand-ins for the services the monitor talks to, used by the benchmarks and tests.
+
+
+class FakeSite(NamedTuple):
+    body: str = '<html><title>The Guardian | SecureDrop</title></html>'
+    status: int = 200
+    delay: float = 0.0
+    # SOCKS reply code sent instead of connecting, e.g. 4 (host unreachable) for a missing descriptor
+    socks_error: Optional[int] = None
+    # served at /metadata, like a SecureDrop source interface; anything else gets the body
+    metadata: Optional[str] = None
+    chunked: bool = False
+    content_type: str = 'text/html; charset=utf-8'
+    # sent instead of the real length, or the size of the first chunk
+    framing: Optional[str] = None
+
+
+class Faults(NamedTuple):
+    # added to every call, in seconds
+    latency: float = 0.0
+    # share of calls that fail straight away
+    error_rate: float = 0.0
+    # share of calls that hang for timeout seconds before failing
+    timeout_rate: float = 0.0
+    timeout: float = 5.0
+
+    def roll(self, rng: random.Random) -> Optional[str]:
+        # which fault, if any, the next call suffers
+        roll = rng.random()
+        if roll < self.timeout_rate:
+            return 'timeout'
+        if roll < self.timeout_rate + self.error_rate:
+            return 'error'
+        return None
+
+
+class FakeTorProxy:
+    # A SOCKS5 proxy that serves HTTP for the registered sites itself, running on its own event loop.
+    # Fault latency is added to the SOCKS handshake, where Tor would build the circuit. Errors and
+    # timeouts hit the handshake, as a general SOCKS server failure, and every request on an open
+    # connection, which is then dropped without an answer.
+    def __init__(self, sites: Optional[Dict[str, FakeSite]] = None, faults: Faults = Faults(),
+                 rng: Optional[random.Random] = None):
+        self.sites = sites or {}
+        self.faults = faults
+        self.rng = rng or random.Random()
+        self.connections = 0
+        self.requests = 0
+        self.credentials: List[Tuple[str, str]] = []
+        self.address = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self) -> None:
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, '127.0.0.1', 0), self._loop
+        ).result()
+        self.address = self._server.sockets[0].getsockname()[:2]
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _shutdown(self) -> None:
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            site = await self._handshake(reader, writer)
+            if site is not None:
+                await self._serve(site, reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # cancelled on shutdown, which asyncio would otherwise log as an error of the handler
+            pass
+        finally:
+            writer.close()
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[FakeSite]:
+        _, count = await reader.readexactly(2)
+        methods = await reader.readexactly(count)
+        method = 2 if 2 in methods else 0
+        writer.write(bytes([5, method]))
+        if method == 2:
+            _, length = await reader.readexactly(2)
+            username = (await reader.readexactly(length)).decode()
+            length = (await reader.readexactly(1))[0]
+            password = (await reader.readexactly(length)).decode()
+            self.credentials.append((username, password))
+            writer.write(bytes([1, 0]))
+
+        _, _, _, address_type = await reader.readexactly(4)
+        length = (await reader.readexactly(1))[0]
+        host = (await reader.readexactly(length)).decode()
+        await reader.readexactly(2)
+
+        site = self.sites.get(host, FakeSite(socks_error=4))
+        reply = site.socks_error or 0
+        await asyncio.sleep(self.faults.latency)
+        fault = self.faults.roll(self.rng)
+        if fault == 'timeout':
+            await asyncio.sleep(self.faults.timeout)
+            return None
+        if fault == 'error':
+            reply = 1
+        writer.write(bytes([5, reply, 0, 1, 0, 0, 0, 0, 0, 0]))
+        await writer.drain()
+        return None if reply else site
+
+    async def _serve(self, site: FakeSite, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            self.requests += 1
+            fault = self.faults.roll(self.rng)
+            if fault == 'timeout':
+                await asyncio.sleep(self.faults.timeout)
+            if fault:
+                return
+            await asyncio.sleep(site.delay)
+            path = head.split(b' ', 2)[1].decode()
+            if path == '/metadata' and site.metadata is not None:
+                status, content_type, body = 200, 'application/json', site.metadata.encode()
+            else:
+                status, content_type, body = site.status, site.content_type, site.body.encode()
+            keep_alive = b'connection: close' not in head.lower()
+            if site.chunked:
+                framing = 'Transfer-Encoding: chunked'
+                step = 4096
+                body = b''.join(b'%x\r\n%s\r\n' % (len(body[i:i + step]), body[i:i + step])
+                                for i in range(0, len(body), step)) + b'0\r\n\r\n'
+                if site.framing is not None:
+                    body = site.framing.encode() + body[body.index(b'\r\n'):]
+            else:
+                framing = f'Content-Length: {len(body) if site.framing is None else site.framing}'
+            writer.write(
+                f'HTTP/1.1 {status} OK\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'{framing}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+            if not keep_alive:
+                return
+
+
+class FakeTorController:
+    # A Tor control port that answers the commands src.control sends from a scripted state.
+    # descriptors maps a service id to RECEIVED or FAILED; other services get no HS_DESC answer.
+    def __init__(self, bootstrap: int = 100, circuits: Sequence[str] = ('BUILT',),
+                 descriptors: Optional[Dict[str, str]] = None, cookie: Optional[bytes] = None):
+        self.bootstrap = bootstrap
+        self.circuits = list(circuits)
+        self.descriptors = descriptors or {}
+        self.cookie = cookie
+        self.commands: List[str] = []
+        self.newnym = 0
+        self.address = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._server = None
+
+    __enter__ = FakeTorProxy.__enter__
+    __exit__ = FakeTorProxy.__exit__
+    start = FakeTorProxy.start
+    stop = FakeTorProxy.stop
+    _shutdown = FakeTorProxy._shutdown
+
+    def _reply(self, line: str) -> str:
+        command, _, argument = line.partition(' ')
+        if command == 'AUTHENTICATE':
+            if self.cookie is not None and argument != self.cookie.hex():
+                return '515 Authentication failed: Wrong length on authentication cookie.\r\n'
+            return '250 OK\r\n'
+        if line == 'SIGNAL NEWNYM':
+            self.newnym += 1
+            return '250 OK\r\n'
+        if line == 'GETINFO status/bootstrap-phase':
+            return (f'250-status/bootstrap-phase=NOTICE BOOTSTRAP PROGRESS={self.bootstrap} TAG=done '
+                    f'SUMMARY="Done"\r\n250 OK\r\n')
+        if line == 'GETINFO circuit-status':
+            lines = ''.join(f'{index} {status} $ABCD~relay PURPOSE=GENERAL\r\n'
+                            for index, status in enumerate(self.circuits, 1))
+            return f'250+circuit-status=\r\n{lines}.\r\n250 OK\r\n'
+        if command == 'SETEVENTS':
+            return '250 OK\r\n'
+        if command == 'HSFETCH':
+            reply = f'250 OK\r\n650 HS_DESC REQUESTED {argument} NO_AUTH $ABCD~hsdir descid\r\n'
+            outcome = self.descriptors.get(argument)
+            if outcome == 'RECEIVED':
+                reply += f'650 HS_DESC RECEIVED {argument} NO_AUTH $ABCD~hsdir descid\r\n'
+            elif outcome == 'FAILED':
+                reply += f'650 HS_DESC FAILED {argument} NO_AUTH $ABCD~hsdir descid REASON=NOT_FOUND\r\n'
+            return reply
+        return f'510 Unrecognized command "{command}"\r\n'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = (await reader.readuntil(b'\r\n')).decode().strip()
+                self.commands.append(line)
+                if line == 'QUIT':
+                    writer.write(b'250 closing connection\r\n')
+                    return
+                writer.write(self._reply(line).encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+CONDITIONS = {
+    '=': lambda value, other: value == other,
+    '<>': lambda value, other: value != other,
+    '<': lambda value, other: value is not None and value < other,
+    '<=': lambda value, other: value is not None and value <= other,
+    '>': lambda value, other: value is not None and value > other,
+    '>=': lambda value, other: value is not None and value >= other,
+}
+
+
+def matches(condition, item: dict) -> bool:
+    # evaluates the boto3.dynamodb.conditions objects the monitor builds
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(matches(value, item) for value in values)
+    if operator == 'OR':
+        return any(matches(value, item) for value in values)
+    if operator == 'NOT':
+        return not matches(values[0], item)
+    if operator == 'attribute_exists':
+        return values[0].name in item
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+    if operator == 'BETWEEN':
+        value = item.get(values[0].name)
+        return value is not None and values[1] <= value <= values[2]
+    return CONDITIONS[operator](item.get(values[0].name), values[1])
+
+
+class FakeTable:
+    def __init__(self, key_schema: Sequence[str], indexes: Optional[Dict[str, Tuple[str, str]]] = None):
+        self.key_schema = key_schema
+        self.indexes = indexes or {}
+        self.items: Dict[tuple, dict] = {}
+        self.calls: Dict[str, int] = {}
+
+    def _count(self, operation: str) -> None:
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _check(self, key: tuple, condition, operation: str) -> dict:
+        # the item a write replaces, if the condition holds for it
+        existing = self.items.get(key, {})
+        if condition is not None and not matches(condition, existing):
+            raise client_error('ConditionalCheckFailedException', operation)
+        return existing
+
+    def put_item(self, Item: dict, ConditionExpression=None, ReturnValues: str = 'NONE', **kwargs) -> dict:
+        self._count('put_item')
+        key = tuple(Item[name] for name in self.key_schema)
+        existing = self._check(key, ConditionExpression, 'PutItem')
+        self.items[key] = dict(Item)
+        return {'Attributes': dict(existing)} if ReturnValues == 'ALL_OLD' and existing else {}
+
+    def delete_item(self, Key: dict, ConditionExpression=None, **kwargs) -> dict:
+        self._count('delete_item')
+        key = tuple(Key[name] for name in self.key_schema)
+        self._check(key, ConditionExpression, 'DeleteItem')
+        self.items.pop(key, None)
+        return {}
+
+    def batch_writer(self, overwrite_by_pkeys: Optional[List[str]] = None) -> 'FakeBatchWriter':
+        return FakeBatchWriter(self)
+
+    def query(self, KeyConditionExpression, IndexName: Optional[str] = None, ScanIndexForward: bool = True,
+              Limit: Optional[int] = None, **kwargs) -> dict:
+        self._count('query')
+        sort_key = self.indexes[IndexName][1] if IndexName else self.key_schema[-1]
+        found = sorted(
+            (item for item in self.items.values() if matches(KeyConditionExpression, item)),
+            key=lambda item: item[sort_key], reverse=not ScanIndexForward
+        )
+        return {'Items': found[:Limit] if Limit else found, 'Count': len(found)}
+
+    def scan(self, **kwargs) -> dict:
+        self._count('scan')
+        return {'Items': list(self.items.values())}
+
+
+class FakeBatchWriter:
+    def __init__(self, table: FakeTable):
+        self.table = table
+        self.items: List[dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for start in range(0, len(self.items), 25):
+            self.table._count('batch_write_item')
+            for item in self.items[start:start + 25]:
+                self.table.items[tuple(item[name] for name in self.table.key_schema)] = dict(item)
+
+    def put_item(self, Item: dict) -> None:
+        self.items.append(Item)
+
+
+class FakeDynamoDB:
+    # stands in for a boto3 DynamoDB service resource
+    def __init__(self):
+        self.tables: Dict[str, FakeTable] = {}
+
+    def Table(self, name: str) -> FakeTable:
+        # the same layouts as the MonitorCluster and MonitorHistory tables in the CloudFormation template
+        if name not in self.tables and name.startswith('MonitorCluster'):
+            self.tables[name] = FakeTable(('Kind', 'Name'))
+        elif name not in self.tables:
+            self.tables[name] = FakeTable(('CheckTime', 'Outcome'), {'HistoryByTime': ('HistoryKey', 'CheckTime')})
+        return self.tables[name]
+
+
+def client_error(code: str, operation: str, status: int = 400) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                       operation)
+
+
+class FakeS3:
+    # stands in for a boto3 S3 client, objects are kept as dicts of the put_object arguments
+    def __init__(self):
+        self.objects: Dict[Tuple[str, str], dict] = {}
+        self.calls: Dict[str, int] = {}
+
+    def _count(self, operation: str) -> None:
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs) -> dict:
+        self._count('put_object')
+        etag = f'"{hashlib.md5(Body).hexdigest()}"'
+        self.objects[(Bucket, Key)] = dict(kwargs, Body=Body, ETag=etag, Metadata=kwargs.get('Metadata', {}),
+                                           LastModified=datetime.now(timezone.utc))
+        return {'ETag': etag, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        self._count('head_object')
+        if (Bucket, Key) not in self.objects:
+            raise client_error('404', 'HeadObject', 404)
+        stored = {name: value for name, value in self.objects[(Bucket, Key)].items() if name != 'Body'}
+        return dict(stored, ContentLength=len(self.objects[(Bucket, Key)]['Body']),
+                    ResponseMetadata={'HTTPStatusCode': 200})
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: dict, MetadataDirective: str = 'COPY', **kwargs) -> dict:
+        self._count('copy_object')
+        source = self.objects.get((CopySource['Bucket'], CopySource['Key']))
+        if source is None:
+            raise client_error('NoSuchKey', 'CopyObject', 404)
+        attributes = dict(kwargs, Metadata=kwargs.get('Metadata', {})) if MetadataDirective == 'REPLACE' else source
+        self.objects[(Bucket, Key)] = dict(attributes, Body=source['Body'], ETag=source['ETag'],
+                                           LastModified=datetime.now(timezone.utc))
+        return {'CopyObjectResult': {'ETag': source['ETag']}, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        self._count('get_object')
+        if (Bucket, Key) not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject', 404)
+        return dict(self.objects[(Bucket, Key)], ResponseMetadata={'HTTPStatusCode': 200})
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, ExtraArgs: Optional[dict] = None) -> None:
+        with open(Filename, 'rb') as fobj:
+            self.put_object(Bucket=Bucket, Key=Key, Body=fobj.read(), **(ExtraArgs or {}))
+
+
+class FakeSSM:
+    # stands in for a boto3 SSM client holding plain string parameters
+    def __init__(self, parameters: Optional[Dict[str, str]] = None, page_size: int = 10, error: Optional[Exception] = None):
+        self.parameters = dict(parameters or {})
+        self.page_size = page_size
+        self.error = error
+        self.calls: Dict[str, int] = {}
+
+    def _count(self, operation: str) -> None:
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.error:
+            raise self.error
+
+    def get_parameters_by_path(self, Path: str, Recursive: bool = False, WithDecryption: bool = False,
+                               NextToken: Optional[str] = None) -> dict:
+        self._count('get_parameters_by_path')
+        names = sorted(name for name in self.parameters
+                       if name.startswith(Path) and (Recursive or '/' not in name[len(Path):]))
+        start = int(NextToken or 0)
+        page = names[start:start + self.page_size]
+        response = {'Parameters': [{'Name': name, 'Value': self.parameters[name]} for name in page]}
+        if start + self.page_size < len(names):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    def get_parameters(self, Names: List[str], WithDecryption: bool = False) -> dict:
+        self._count('get_parameters')
+        if len(Names) > 10:
+            raise client_error('ValidationException', 'GetParameters')
+        return {
+            'Parameters': [{'Name': name, 'Value': self.parameters[name]} for name in Names if name in self.parameters],
+            'InvalidParameters': [name for name in Names if name not in self.parameters]
+        }
+
+
+class FakeSES:
+    # stands in for a boto3 SES client
+    def __init__(self):
+        self.sent: List[dict] = []
+
+    def send_email(self, Destination: dict, Message: dict, Source: str) -> dict:
+        self.sent.append({'Destination': Destination, 'Message': Message, 'Source': Source})
+        return {'MessageId': str(uuid.uuid4()), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+class FaultInjector:
+    # Wraps one of the fakes above so that every call can be slowed down, fail with a
+    # ServiceUnavailable ClientError or time out, like a boto3 client or resource would.
+    # Calls are logged with the time they completed, for the benchmarks to measure against.
+    def __init__(self, target, faults: Faults = Faults(), rng: Optional[random.Random] = None,
+                 sleep=time.sleep, clock=time.monotonic, nested: Sequence[str] = ('Table',)):
+        self._target = target
+        self._faults = faults
+        self._rng = rng or random.Random()
+        self._sleep = sleep
+        self._clock = clock
+        # methods that return another service object, e.g. a DynamoDB Table, rather than calling AWS
+        self._nested = nested
+        self.log: List[Tuple[float, str, dict]] = []
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        if name in self._nested:
+            def nested(*args, **kwargs):
+                wrapped = FaultInjector(attribute(*args, **kwargs), self._faults, self._rng, self._sleep, self._clock,
+                                        self._nested)
+                # calls on the nested object share this log
+                wrapped.log = self.log
+                return wrapped
+            return nested
+
+        def call(*args, **kwargs):
+            self._sleep(self._faults.latency)
+            fault = self._faults.roll(self._rng)
+            if fault == 'timeout':
+                self._sleep(self._faults.timeout)
+                raise ReadTimeoutError(endpoint_url=f'https://fake/{name}')
+            if fault == 'error':
+                raise client_error('ServiceUnavailable', name, 503)
+            result = attribute(*args, **kwargs)
+            self.log.append((self._clock(), name, kwargs))
+            return result
+        return call
+
+    def __enter__(self):
+        return self._target.__enter__()
+
+    def __exit__(self, *exc):
+        return self._target.__exit__(*exc)
+
+
+class FakeSession:
+    # stands in for a boto3 Session, handing out the same fake for every client or resource of a service
+    def __init__(self, **services):
+        self.services = services
+
+    def client(self, service: str, **kwargs):
+        return self.services[service]
+
+    def resource(self, service: str, **kwargs):
+        return self.services[service]
+
+
+class FakeWebhook:
+    # An HTTP server standing in for the chat webhook, recording every JSON payload posted to it
+    def __init__(self, faults: Faults = Faults(), rng: Optional[random.Random] = None):
+        self.faults = faults
+        self.rng = rng or random.Random()
+        self.received: List[Tuple[float, dict]] = []
+        self.url = None
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(webhook.faults.latency)
+                fault = webhook.faults.roll(webhook.rng)
+                if fault == 'timeout':
+                    time.sleep(webhook.faults.timeout)
+                if fault:
+                    self.send_response(503)
+                else:
+                    webhook.received.append((time.monotonic(), json.loads(body)))
+                    self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}/webhook'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
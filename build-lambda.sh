@@ -25,14 +25,22 @@ BUILD_START_DATE=$(date +"%Y-%m-%dT%H:%M:%S.000Z")
 mkdir -p target/packages
 mkdir -p target/lambda
 
+# The slim requirements leave out the AWS CLI, Flask and the packages the Lambda runtime
+# already provides; set REQUIREMENTS=requirements.txt to bundle everything
+if [[ -z ${REQUIREMENTS} ]]; then
+  REQUIREMENTS=requirements-lambda.txt
+fi
+
 # Download required python packages so we can bundle them
-pip install --target target/packages -r requirements.txt
+pip install --target target/packages -r ${REQUIREMENTS}
 
 # archive entire directory and subdirectories using maximum compression
 cd target/packages
 zip -r9 $OLDPWD/target/lambda/${APP}.zip .
 cd $OLDPWD
 
+zip -gr target/lambda/${APP}.zip securedrop.py assets.py
+zip -gr target/lambda/${APP}.zip src -x "*/__pycache__/*"
 zip -gr target/lambda/${APP}.zip static
 zip -gr target/lambda/${APP}.zip templates
 
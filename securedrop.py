@@ -1,48 +1,117 @@
+import hashlib
+import logging
 import os
-import shutil
+import tempfile
+from typing import List, Optional, Tuple
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 
+from assets import Assets, build_assets
+
+
+logger = logging.getLogger('securecontact.securedrop')
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = THIS_DIR + '/templates/public'
+STATIC_DIR = THIS_DIR + '/static'
+CACHE_DIR = THIS_DIR + '/.build-cache'
+FINGERPRINT_FILE = '.fingerprint'
+
+
+def create_bytecode_cache(directory: str):
+    # compiled templates are cached on disk when the directory is writable (it is not in Lambda)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory) if os.access(directory, os.W_OK) else None
+
+
 env = Environment(
-    loader=FileSystemLoader(THIS_DIR + '/templates/public'),
+    loader=FileSystemLoader(TEMPLATE_DIR),
     trim_blocks=True,
-    autoescape=select_autoescape(['html', 'xml'])
+    autoescape=select_autoescape(['html', 'xml']),
+    bytecode_cache=create_bytecode_cache(CACHE_DIR + '/jinja')
 )
 
 
-def render_page(securedrop_url: str, securedrop_url_human: str, path: str, passes_healthcheck: bool):
+def render_page(securedrop_url: str, securedrop_url_human: str, path: str, passes_healthcheck: bool,
+                assets: Optional[Assets] = None):
     root_template = env.get_template('securedrop.html')
     return root_template.render(
         securedrop_url=securedrop_url,
         securedrop_url_human = securedrop_url_human,
         path=path,
-        passes_healthcheck=passes_healthcheck
+        passes_healthcheck=passes_healthcheck,
+        stylesheet=assets.stylesheet if assets else None,
+        critical_css=assets.critical_css if assets else None
     )
 
 
-def build_pages(securedrop_url: str, securedrop_url_human: str, stage: str):
+def fingerprint(*values: str, directories=(TEMPLATE_DIR, STATIC_DIR)) -> str:
+    # covers everything a build depends on, including this module and the asset pipeline
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(value.encode() + b'\0')
+    files = [os.path.abspath(__file__), os.path.join(THIS_DIR, 'assets.py')]
+    for directory in directories:
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names))
+    for file_name in files:
+        digest.update(os.path.relpath(file_name, THIS_DIR).encode() + b'\0')
+        with open(file_name, 'rb') as fobj:
+            digest.update(hashlib.sha256(fobj.read()).digest())
+    return digest.hexdigest()
+
+
+def write_atomic(file_name: str, content: str):
+    # readers see either the old file or the new one, never a partial write
+    directory = os.path.dirname(os.path.abspath(file_name))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.tmp-', delete=False) as fobj:
+        fobj.write(content)
+    os.chmod(fobj.name, 0o644)
+    os.replace(fobj.name, file_name)
+
+
+def read_fingerprint(build_dir: str) -> Tuple[Optional[str], List[str]]:
+    # the fingerprint of the last build, and the files it wrote relative to build_dir, one per line
+    try:
+        with open(os.path.join(build_dir, FINGERPRINT_FILE)) as fobj:
+            lines = fobj.read().split('\n')
+    except OSError:
+        return None, []
+    return lines[0].strip(), [line for line in lines[1:] if line]
+
+
+def build_pages(securedrop_url: str, securedrop_url_human: str, stage: str, build_dir: str = './build') -> bool:
     # routing in Fastly requires the PROD pages to include securedrop/ before links to assets
     path = 'securedrop/' if stage == 'PROD' else ''
 
-    if os.path.exists('./build'):
-        shutil.rmtree('./build')
-    os.makedirs('./build')
-
-    passed = render_page(securedrop_url, securedrop_url_human, path=path, passes_healthcheck=True)
-    failed = render_page(securedrop_url, securedrop_url_human, path=path, passes_healthcheck=False)
+    outputs = [os.path.join(build_dir, 'index.html'), os.path.join(build_dir, 'maintenance.html')]
+    current = fingerprint(securedrop_url or '', securedrop_url_human or '', path)
+    # the assets are published from build/static, so they have to be there as well as the pages
+    built, files = read_fingerprint(build_dir)
+    if built == current and files and all(os.path.exists(output) for output in outputs) and \
+            all(os.path.isfile(os.path.join(build_dir, name)) for name in files):
+        logger.info('pages are up to date, skipping build')
+        return False
 
-    index = open("build/index.html", "w")
-    maintenance = open("build/maintenance.html", "w")
+    os.makedirs(build_dir, exist_ok=True)
+    # the stylesheet is purged against the markup of both pages before they are rendered with it
+    pages = [render_page(securedrop_url, securedrop_url_human, path=path, passes_healthcheck=healthy)
+             for healthy in (True, False)]
+    assets = build_assets(STATIC_DIR, os.path.join(build_dir, 'static'), pages)
+    passed = render_page(securedrop_url, securedrop_url_human, path=path, passes_healthcheck=True, assets=assets)
+    failed = render_page(securedrop_url, securedrop_url_human, path=path, passes_healthcheck=False, assets=assets)
 
-    index.write(passed)
-    maintenance.write(failed)
-    index.close()
-    maintenance.close()
+    write_atomic(outputs[0], passed)
+    write_atomic(outputs[1], failed)
+    # written last, so an interrupted build is redone on the next run
+    static = sorted(f'static/{name}' for name in os.listdir(os.path.join(build_dir, 'static')))
+    write_atomic(os.path.join(build_dir, FINGERPRINT_FILE), '\n'.join([current] + static) + '\n')
+    return True
 
 
 if __name__ == '__main__':
     build_pages('xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion', 'theguardian.securedrop.tor.onion', stage='DEV')
-    shutil.copytree('./static', './build/static')
-
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from src.history import STORE_ERRORS, HistoryStore
+from src.state import state_path
+
+
+logger = logging.getLogger('securecontact.cache')
+
+DEFAULT_CACHE_PATH = state_path('state-cache.json')
+CACHE_VERSION = 1
+
+
+class StateCache:
+    # A small JSON file holding the most recent outcomes, plus results not yet written to the store.
+    # A missing or unreadable file is treated as empty and stale, so the next read goes to the store.
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: float = 6 * 3600, size: int = 48,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self.items: List[Dict] = []
+        self.pending: List[Dict] = []
+        self.reconciled_at = 0.0
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fobj:
+                data = json.load(fobj)
+            if data.get('version') != CACHE_VERSION:
+                raise ValueError(f'unsupported cache version {data.get("version")}')
+            items, pending = list(data['items']), list(data['pending'])
+            reconciled_at = float(data['reconciled_at'])
+            if not all(isinstance(item.get('CheckTime'), (int, float)) and 'Outcome' in item for item in items + pending):
+                raise ValueError('malformed cache item')
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as err:
+            logger.warning(f'ignoring unreadable state cache {self.path}: {err}')
+            return
+        self.items, self.pending, self.reconciled_at = items, pending, reconciled_at
+        self.evict()
+
+    def save(self) -> None:
+        data = {
+            'version': CACHE_VERSION,
+            'reconciled_at': self.reconciled_at,
+            'items': self.items,
+            'pending': self.pending
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fobj:
+                json.dump(data, fobj)
+            os.replace(fobj.name, self.path)
+        except OSError as err:
+            logger.warning(f'unable to save state cache {self.path}: {err}')
+
+    def evict(self) -> None:
+        # results that still have to reach the store are never evicted
+        cutoff = self.clock() - self.ttl
+        self.items = [item for item in self.items if item['CheckTime'] >= cutoff][:self.size]
+
+    def add(self, item: Dict, pending: bool = True) -> None:
+        self.items = sorted(self.items + [item], key=lambda cached: cached['CheckTime'], reverse=True)
+        if pending:
+            self.pending.append(item)
+        self.evict()
+
+    def is_fresh(self, interval: float) -> bool:
+        # an empty window tells us nothing about the previous state
+        return bool(self.items) and self.clock() - self.reconciled_at < interval
+
+
+class CachedHistory:
+    # Reads the latest outcomes from the local cache and only falls back to the history store when
+    # the cache is stale. Results are written to the store when the cache is reconciled, or straight
+    # away when flush is requested.
+    def __init__(self, store: HistoryStore, cache: StateCache, reconcile_interval: float = 3600):
+        self.store = store
+        self.cache = cache
+        self.reconcile_interval = reconcile_interval
+
+    def latest(self, limit: int = 10) -> List[Dict]:
+        if not self.cache.is_fresh(self.reconcile_interval):
+            self.reconcile()
+        return self.cache.items[:limit]
+
+    def record(self, item: Dict, flush: bool = False) -> None:
+        self.cache.add(item)
+        if flush or not self.cache.is_fresh(self.reconcile_interval):
+            self.reconcile()
+        else:
+            self.cache.save()
+
+    def reconcile(self) -> bool:
+        # on failure the cache keeps serving what it has and pending results wait for the next attempt
+        try:
+            if self.cache.pending:
+                self.store.write(self.cache.pending)
+                self.cache.pending = []
+            latest = self.store.latest(limit=self.cache.size)
+        except STORE_ERRORS as err:
+            logger.error(f'unable to reconcile the state cache with {self.store.name}: {err}')
+            self.cache.save()
+            return False
+
+        self.cache.items = []
+        for item in latest:
+            self.cache.add(item, pending=False)
+        self.cache.reconciled_at = self.cache.clock()
+        self.cache.save()
+        logger.info(f'state cache reconciled with {self.store.name}')
+        return True
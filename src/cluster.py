@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import socket
+import time
+from typing import Callable, List, Optional, Sequence
+
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger('securecontact.cluster')
+
+# Several monitor hosts share the MonitorCluster-<STAGE> table. Each node registers a heartbeat
+# under Kind=node, and whichever node holds the lease under Kind=lease is the leader, the only
+# one that publishes the status page and sends notifications. Both are taken with conditional
+# writes, so two nodes can never both believe they hold the same lease.
+# If you update this then be sure to also update the CloudFormation definition.
+NODE_KIND = 'node'
+LEASE_KIND = 'lease'
+LEADER_LEASE = 'leader'
+# how much longer than the longest check the lease lasts, for the time around the retries
+LEASE_MARGIN = 120
+
+
+def node_name() -> str:
+    # the same on every run from the same host, so cron runs keep their lease
+    return socket.gethostname()
+
+
+def rendezvous_owner(target: str, nodes: Sequence[str]) -> str:
+    # Highest random weight hashing: every node ranks the same way, and when a node goes only
+    # its own targets move, spread over the rest
+    return max(nodes, key=lambda node: hashlib.sha256(f'{node}\0{target}'.encode()).digest())
+
+
+class Cluster:
+    def __init__(self, dynamodb, table_name: str, node: Optional[str] = None, lease_duration: float = 90,
+                 clock: Callable[[], float] = time.time, heartbeat_duration: Optional[float] = None):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.node = node or node_name()
+        self.lease_duration = lease_duration
+        # a node that misses its heartbeat is taken as gone, by default after as long as the lease
+        self.heartbeat_duration = heartbeat_duration or lease_duration
+        self.clock = clock
+        self.leader = False
+        # True when the last acquire took the lease over from another node, or found it free
+        self.elected = False
+
+    @property
+    def table(self):
+        return self.dynamodb.Table(self.table_name)
+
+    def heartbeat(self) -> None:
+        now = self.clock()
+        self.table.put_item(Item={
+            'Kind': NODE_KIND,
+            'Name': self.node,
+            'LastSeen': int(now),
+            # also the TTL attribute, so the table does not keep nodes that are long gone
+            'ExpiresAt': int(now + self.heartbeat_duration)
+        })
+
+    def nodes(self) -> List[str]:
+        # the nodes with a live heartbeat, always including this one
+        from boto3.dynamodb.conditions import Key
+        response = self.table.query(KeyConditionExpression=Key('Kind').eq(NODE_KIND))
+        now = self.clock()
+        live = {item['Name'] for item in response['Items'] if item['ExpiresAt'] > now}
+        return sorted(live | {self.node})
+
+    def acquire(self) -> bool:
+        # takes the lease when it is free or has expired, or extends it when this node holds it
+        from boto3.dynamodb.conditions import Attr
+        now = self.clock()
+        condition = Attr('Name').not_exists() | Attr('Owner').eq(self.node) | Attr('ExpiresAt').lte(int(now))
+        try:
+            response = self.table.put_item(
+                Item={'Kind': LEASE_KIND, 'Name': LEADER_LEASE, 'Owner': self.node,
+                      'ExpiresAt': int(now + self.lease_duration)},
+                ConditionExpression=condition,
+                ReturnValues='ALL_OLD'
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            if self.leader:
+                logger.warning(f'{self.node} lost the leader lease')
+            self.leader = self.elected = False
+            return False
+        self.elected = response.get('Attributes', {}).get('Owner') != self.node
+        if self.elected:
+            logger.info(f'{self.node} is now the leader')
+        self.leader = True
+        return True
+
+    def release(self) -> None:
+        # lets another node take over straight away, rather than once the lease expires
+        from boto3.dynamodb.conditions import Attr
+        if not self.leader:
+            return
+        try:
+            self.table.delete_item(Key={'Kind': LEASE_KIND, 'Name': LEADER_LEASE},
+                                   ConditionExpression=Attr('Owner').eq(self.node))
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        self.leader = self.elected = False
+
+    def share(self, targets: Sequence[str]) -> List[str]:
+        # The targets this node probes. The first target decides the status page, so it stays
+        # with the leader; the rest are spread over the live nodes, and rebalanced when one goes.
+        primary, mirrors = targets[0], targets[1:]
+        nodes = self.nodes()
+        return ([primary] if self.leader else []) + [
+            target for target in mirrors if rendezvous_owner(target, nodes) == self.node
+        ]
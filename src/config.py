@@ -0,0 +1,266 @@
+import atexit
+import importlib.util
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from src.state import state_path
+
+
+logger = logging.getLogger('securecontact.config')
+
+PARAMETER_PATH = '/secure-contact/{stage}/'
+# config key -> parameter name under PARAMETER_PATH
+STAGE_PARAMETERS = {
+    'BUCKET_NAME': 'securedrop-public-bucket',
+    'PRODMON_WEBHOOK': 'prodmon-webhook',
+    'PRODMON_SENDER': 'prodmon-sender',
+    'PRODMON_RECIPIENT': 'prodmon-recipient',
+    'PRODMON_REDEPLOY_URL': 'prodmon-redeploy-url',
+    'SECUREDROP_MIRRORS': 'securedrop-mirrors',
+    'TOR_ISOLATION': 'tor-isolation',
+    'TOR_RESTART': 'tor-restart',
+    'TOR_CONTROL': 'tor-control',
+    'SECUREDROP_MIN_VERSION': 'securedrop-min-version',
+    'HEALTHCHECK_SLOW': 'healthcheck-slow',
+    'HEALTHCHECK_METADATA': 'healthcheck-metadata',
+    'HEALTHCHECK_TIMEOUT': 'healthcheck-timeout',
+    'METRICS_LOG_GROUP': 'metrics-log-group',
+    'HISTORY_STORE': 'history-store',
+    'PUBLISH_MODE': 'publish-mode',
+    'TOR_QUORUM': 'tor-quorum',
+    'TOR_PROXIES': 'tor-proxies',
+    'CLUSTER': 'cluster',
+}
+# config key -> parameter name shared by every stage
+SHARED_PARAMETERS = {
+    'SECUREDROP_URL': 'securedrop-url',
+    'SECUREDROP_URL_HUMAN': 'securedrop-url-human',
+}
+OPTIONAL_PARAMETERS = ('SECUREDROP_MIRRORS', 'TOR_ISOLATION', 'TOR_RESTART', 'TOR_CONTROL', 'SECUREDROP_MIN_VERSION',
+                       'HEALTHCHECK_SLOW', 'HEALTHCHECK_METADATA', 'HEALTHCHECK_TIMEOUT', 'METRICS_LOG_GROUP',
+                       'HISTORY_STORE', 'PUBLISH_MODE', 'TOR_QUORUM', 'TOR_PROXIES', 'CLUSTER')
+# GetParameters accepts at most ten names per call
+MAX_NAMES = 10
+
+DEFAULT_CONFIG_CACHE = state_path('config-cache.bin')
+DEFAULT_KEY_FILE = state_path('config-cache.key')
+KEY_VARIABLE = 'SECURE_CONTACT_CONFIG_KEY'
+# SSM is given a couple of seconds before a cached configuration is used instead
+SSM_CLIENT_CONFIG = {'connect_timeout': 2, 'read_timeout': 5, 'retries': {'max_attempts': 2}}
+
+
+class MissingParameters(Exception):
+    def __init__(self, names: List[str]):
+        super().__init__(f'missing parameters: {", ".join(names)}')
+        self.names = names
+
+
+class Snapshot(NamedTuple):
+    values: Dict[str, Optional[str]]
+    fetched_at: float
+
+
+def parameter_names(stage: str) -> Dict[str, str]:
+    path = PARAMETER_PATH.format(stage=stage)
+    names = {key: path + name for key, name in STAGE_PARAMETERS.items()}
+    names.update(SHARED_PARAMETERS)
+    return names
+
+
+def get_parameters_by_path(client, path: str) -> Dict[str, str]:
+    values, kwargs = {}, {}
+    while True:
+        response = client.get_parameters_by_path(Path=path, Recursive=False, WithDecryption=True, **kwargs)
+        values.update((parameter['Name'], parameter['Value']) for parameter in response['Parameters'])
+        if not response.get('NextToken'):
+            return values
+        kwargs['NextToken'] = response['NextToken']
+
+
+def get_parameters(client, names: Iterable[str]) -> Dict[str, str]:
+    names, values = list(names), {}
+    for start in range(0, len(names), MAX_NAMES):
+        response = client.get_parameters(Names=names[start:start + MAX_NAMES], WithDecryption=True)
+        values.update((parameter['Name'], parameter['Value']) for parameter in response['Parameters'])
+    return values
+
+
+def fetch_config(client, stage: str) -> Dict[str, Optional[str]]:
+    # one call for everything under the stage path, one more for the names that live elsewhere
+    names = parameter_names(stage)
+    found = get_parameters_by_path(client, PARAMETER_PATH.format(stage=stage))
+    found.update(get_parameters(client, [name for name in names.values() if name not in found]))
+    return {key: found.get(name) for key, name in names.items()}
+
+
+def check_config(values: Dict[str, Optional[str]], stage: str) -> None:
+    # every missing parameter is reported at once, not just the first
+    names = parameter_names(stage)
+    missing = [names[key] for key, value in values.items() if value is None and key not in OPTIONAL_PARAMETERS]
+    if missing:
+        raise MissingParameters(missing)
+
+
+def load_key(path: str = DEFAULT_KEY_FILE) -> bytes:
+    key = os.environ.get(KEY_VARIABLE)
+    if key:
+        return key.encode()
+    try:
+        with open(path, 'rb') as fobj:
+            return fobj.read().strip()
+    except FileNotFoundError:
+        pass
+    from cryptography.fernet import Fernet
+    key = Fernet.generate_key()
+    # only the user running the monitor can read the key
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'wb') as fobj:
+        fobj.write(key)
+    return key
+
+
+class FernetCipher:
+    # imported on first use, like the other heavy dependencies, with a token that does not
+    # decrypt raised as a ValueError
+    def __init__(self, key: bytes):
+        from cryptography.fernet import Fernet
+        self.fernet = Fernet(key)
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        from cryptography.fernet import InvalidToken
+        try:
+            return self.fernet.decrypt(token)
+        except InvalidToken as err:
+            raise ValueError('the token is invalid or was encrypted with another key') from err
+
+
+def create_cipher(key_path: str = DEFAULT_KEY_FILE) -> Optional[FernetCipher]:
+    if importlib.util.find_spec('cryptography') is None:
+        # without it the configuration is simply fetched from SSM on every run
+        logger.info('cryptography is not installed, the configuration will not be cached')
+        return None
+    try:
+        return FernetCipher(load_key(key_path))
+    except (OSError, ValueError) as err:
+        logger.warning(f'unable to load the configuration cache key {key_path}: {err}')
+        return None
+
+
+class ConfigCache:
+    # The decrypted parameters, encrypted again with a key kept in a separate file (or the
+    # SECURE_CONTACT_CONFIG_KEY environment variable). Without a cipher nothing is read or written.
+    # The key file sits next to the cache, readable by the same user, so it only keeps the values
+    # out of casual reads and copies of the cache; only a key from the environment, provisioned
+    # from somewhere else, encrypts them at rest.
+    def __init__(self, path: str = DEFAULT_CONFIG_CACHE, cipher=None):
+        self.path = path
+        self.cipher = cipher
+
+    def load(self) -> Optional[Snapshot]:
+        if self.cipher is None:
+            return None
+        try:
+            with open(self.path, 'rb') as fobj:
+                data = json.loads(self.cipher.decrypt(fobj.read()))
+            return Snapshot(dict(data['values']), float(data['fetched_at']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logger.warning(f'ignoring unreadable configuration cache {self.path}: {err}')
+            return None
+
+    def save(self, snapshot: Snapshot) -> None:
+        if self.cipher is None:
+            return
+        token = self.cipher.encrypt(json.dumps(snapshot._asdict()).encode())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as fobj:
+                fobj.write(token)
+            os.chmod(fobj.name, 0o600)
+            os.replace(fobj.name, self.path)
+        except OSError as err:
+            logger.warning(f'unable to save configuration cache {self.path}: {err}')
+
+
+class ConfigLoader:
+    # A cached configuration is used as is while younger than ttl. Up to max_stale it is still
+    # used straight away while SSM is queried in the background, and it is the fallback whenever
+    # SSM cannot be reached.
+    def __init__(self, client, stage: str, cache: Optional[ConfigCache] = None, ttl: float = 900,
+                 max_stale: float = 24 * 3600, clock: Callable[[], float] = time.time):
+        self.client = client
+        self.stage = stage
+        self.cache = cache or ConfigCache()
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.clock = clock
+        self.refresher: Optional[threading.Thread] = None
+
+    def refresh(self) -> Snapshot:
+        snapshot = Snapshot(fetch_config(self.client, self.stage), self.clock())
+        # a configuration missing parameters is never cached
+        check_config(snapshot.values, self.stage)
+        self.cache.save(snapshot)
+        return snapshot
+
+    def refresh_in_background(self) -> None:
+        def refresh():
+            try:
+                self.refresh()
+            except (BotoCoreError, ClientError, MissingParameters) as err:
+                logger.warning(f'unable to refresh the configuration: {err}')
+            finally:
+                atexit.unregister(self.wait)
+
+        self.refresher = threading.Thread(target=refresh, name='config-refresh', daemon=True)
+        # registered before the thread starts, so that it is always unregistered after
+        atexit.register(self.wait)
+        self.refresher.start()
+
+    def wait(self, timeout: float = 10) -> None:
+        # gives a refresh still running at exit the chance to save the cache
+        if self.refresher is not None:
+            self.refresher.join(timeout)
+
+    def load(self) -> Dict[str, Optional[str]]:
+        cached = self.cache.load()
+        age = self.clock() - cached.fetched_at if cached else None
+        if cached and age < self.ttl:
+            logger.info(f'using the cached configuration from {age:.0f}s ago')
+            return dict(cached.values)
+        if cached and age < self.max_stale:
+            logger.info(f'using the cached configuration from {age:.0f}s ago while it is refreshed')
+            self.refresh_in_background()
+            return dict(cached.values)
+
+        try:
+            return dict(self.refresh().values)
+        except (BotoCoreError, ClientError) as err:
+            if cached is None:
+                raise
+            logger.warning(f'unable to fetch the configuration, using the cached one from {age:.0f}s ago: {err}')
+            return dict(cached.values)
+
+
+def create_ssm_client(session):
+    from botocore.config import Config
+    return session.client('ssm', config=Config(**SSM_CLIENT_CONFIG))
+
+
+def load_config(session, stage: str, cache_path: str = DEFAULT_CONFIG_CACHE, key_path: str = DEFAULT_KEY_FILE,
+                refresh: bool = False) -> Dict[str, Optional[str]]:
+    # refresh skips the cache, for when the parameters are known to have changed
+    cache = ConfigCache(cache_path, create_cipher(key_path))
+    loader = ConfigLoader(create_ssm_client(session), stage, cache)
+    return dict(loader.refresh().values) if refresh else loader.load()
@@ -0,0 +1,274 @@
+import logging
+import socket
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from src.healthcheck import Signal
+
+
+logger = logging.getLogger('securecontact.control')
+
+# needs ControlPort 9051 and CookieAuthentication 1 in the torrc
+TOR_CONTROL = ('127.0.0.1', 9051)
+# the Debian default, readable by members of the debian-tor group with CookieAuthFileGroupReadable 1
+DEFAULT_COOKIE = '/run/tor/control.authcookie'
+# fetching a descriptor asks up to six HSDirs in turn
+DESCRIPTOR_TIMEOUT = 20
+
+
+class ControlError(Exception):
+    def __init__(self, code: str, message: str):
+        super().__init__(f'{code} {message}')
+        self.code = code
+
+
+class Circuit(NamedTuple):
+    id: str
+    # LAUNCHED, BUILT, EXTENDED, FAILED or CLOSED
+    status: str
+    purpose: str = ''
+
+
+class TorStatus(NamedTuple):
+    # bootstrap progress in percent, 100 once Tor is ready to build circuits
+    bootstrap: int
+    built: int
+    # received, failed: <reason> or None when it was not fetched (or Tor gave no answer in time)
+    descriptor: Optional[str] = None
+
+    @property
+    def broken(self) -> bool:
+        # the local Tor daemon cannot reach the network, whatever state the onion is in
+        return self.bootstrap < 100 or self.built == 0
+
+    def signals(self) -> Tuple[Signal, ...]:
+        detail = f'bootstrapped {self.bootstrap}%, {self.built} circuits built'
+        signals = [Signal('tor', 'failed' if self.broken else 'ok', detail)]
+        if self.descriptor is None:
+            signals.append(Signal('descriptor', 'skipped'))
+        elif self.descriptor == 'received':
+            signals.append(Signal('descriptor', 'ok'))
+        else:
+            signals.append(Signal('descriptor', 'failed', self.descriptor))
+        return tuple(signals)
+
+
+def onion_service_id(target: str) -> str:
+    # HSFETCH and the HS_DESC events name the service without the .onion suffix or a scheme
+    host = target.split('://')[-1].split('/')[0]
+    return host[:-len('.onion')] if host.endswith('.onion') else host
+
+
+class TorController:
+    # A minimal client for the Tor control protocol (control-spec.txt), enough to ask Tor
+    # for new circuits, report on its own health and fetch an onion service descriptor.
+    # Connections are opened per use, as the monitor only needs one when a check fails.
+    def __init__(self, address: Tuple[str, int] = TOR_CONTROL, cookie_path: str = DEFAULT_COOKIE,
+                 timeout: float = 10):
+        self.address = address
+        self.cookie_path = cookie_path
+        self.timeout = timeout
+        self.events: List[str] = []
+        self._sock: Optional[socket.socket] = None
+        self._buffer = b''
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self) -> None:
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._buffer = b''
+        try:
+            try:
+                with open(self.cookie_path, 'rb') as fobj:
+                    self.command(f'AUTHENTICATE {fobj.read().hex()}')
+            except FileNotFoundError:
+                # a control port without authentication, as used in development
+                self.command('AUTHENTICATE')
+        except BaseException:
+            # __exit__ is never called when __enter__ fails, so the socket is closed here
+            self._sock.close()
+            self._sock = None
+            raise
+
+    def close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.sendall(b'QUIT\r\n')
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+
+    def _readline(self) -> str:
+        while b'\r\n' not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise ConnectionError('the control connection was closed')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\r\n', 1)
+        return line.decode(errors='replace')
+
+    def _read_reply(self) -> Tuple[str, List[str]]:
+        # returns the status code and lines of the next reply, with data blocks joined into their line
+        lines = []
+        while True:
+            line = self._readline()
+            code, separator, text = line[:3], line[3:4], line[4:]
+            if separator == '+':
+                data = []
+                while True:
+                    data_line = self._readline()
+                    if data_line == '.':
+                        break
+                    data.append(data_line[1:] if data_line.startswith('..') else data_line)
+                text += '\n'.join(data)
+            lines.append(text)
+            if separator == ' ':
+                return code, lines
+
+    def read_event(self) -> str:
+        while True:
+            code, lines = self._read_reply()
+            if code == '650':
+                return lines[0]
+
+    def command(self, line: str) -> List[str]:
+        self._sock.sendall(line.encode() + b'\r\n')
+        while True:
+            code, lines = self._read_reply()
+            if code == '650':
+                # asynchronous events can arrive ahead of the reply
+                self.events.append(lines[0])
+                continue
+            if code != '250':
+                raise ControlError(code, lines[-1])
+            return lines
+
+    def getinfo(self, *keys: str) -> Dict[str, str]:
+        values = {}
+        for line in self.command('GETINFO ' + ' '.join(keys)):
+            key, separator, value = line.partition('=')
+            if separator:
+                values[key] = value.lstrip('\n')
+        return values
+
+    def newnym(self) -> None:
+        # new streams go on new circuits; Tor rate limits this to once every ten seconds
+        self.command('SIGNAL NEWNYM')
+
+    def bootstrap(self) -> int:
+        # e.g. NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"
+        phase = self.getinfo('status/bootstrap-phase')['status/bootstrap-phase']
+        for field in phase.split():
+            if field.startswith('PROGRESS='):
+                return int(field[len('PROGRESS='):])
+        return 0
+
+    def circuits(self) -> List[Circuit]:
+        circuits = []
+        for line in self.getinfo('circuit-status')['circuit-status'].splitlines():
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            purpose = next((field[len('PURPOSE='):] for field in fields if field.startswith('PURPOSE=')), '')
+            circuits.append(Circuit(fields[0], fields[1], purpose))
+        return circuits
+
+    def fetch_descriptor(self, target: str, timeout: float = DESCRIPTOR_TIMEOUT) -> Optional[str]:
+        # HSFETCH only starts the fetch, the answer comes as HS_DESC events
+        service_id = onion_service_id(target)
+        self.command('SETEVENTS HS_DESC')
+        requested = failed = 0
+        reason = 'failed'
+        deadline = time.monotonic() + timeout
+        try:
+            self.command(f'HSFETCH {service_id}')
+            pending = self.events
+            self.events = []
+            while True:
+                if pending:
+                    event = pending.pop(0)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._sock.settimeout(remaining)
+                    event = self.read_event()
+                fields = event.split()
+                if len(fields) < 3 or fields[0] != 'HS_DESC' or fields[2] != service_id:
+                    continue
+                if fields[1] == 'RECEIVED':
+                    return 'received'
+                if fields[1] == 'REQUESTED':
+                    requested += 1
+                elif fields[1] == 'FAILED':
+                    failed += 1
+                    reason = next((field[len('REASON='):].lower() for field in fields
+                                   if field.startswith('REASON=')), reason)
+                    # another HSDir may still have it until every one asked has failed
+                    if failed >= requested:
+                        return f'failed: {reason}'
+        except socket.timeout:
+            return None
+        finally:
+            self._sock.settimeout(self.timeout)
+            self.command('SETEVENTS')
+
+    def status(self, target: Optional[str] = None) -> TorStatus:
+        built = sum(circuit.status == 'BUILT' for circuit in self.circuits())
+        bootstrap = self.bootstrap()
+        descriptor = None
+        # a descriptor cannot be fetched without circuits, so its absence would say nothing about the onion
+        if target and bootstrap == 100 and built:
+            descriptor = self.fetch_descriptor(target)
+        return TorStatus(bootstrap, built, descriptor)
+
+
+def diagnose(controller: Optional[TorController], target: str) -> Tuple[Signal, ...]:
+    # signals for healthcheck.evaluate that tell a broken local Tor apart from a missing onion
+    if controller is None:
+        return ()
+    try:
+        with controller:
+            status = controller.status(target)
+    except (OSError, ControlError) as err:
+        logger.warning(f'unable to query the tor control port: {err}')
+        return Signal('tor', 'skipped', 'control port unavailable'),
+    logger.info(f'tor status: {status}')
+    return status.signals()
+
+
+def recover(controller: Optional[TorController], restart: Optional[Callable[[], None]]) -> bool:
+    # Asks Tor for new circuits, which takes seconds, and only restarts the daemon when Tor
+    # reports that it is not bootstrapped or has no circuits. Returns True if it restarted Tor.
+    if controller is not None:
+        try:
+            with controller:
+                controller.newnym()
+                status = controller.status()
+            if not status.broken:
+                logger.info(f'Healthcheck: requested new tor circuits ({status.built} built)')
+                return False
+            logger.warning(f'tor is broken, bootstrapped {status.bootstrap}% with {status.built} circuits built')
+        except (OSError, ControlError) as err:
+            logger.warning(f'unable to use the tor control port: {err}')
+    if restart is None:
+        return False
+    restart()
+    return True
+
+
+def controller_from_config(config: Dict[str, str]) -> Optional[TorController]:
+    # the optional tor-control parameter: host:port, or never to only ever restart Tor
+    setting = config.get('TOR_CONTROL')
+    if setting == 'never':
+        return None
+    if not setting:
+        return TorController()
+    host, _, port = setting.rpartition(':')
+    return TorController((host or TOR_CONTROL[0], int(port)))
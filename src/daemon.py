@@ -0,0 +1,193 @@
+import logging
+import signal
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from src.cache import CachedHistory
+from src.cluster import Cluster
+from src.config import MissingParameters
+from src.history import STORE_ERRORS, HistoryStore, ResultSink
+from src.metrics import MetricsRecorder
+from src.monitor import (check_once, create_config, create_dispatcher, create_history, create_history_store,
+                         create_cluster, create_metrics, create_probe_client, publish_pages, restart_tor)
+from src.notifications import NotificationDispatcher
+from src.probe import TorClient
+from src.tracing import span, traced
+
+
+logger = logging.getLogger('securecontact.daemon')
+
+# the shortest interval the command line accepts
+MIN_INTERVAL = 5
+
+
+class Ticker:
+    # Schedules ticks at start + n * interval, so the time a check takes does not push the
+    # following ones back. Ticks missed while a check overran are skipped, not run back to back.
+    def __init__(self, interval: float, start: float):
+        self.interval = interval
+        self.next = start
+
+    def advance(self, now: float) -> float:
+        # returns how long to wait for the next tick
+        self.next += self.interval
+        if self.next <= now:
+            missed = int((now - self.next) // self.interval) + 1
+            logger.warning(f'check overran, skipping {missed} scheduled checks')
+            self.next += missed * self.interval
+        return self.next - now
+
+
+class Daemon:
+    # Keeps the session, clients, configuration and Tor connections warm between checks.
+    # SIGHUP reloads the configuration before the next check, SIGTERM and SIGINT stop the
+    # daemon once the current check is done.
+    def __init__(self, session, stage: str, interval: float = 30, restart_cooldown: float = 600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.session = session
+        self.stage = stage
+        self.interval = interval
+        self.restart_cooldown = restart_cooldown
+        self.clock = clock
+        self.stopping = threading.Event()
+        # set to interrupt a wait, by a signal or stop()
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.last_restart: Optional[float] = None
+        self.config: Dict[str, str] = {}
+        self.client: Optional[TorClient] = None
+        self.notifier: Optional[NotificationDispatcher] = None
+        self.store: Optional[HistoryStore] = None
+        self.sink: Optional[ResultSink] = None
+        self.history: Optional[CachedHistory] = None
+        self.metrics: Optional[MetricsRecorder] = None
+        self.cluster: Optional[Cluster] = None
+
+    def install_signal_handlers(self) -> None:
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        signal.signal(signal.SIGHUP, lambda *_: self.request_reload())
+
+    def stop(self) -> None:
+        logger.info('stopping after the current check')
+        self.stopping.set()
+        self.wakeup.set()
+
+    def request_reload(self) -> None:
+        logger.info('reloading the configuration before the next check')
+        self.reload_requested = True
+        self.wakeup.set()
+
+    @traced('load')
+    def load(self, refresh: bool = False) -> None:
+        config = create_config(self.session, self.stage, refresh=refresh)
+        config['CHECK_INTERVAL'] = str(self.interval)
+        # checks are spread out in time, so results are written in batches every few minutes
+        if self.sink is None:
+            self.store = create_history_store(self.session, config)
+            self.sink = ResultSink(self.store)
+            self.history = create_history(self.store, config)
+            # the rolling windows are kept in memory, and saved so they survive a restart
+            self.metrics = create_metrics(self.session, config)
+            self.cluster = create_cluster(self.session, config)
+
+        from securedrop import build_pages
+        with span('build_pages') as current:
+            built = build_pages(config['SECUREDROP_URL'], config['SECUREDROP_URL_HUMAN'], self.stage)
+            current.set(changed=bool(built))
+        if built:
+            publish_pages(self.session, config)
+
+        # the probe client and notification channels depend on the configuration
+        if self.client is None or any(config.get(key) != self.config.get(key)
+                                      for key in ('TOR_ISOLATION', 'TOR_QUORUM', 'TOR_PROXIES')):
+            if self.client is not None:
+                self.client.close()
+            self.client = create_probe_client(config)
+        if self.notifier is not None:
+            self.notifier.close()
+        self.notifier = create_dispatcher(self.session, config)
+        self.config = config
+
+    def reload(self) -> None:
+        self.reload_requested = False
+        try:
+            self.load(refresh=True)
+        except (BotoCoreError, ClientError, MissingParameters) as err:
+            logger.error(f'unable to reload the configuration, keeping the current one: {err}')
+
+    def restart_tor(self) -> None:
+        self.last_restart = self.clock()
+        restart_tor()
+
+    def can_restart_tor(self) -> bool:
+        # a restart takes a while to settle, and every check would otherwise be allowed one
+        return self.last_restart is None or self.clock() - self.last_restart >= self.restart_cooldown
+
+    def check(self) -> None:
+        restart = self.restart_tor if self.can_restart_tor() else None
+        # every check is a trace of its own, as every cron run is
+        with span('cycle', stage=self.stage) as cycle:
+            try:
+                check_once(self.session, self.config, self.client, self.notifier, self.sink, self.history, restart,
+                           self.metrics, cluster=self.cluster)
+            except STORE_ERRORS + (OSError,) as err:
+                # the daemon keeps going, the next check will try again
+                logger.error(f'check failed: {err}')
+                cycle.fail(f'{type(err).__name__}: {err}')
+            self.sink.flush_if_due()
+
+    def wait(self, seconds: float) -> bool:
+        # returns False once the daemon is stopping; a reload does not move the next check
+        deadline = self.clock() + seconds
+        while not self.stopping.is_set():
+            if self.reload_requested:
+                self.reload()
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return True
+            self.wakeup.wait(remaining)
+            self.wakeup.clear()
+        return False
+
+    def close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+        if self.notifier is not None:
+            self.notifier.close()
+        if self.sink is not None:
+            self.sink.close()
+        if self.history is not None:
+            # pending results go to the history store before the daemon exits
+            self.history.reconcile()
+        if self.store is not None:
+            self.store.close()
+        if self.cluster is not None:
+            # another node takes over without waiting for the lease to expire
+            try:
+                self.cluster.release()
+            except STORE_ERRORS as err:
+                logger.error(f'unable to release the leader lease: {err}')
+
+    def run(self) -> int:
+        self.install_signal_handlers()
+        logger.info(f'starting the monitor daemon for stage={self.stage}, checking every {self.interval}s')
+        try:
+            self.load()
+        except MissingParameters as err:
+            logger.error(f'Unable to run the monitor: {err}')
+            return 1
+
+        ticker = Ticker(self.interval, self.clock())
+        try:
+            while not self.stopping.is_set():
+                self.check()
+                if not self.wait(ticker.advance(self.clock())):
+                    break
+        finally:
+            self.close()
+        logger.info('monitor daemon stopped')
+        return 0
@@ -1,63 +1,113 @@
 import decimal
-import json
 import numbers
 import time
-from collections.abc import Iterable, Mapping, ByteString, Set
-from typing import Dict, List
+from collections.abc import Iterable, Mapping, Set
+from typing import Callable, Dict, List
 
-from boto3.dynamodb.conditions import Attr
-
-
-# Helper class to convert a DynamoDB item to JSON.
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            return str(o)
-        return super(DecimalEncoder, self).default(o)
+# Every check result shares a partition key in the HistoryByTime index, which sorts them by
+# CheckTime so the latest results can be read with a single Query instead of a table scan.
+# If you update this then be sure to also update the CloudFormation definition.
+HISTORY_INDEX = 'HistoryByTime'
+HISTORY_KEY = 'securedrop'
+# individual attempts are kept in their own partition so they never hide the latest verdict
+ATTEMPT_HISTORY_KEY = 'securedrop#attempts'
+# and so are the results for the mirrors, whichever node of a cluster probed them
+MIRROR_HISTORY_KEY = 'securedrop#mirrors'
+PRIMARY_KEY = ['CheckTime', 'Outcome']
 
 
 # For types that involve numbers, it is recommended that Decimal
 # objects are used to be able to round-trip the Python type...
-# We are using a lightweight serializer from author of Bloop:
+# The serializer is based on one from the author of Bloop:
 # https://github.com/boto/boto3/issues/369#issuecomment-330136042
-def dump_to_dynamodb(item):
-    context = decimal.Context(
-        Emin=-128, Emax=126, rounding=None, prec=38,
-        traps=[decimal.Clamped, decimal.Overflow, decimal.Underflow]
-    )
+# ignore inexact, rounding errors
+DYNAMODB_CONTEXT = decimal.Context(
+    Emin=-128, Emax=126, rounding=None, prec=38,
+    traps=[decimal.Clamped, decimal.Overflow, decimal.Underflow]
+)
 
-    # don't catch str/bytes with Iterable check below;
-    # don't catch bool with numbers.Number
-    if isinstance(item, (str, ByteString, bool)):
-        return item
 
-    # ignore inexact, rounding errors
-    if isinstance(item, numbers.Number):
-        return context.create_decimal(item)
+def _unchanged(item):
+    return item
 
-    elif isinstance(item, Dict):
-        for key, value in item.items():
-            item[key] = dump_to_dynamodb(value)
-        return item
 
-    # mappings are also Iterable
-    elif isinstance(item, Mapping):
-        return {
-            key: dump_to_dynamodb(value)
-            for key, value in item.values()
-        }
+def _dump_number(item):
+    return DYNAMODB_CONTEXT.create_decimal(item)
+
+
+def _dump_mapping(item):
+    return {key: dump_to_dynamodb(value) for key, value in item.items()}
+
+
+def _dump_set(item):
+    return set(map(dump_to_dynamodb, item))
 
+
+def _dump_iterable(item):
+    return list(map(dump_to_dynamodb, item))
+
+
+def _dump_for(cls: type) -> Callable:
+    # don't catch str/bytes with the Iterable check below;
+    # don't catch bool with numbers.Number
+    if issubclass(cls, (str, bytes, bytearray, memoryview, bool)):
+        return _unchanged
+    if issubclass(cls, numbers.Number):
+        return _dump_number
+    # mappings are also Iterable
+    if issubclass(cls, Mapping):
+        return _dump_mapping
     # dynamodb.TypeSerializer checks isinstance(o, Set)
     # so we cannot handle this as a list
-    elif isinstance(item, Set):
-        return set(map(dump_to_dynamodb, item))
-
+    if issubclass(cls, Set):
+        return _dump_set
     # may not be a literal instance of List
-    elif isinstance(item, Iterable):
-        return list(map(dump_to_dynamodb, item))
-
+    if issubclass(cls, Iterable):
+        return _dump_iterable
     # datetime, custom object, None
-    return item
+    return _unchanged
+
+
+def _load_number(item: decimal.Decimal):
+    return int(item) if item == item.to_integral_value() else float(item)
+
+
+def _load_mapping(item):
+    return {key: load_from_dynamodb(value) for key, value in item.items()}
+
+
+def _load_set(item):
+    return set(map(load_from_dynamodb, item))
+
+
+def _load_list(item):
+    return list(map(load_from_dynamodb, item))
+
+
+# the isinstance checks only run the first time a type is seen
+_DUMPERS: Dict[type, Callable] = {}
+_LOADERS: Dict[type, Callable] = {
+    decimal.Decimal: _load_number,
+    dict: _load_mapping,
+    list: _load_list,
+    set: _load_set,
+}
+
+
+# Returns a copy of item with numbers converted to Decimal, the input is left untouched
+def dump_to_dynamodb(item):
+    cls = type(item)
+    try:
+        dump = _DUMPERS[cls]
+    except KeyError:
+        dump = _DUMPERS[cls] = _dump_for(cls)
+    return dump(item)
+
+
+# The inverse of dump_to_dynamodb for items read back through boto3, which
+# returns every number as a Decimal
+def load_from_dynamodb(item):
+    return _LOADERS.get(type(item), _unchanged)(item)
 
 
 def write_to_database(dynamodb, table_name: str, item: Dict[str, str]):
@@ -67,14 +117,38 @@ def write_to_database(dynamodb, table_name: str, item: Dict[str, str]):
     monitor_table.put_item(Item=dump_to_dynamodb(item))
 
 
+def write_batch(dynamodb, table_name: str, items: List[Dict]):
+    # the batch writer sends up to 25 items per request and resubmits any UnprocessedItems
+    monitor_table = dynamodb.Table(table_name)
+    with monitor_table.batch_writer(overwrite_by_pkeys=PRIMARY_KEY) as batch:
+        for item in items:
+            batch.put_item(Item=dump_to_dynamodb(item))
+
+
+def read_latest_outcomes(dynamodb, table_name: str, limit: int = 10,
+                         history_key: str = HISTORY_KEY) -> List[Dict[str, str]]:
+    # newest first; boto3 is already loaded by whoever created the resource
+    from boto3.dynamodb.conditions import Key
+    table = dynamodb.Table(table_name)
+    response = table.query(
+        IndexName=HISTORY_INDEX,
+        KeyConditionExpression=Key('HistoryKey').eq(history_key),
+        ScanIndexForward=False,
+        Limit=limit
+    )
+    return load_from_dynamodb(response['Items'])
+
+
 def read_from_database(dynamodb, table_name: str) -> List[Dict[str, str]]:
+    from boto3.dynamodb.conditions import Key
     table = dynamodb.Table(table_name)
     current_time = int(time.time())
     cutoff_time = current_time - 6000
-    filter_expression = Attr('CheckTime').between(cutoff_time, current_time)
+    key_condition = Key('HistoryKey').eq(HISTORY_KEY) & Key('CheckTime').between(cutoff_time, current_time)
 
-    response = table.scan(
-        FilterExpression=filter_expression,
-        Limit=10
+    response = table.query(
+        IndexName=HISTORY_INDEX,
+        KeyConditionExpression=key_condition,
+        ScanIndexForward=False
     )
-    return response['Items']
+    return load_from_dynamodb(response['Items'])
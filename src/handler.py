@@ -0,0 +1,116 @@
+import logging
+import math
+import os
+import time
+from typing import Dict, Optional
+
+from src.daemon import Daemon
+from src.healthcheck import policy_from_config
+from src.monitor import (attempt_check, create_scheduler, create_session, get_targets, record_mirrors,
+                         report_outcome)
+from src.scheduler import Clock, RetryState
+from src.tracing import span
+
+
+logger = logging.getLogger('securecontact.handler')
+
+# The Lambda entry point, src.handler.handler. A Step Functions state machine invokes it once
+# per attempt, see cloudformation/secure-contact-lambda.yaml: when an attempt fails and the
+# retry budget allows another, the handler returns the retry state and how long to wait, and the
+# state machine waits and invokes it again, rather than the Lambda being billed for sleeping.
+#
+# The session, clients, configuration and rendered pages are set up once per container, during
+# the init phase, and reused by every warm invocation.
+
+# the only writable directory in Lambda, the build and the state files are relative to it
+WORKING_DIRECTORY = '/tmp/secure-contact'
+# how long a warm container keeps its configuration before fetching it again
+CONFIG_TTL = 900
+
+
+class WallClock(Clock):
+    # the attempts of one check may run in different containers
+    def now(self) -> float:
+        return time.time()
+
+
+class LambdaMonitor(Daemon):
+    # The daemon, without its loop: the state machine schedules the checks and the waits between
+    # attempts. There is no local Tor, so the probes go through the proxies in tor-proxies and
+    # Tor is never restarted from here.
+    def __init__(self, session, stage: str, interval: float = 1800, clock=time.monotonic):
+        super().__init__(session, stage, interval, clock=clock)
+        self.loaded_at: Optional[float] = None
+        # the invocations this container has handled, the first of them is the cold one
+        self.invocations = 0
+
+    def load(self, refresh: bool = False) -> None:
+        super().load(refresh)
+        self.loaded_at = self.clock()
+
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or self.clock() - self.loaded_at >= CONFIG_TTL
+
+    def step(self, event: Dict) -> Dict:
+        self.invocations += 1
+        retry = event.get('retry')
+        state = RetryState(**retry) if retry else RetryState(WallClock().now())
+        targets = get_targets(self.config)
+        policy = policy_from_config(self.config)
+        scheduler = create_scheduler(self.config, allow_restart=False, clock=WallClock())
+        results = []
+
+        def check():
+            nonlocal results
+            results = attempt_check(self.client, targets, policy, None, self.sink, state.attempts + 1)
+            return results[0].healthy, results[0].failure
+
+        try:
+            state, outcome, delay = scheduler.attempt(state, check)
+            if outcome is None:
+                logger.info(f'Healthcheck: attempt {state.attempts} failed, checking again in {delay:.0f}s')
+                # the wait state only takes whole seconds
+                return {'done': False, 'wait': math.ceil(delay), 'retry': state._asdict()}
+            mirrors = record_mirrors(results[1:], self.sink, self.metrics)
+            report_outcome(self.session, self.config, self.history, self.notifier, outcome, results[0], self.metrics,
+                           mirrors=mirrors)
+            if self.history.cache.pending:
+                # a frozen container may never be thawed, so the results cannot wait for it
+                self.history.reconcile()
+            return {'done': True, 'healthy': outcome.healthy, 'attempts': outcome.attempts,
+                    'confirmed': outcome.confirmed}
+        finally:
+            # likewise the buffered attempts and the notifications still queued on the worker thread
+            self.sink.flush()
+            self.notifier.close()
+
+
+MONITOR: Optional[LambdaMonitor] = None
+
+
+def create_monitor() -> LambdaMonitor:
+    monitor = LambdaMonitor(create_session(region=os.environ.get('AWS_REGION', 'eu-west-1')),
+                            os.environ.get('STAGE', 'PROD'), 60 * float(os.environ.get('CHECK_MINUTES', 30)))
+    monitor.load()
+    return monitor
+
+
+def handler(event: Optional[Dict], context=None) -> Dict:
+    global MONITOR
+    with span('cycle', stage=os.environ.get('STAGE', 'PROD')) as cycle:
+        if MONITOR is None:
+            MONITOR = create_monitor()
+        elif MONITOR.is_stale():
+            # keeps the current configuration when Parameter Store cannot be reached
+            MONITOR.reload()
+        response = MONITOR.step(event or {})
+        cycle.set(invocation=MONITOR.invocations, done=response['done'])
+        return response
+
+
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    os.makedirs(WORKING_DIRECTORY, exist_ok=True)
+    os.chdir(WORKING_DIRECTORY)
+    # the init phase, before the first invocation
+    with span('init'):
+        MONITOR = create_monitor()
@@ -0,0 +1,232 @@
+import datetime
+import json
+import logging
+import re
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+from src.probe import ProbeResponse
+from src.scheduler import CONFIRMED_FAILURES, LOCAL_FAILURES
+
+
+logger = logging.getLogger('securecontact.healthcheck')
+
+EXPECTED_TEXT = 'The Guardian | SecureDrop'
+# the marker sits in the <title>, so the page is judged on its first few kilobytes
+MAX_BODY_BYTES = 64 * 1024
+MAX_METADATA_BYTES = 16 * 1024
+METADATA_PATH = '/metadata'
+
+# a failed signal makes the site down, anything else only degraded
+CRITICAL_SIGNALS = ('reachable', 'status', 'content')
+# vantage points that fail like this say nothing about the site
+ABSTAINING_FAILURES = LOCAL_FAILURES + ('cancelled',)
+
+
+class Signal(NamedTuple):
+    name: str
+    # ok, failed or skipped
+    status: str
+    detail: str = ''
+
+
+class HealthcheckPolicy(NamedTuple):
+    marker: str = EXPECTED_TEXT
+    max_bytes: int = MAX_BODY_BYTES
+    # responses slower than this are degraded; connecting through Tor takes a few seconds on its own
+    slow: float = 10.0
+    check_metadata: bool = True
+    # the oldest SecureDrop release that is not degraded, e.g. 2.6.0
+    min_version: Optional[str] = None
+    certificate_days: int = 14
+    # how long a single probe may take before it counts as a timeout
+    timeout: float = 15.0
+
+
+class CheckResult(NamedTuple):
+    target: str
+    # up, degraded or down
+    status: str
+    signals: Tuple[Signal, ...] = ()
+    elapsed: float = 0.0
+    # the probe error kind, if the site could not be reached
+    error: Optional[str] = None
+    # the share of the vantage points that agree with the status, with a quorum
+    confidence: float = 1.0
+
+    @property
+    def healthy(self) -> bool:
+        # a degraded site is still up as far as the status page is concerned
+        return self.status != 'down'
+
+    @property
+    def failure(self) -> Optional[str]:
+        # the failure kind the retry scheduler works with; tor is the local daemon, descriptor
+        # an onion service that is not published
+        if self.healthy:
+            return None
+        problems = self.problems
+        if 'tor' in problems:
+            return 'tor'
+        if 'descriptor' in problems:
+            return 'descriptor'
+        return self.error or 'http'
+
+    @property
+    def problems(self) -> Tuple[str, ...]:
+        return tuple(signal.name for signal in self.signals if signal.status == 'failed')
+
+    def __bool__(self) -> bool:
+        return self.healthy
+
+
+def policy_from_config(config: Dict[str, str]) -> HealthcheckPolicy:
+    policy = HealthcheckPolicy()
+    return policy._replace(
+        slow=float(config.get('HEALTHCHECK_SLOW') or policy.slow),
+        check_metadata=config.get('HEALTHCHECK_METADATA') != 'never',
+        min_version=config.get('SECUREDROP_MIN_VERSION') or None,
+        timeout=float(config.get('HEALTHCHECK_TIMEOUT') or policy.timeout)
+    )
+
+
+def metadata_url(target: str) -> str:
+    return target.rstrip('/') + METADATA_PATH
+
+
+def parse_version(version: str) -> Tuple[int, ...]:
+    # release candidates such as 2.6.0~rc1 compare as their release
+    return tuple(int(part) for part in re.findall(r'\d+', version.split('~')[0])[:3])
+
+
+def check_response(response: Optional[ProbeResponse], policy: HealthcheckPolicy) -> Tuple[Signal, ...]:
+    if response is None or response.error is not None:
+        return Signal('reachable', 'failed', response.error if response else 'no response'),
+    signals = [Signal('reachable', 'ok')]
+    if response.status_code != 200:
+        return tuple(signals + [Signal('status', 'failed', str(response.status_code))])
+    signals.append(Signal('status', 'ok'))
+
+    if policy.marker not in response.text:
+        detail = f'marker not in the first {len(response.text)} characters' if response.truncated else 'marker not found'
+        return tuple(signals + [Signal('content', 'failed', detail)])
+    signals.append(Signal('content', 'ok'))
+
+    if response.elapsed > policy.slow:
+        signals.append(Signal('latency', 'failed', f'{response.elapsed:.1f}s'))
+    else:
+        signals.append(Signal('latency', 'ok', f'{response.elapsed:.1f}s'))
+    return tuple(signals)
+
+
+def check_metadata(response: Optional[ProbeResponse], target: str, policy: HealthcheckPolicy) -> Signal:
+    if response is None:
+        return Signal('metadata', 'skipped')
+    if response.error is not None or response.status_code != 200 or response.truncated:
+        return Signal('metadata', 'failed', response.error or f'status code {response.status_code}')
+    try:
+        metadata = json.loads(response.text)
+        version = str(metadata['sd_version'])
+    except (ValueError, KeyError, TypeError) as err:
+        return Signal('metadata', 'failed', f'unreadable metadata: {err}')
+
+    # the metadata lists the address the instance believes it is served at
+    served_at = metadata.get('v3_source_url')
+    host = target.split('://')[-1].split('/')[0]
+    if served_at and host not in served_at:
+        return Signal('metadata', 'failed', f'instance reports {served_at}')
+    if policy.min_version and parse_version(version) < parse_version(policy.min_version):
+        return Signal('metadata', 'failed', f'version {version} is older than {policy.min_version}')
+    return Signal('metadata', 'ok', version)
+
+
+def certificate_expiry(certificate: bytes) -> Optional[datetime.datetime]:
+    # imported here as only https targets have a certificate, and it is optional
+    try:
+        from cryptography import x509
+    except ImportError:
+        return None
+    parsed = x509.load_der_x509_certificate(certificate)
+    # not_valid_after_utc replaced the naive not_valid_after in cryptography 42
+    expiry = getattr(parsed, 'not_valid_after_utc', None)
+    return expiry or parsed.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+
+def check_certificate(response: Optional[ProbeResponse], policy: HealthcheckPolicy,
+                      now: Optional[datetime.datetime] = None) -> Signal:
+    if response is None or not response.certificate:
+        return Signal('certificate', 'skipped')
+    try:
+        expiry = certificate_expiry(response.certificate)
+    except ValueError as err:
+        return Signal('certificate', 'failed', f'unreadable certificate: {err}')
+    if expiry is None:
+        return Signal('certificate', 'skipped', 'cryptography is not installed')
+    days = (expiry - (now or datetime.datetime.now(datetime.timezone.utc))).days
+    status = 'failed' if days < policy.certificate_days else 'ok'
+    return Signal('certificate', status, f'expires in {days} days')
+
+
+def evaluate(response: Optional[ProbeResponse], policy: HealthcheckPolicy = HealthcheckPolicy(),
+             metadata: Optional[ProbeResponse] = None, extra: Tuple[Signal, ...] = ()) -> CheckResult:
+    # extra takes signals gathered elsewhere, such as the state of the onion descriptor, which
+    # are kept even when the site is down as they explain why
+    # a ProbeResponse with an error is falsy, so these compare with None
+    target = response.target if response is not None else ''
+    signals = check_response(response, policy)
+    down = any(signal.status == 'failed' and signal.name in CRITICAL_SIGNALS for signal in signals)
+    if not down:
+        signals += (check_metadata(metadata, target, policy), check_certificate(response, policy))
+    signals += tuple(extra)
+
+    failed = [signal for signal in signals if signal.status == 'failed']
+    status = 'down' if down else 'degraded' if failed else 'up'
+    if status == 'degraded':
+        logger.warning(f'{target}: degraded, ' + ', '.join(f'{signal.name}: {signal.detail}' for signal in failed))
+    return CheckResult(target, status, signals, response.elapsed if response is not None else 0.0,
+                       response.error if response is not None else None)
+
+
+def agreed_failure(results: Sequence[CheckResult], quorum: int) -> Optional[str]:
+    # a failure the scheduler takes as confirmed, such as the wrong page, that quorum results saw
+    failures = [result.failure for result in results if result.failure in CONFIRMED_FAILURES]
+    return next((failure for failure in CONFIRMED_FAILURES if failures.count(failure) >= quorum), None)
+
+
+def quorum_reached(results: Sequence[CheckResult], quorum: int) -> bool:
+    # whether results, of the vantage points that have answered so far, already decide
+    return sum(result.healthy for result in results) >= quorum or agreed_failure(results, quorum) is not None
+
+
+def combine(results: Sequence[CheckResult], quorum: int) -> CheckResult:
+    # Decides on one result per vantage point. A vantage point whose own Tor failed, or that
+    # was not waited for, abstains. The site is up or down once quorum vantage points agree,
+    # and the result is that of the first of them. Down is only a confirmed failure when quorum
+    # of them saw the same one, otherwise it is retried, and without a quorum the check is
+    # inconclusive.
+    voters = [result for result in results if result.failure not in ABSTAINING_FAILURES]
+    up = [result for result in voters if result.healthy]
+    down = [result for result in voters if not result.healthy]
+    counts = f'{len(up)} up, {len(down)} down, {len(results) - len(voters)} abstained'
+
+    if len(up) >= quorum:
+        result = up[0]
+        signal = Signal('quorum', 'ok', counts)
+        confidence = len(up) / len(voters)
+    elif len(down) >= quorum:
+        agreed = agreed_failure(down, quorum)
+        # e.g. timeouts, or the wrong page from too few of them to be sure
+        result = next((result for result in down if result.failure == agreed or
+                       agreed is None and result.failure not in CONFIRMED_FAILURES), None)
+        if result is None:
+            result = down[0]._replace(error='inconclusive')
+        signal = Signal('quorum', 'failed', counts)
+        confidence = len(down) / len(voters)
+    else:
+        result = next(result for result in results if not result.healthy)
+        # a retry decides, unless no vantage point could reach Tor at all
+        if voters:
+            result = result._replace(status='down', error='inconclusive')
+        signal = Signal('quorum', 'failed', f'no quorum of {quorum}: {counts}')
+        confidence = 0.0
+    logger.info(f'{result.target}: {result.status} by quorum, {counts}')
+    return result._replace(signals=result.signals + (signal,), confidence=round(confidence, 3))
@@ -0,0 +1,238 @@
+import atexit
+import json
+import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from src.dynamo import HISTORY_INDEX, HISTORY_KEY, load_from_dynamodb, read_latest_outcomes, write_batch
+from src.state import state_path
+from src.tracing import span
+
+
+logger = logging.getLogger('securecontact.history')
+
+DEFAULT_HISTORY_PATH = state_path('history.sqlite3')
+# what any of the stores raise when they cannot be read or written
+STORE_ERRORS = (BotoCoreError, ClientError, sqlite3.Error)
+
+
+class HistorySummary(NamedTuple):
+    checks: int
+    healthy: int
+    # mean and worst latency in seconds of the checks that got a response, None without any
+    latency: Optional[float]
+    max_latency: Optional[float]
+
+    @property
+    def availability(self) -> Optional[float]:
+        return 100 * self.healthy / self.checks if self.checks else None
+
+
+def is_healthy(item: Dict) -> bool:
+    # verdicts are 'True' or 'False', attempts 'True#1' and so on
+    return str(item['Outcome']).split('#')[0] == 'True'
+
+
+class HistoryStore(ABC):
+    # Where check results are kept. Items are dicts as built by monitor.create_item, unique on
+    # CheckTime and Outcome and grouped by HistoryKey; a later item with the same key replaces
+    # the earlier one. Reads return the newest first.
+    name = ''
+
+    @abstractmethod
+    def write(self, items: List[Dict]) -> None:
+        pass
+
+    @abstractmethod
+    def latest(self, limit: int = 10, history_key: str = HISTORY_KEY) -> List[Dict]:
+        pass
+
+    @abstractmethod
+    def between(self, start: int, end: int, history_key: str = HISTORY_KEY) -> List[Dict]:
+        # CheckTime from start to end, both included
+        pass
+
+    def summary(self, start: int, end: int, history_key: str = HISTORY_KEY) -> HistorySummary:
+        items = self.between(start, end, history_key)
+        latencies = [item['Latency'] for item in items if item.get('Latency') is not None]
+        return HistorySummary(len(items), sum(is_healthy(item) for item in items),
+                              sum(latencies) / len(latencies) if latencies else None,
+                              max(latencies) if latencies else None)
+
+    def prune(self) -> int:
+        # removes expired items, returning how many
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class DynamoHistory(HistoryStore):
+    # The MonitorHistory table, read with Queries on the HistoryByTime index and written with the
+    # batch writer. DynamoDB deletes items itself once their ExpirationTime has passed.
+    def __init__(self, dynamodb, table_name: str):
+        self.dynamodb = dynamodb
+        self.name = table_name
+
+    def write(self, items: List[Dict]) -> None:
+        write_batch(self.dynamodb, self.name, items)
+
+    def latest(self, limit: int = 10, history_key: str = HISTORY_KEY) -> List[Dict]:
+        return read_latest_outcomes(self.dynamodb, self.name, limit=limit, history_key=history_key)
+
+    def between(self, start: int, end: int, history_key: str = HISTORY_KEY) -> List[Dict]:
+        from boto3.dynamodb.conditions import Key
+        table = self.dynamodb.Table(self.name)
+        kwargs = {
+            'IndexName': HISTORY_INDEX,
+            'KeyConditionExpression': Key('HistoryKey').eq(history_key) & Key('CheckTime').between(start, end),
+            'ScanIndexForward': False
+        }
+        items = []
+        while True:
+            response = table.query(**kwargs)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return load_from_dynamodb(items)
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS history (
+        check_time INTEGER NOT NULL,
+        outcome TEXT NOT NULL,
+        history_key TEXT NOT NULL,
+        expiration_time INTEGER,
+        latency REAL,
+        item TEXT NOT NULL,
+        PRIMARY KEY (check_time, outcome)
+    )''',
+    # the equivalent of the HistoryByTime index
+    'CREATE INDEX IF NOT EXISTS history_by_time ON history (history_key, check_time)',
+    'CREATE INDEX IF NOT EXISTS history_by_expiry ON history (expiration_time)',
+)
+
+
+class SQLiteHistory(HistoryStore):
+    # An embedded store for single host deployments and development, which needs no network
+    # round trips. The database is in WAL mode, so reads never wait for a write, and expired
+    # items are pruned on every write, like the DynamoDB TTL.
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH, clock: Callable[[], float] = time.time):
+        self.name = path
+        self.clock = clock
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode a commit is still atomic without a sync, only the last ones can be lost on power failure
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        atexit.register(self.close)
+
+    def write(self, items: Iterable[Dict]) -> None:
+        rows = [(item['CheckTime'], str(item['Outcome']), item.get('HistoryKey', HISTORY_KEY),
+                 item.get('ExpirationTime'), item.get('Latency'), json.dumps(item, default=str)) for item in items]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._prune()
+
+    def _select(self, where: str, parameters: tuple, limit: Optional[int] = None) -> List[Dict]:
+        # expired items are hidden even before they are pruned
+        query = (f'SELECT item FROM history WHERE {where} AND (expiration_time IS NULL OR expiration_time > ?) '
+                 f'ORDER BY check_time DESC')
+        parameters += (int(self.clock()),)
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters += (limit,)
+        return [json.loads(row[0]) for row in self.connection.execute(query, parameters)]
+
+    def latest(self, limit: int = 10, history_key: str = HISTORY_KEY) -> List[Dict]:
+        return self._select('history_key = ?', (history_key,), limit)
+
+    def between(self, start: int, end: int, history_key: str = HISTORY_KEY) -> List[Dict]:
+        return self._select('history_key = ? AND check_time BETWEEN ? AND ?', (history_key, start, end))
+
+    def summary(self, start: int, end: int, history_key: str = HISTORY_KEY) -> HistorySummary:
+        # aggregated in SQLite rather than by loading every item
+        checks, healthy, latency, max_latency = self.connection.execute(
+            '''SELECT COUNT(*), SUM(outcome = 'True' OR outcome LIKE 'True#%'), AVG(latency), MAX(latency)
+               FROM history WHERE history_key = ? AND check_time BETWEEN ? AND ?
+               AND (expiration_time IS NULL OR expiration_time > ?)''',
+            (history_key, start, end, int(self.clock()))
+        ).fetchone()
+        return HistorySummary(checks, healthy or 0, latency, max_latency)
+
+    def _prune(self) -> int:
+        return self.connection.execute('DELETE FROM history WHERE expiration_time <= ?', (int(self.clock()),)).rowcount
+
+    def prune(self) -> int:
+        with self.connection:
+            return self._prune()
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self.connection.close()
+
+
+class ResultSink:
+    # Buffers check results and writes them in batches once max_items are waiting or the oldest
+    # has waited max_age seconds, and when the process exits. Items are only dropped from the
+    # buffer after a successful write.
+    def __init__(self, store: HistoryStore, max_items: int = 25, max_age: float = 300,
+                 retries: int = 3, backoff: float = 1, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.store = store
+        self.max_items = max_items
+        self.max_age = max_age
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.buffer: List[Dict] = []
+        self.oldest = None
+        atexit.register(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, item: Dict) -> None:
+        if not self.buffer:
+            self.oldest = self.clock()
+        self.buffer.append(item)
+        self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        if len(self.buffer) >= self.max_items or (self.buffer and self.clock() - self.oldest >= self.max_age):
+            self.flush()
+
+    def flush(self) -> bool:
+        if not self.buffer:
+            return True
+        with span('history.flush', store=self.store.name, items=len(self.buffer)) as current:
+            for attempt in range(self.retries):
+                if not self.buffer:
+                    return True
+                if attempt:
+                    self.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    self.store.write(self.buffer)
+                except STORE_ERRORS as err:
+                    logger.warning(f'unable to write {len(self.buffer)} results to {self.store.name}: {err}')
+                else:
+                    self.buffer = []
+            if self.buffer:
+                logger.error(f'giving up on writing {len(self.buffer)} results to {self.store.name}')
+                current.fail(f'{len(self.buffer)} results not written')
+                return False
+            return True
+
+    def close(self) -> bool:
+        atexit.unregister(self.flush)
+        return self.flush()
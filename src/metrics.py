@@ -0,0 +1,228 @@
+import json
+import logging
+import math
+import os
+import struct
+import tempfile
+import time
+from array import array
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from src.state import state_path
+
+
+logger = logging.getLogger('securecontact.metrics')
+# one embedded metric format (EMF) JSON document per line, see enable_cloudwatch
+emf_logger = logging.getLogger('securecontact.metrics.emf')
+
+NAMESPACE = 'SecureContact'
+DEFAULT_METRICS_PATH = state_path('metrics.bin')
+WINDOWS = (('1h', 3600), ('24h', 24 * 3600), ('7d', 7 * 24 * 3600))
+# a week of checks every 30 seconds, about 260KB
+DEFAULT_CAPACITY = 7 * 24 * 120
+HEADER = struct.Struct('<4sII')
+MAGIC = b'SCM1'
+
+
+class RingBuffer:
+    # Fixed size columns of check time, latency and outcome; the oldest row is overwritten once full.
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.times = array('d')
+        # NaN when the check never got a response
+        self.latencies = array('f')
+        self.healthy = array('b')
+        # index of the oldest row once the buffer is full
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, timestamp: float, latency: float, healthy: bool) -> None:
+        if len(self.times) < self.capacity:
+            self.times.append(timestamp)
+            self.latencies.append(latency)
+            self.healthy.append(healthy)
+            return
+        self.times[self.start] = timestamp
+        self.latencies[self.start] = latency
+        self.healthy[self.start] = healthy
+        self.start = (self.start + 1) % self.capacity
+
+    def rows(self) -> Iterator[Tuple[float, float, bool]]:
+        # oldest first
+        count = len(self.times)
+        for offset in range(count):
+            index = (self.start + offset) % count
+            yield self.times[index], self.latencies[index], bool(self.healthy[index])
+
+    def to_bytes(self) -> bytes:
+        rows = list(self.rows())
+        columns = (array('d', [row[0] for row in rows]), array('f', [row[1] for row in rows]),
+                   array('b', [row[2] for row in rows]))
+        return HEADER.pack(MAGIC, self.capacity, len(rows)) + b''.join(column.tobytes() for column in columns)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, capacity: Optional[int] = None) -> 'RingBuffer':
+        magic, stored_capacity, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not a metrics buffer')
+        buffer = cls(capacity or stored_capacity)
+        offset = HEADER.size
+        columns = []
+        for typecode in 'dfb':
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[offset:offset + size])
+            offset += size
+            columns.append(column)
+        if len(columns[2]) != count:
+            raise ValueError('truncated metrics buffer')
+        for row in zip(*columns):
+            buffer.append(*row)
+        return buffer
+
+
+class WindowStats(NamedTuple):
+    window: str
+    checks: int
+    # percentages and seconds, None without any checks (or responses) in the window
+    availability: Optional[float]
+    p50: Optional[float]
+    p90: Optional[float]
+    p99: Optional[float]
+
+
+def percentile(ordered: Sequence[float], q: float) -> Optional[float]:
+    # nearest rank, so the value is always one that was measured
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class RollingAggregator:
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, windows: Sequence[Tuple[str, float]] = WINDOWS,
+                 clock: Callable[[], float] = time.time):
+        self.buffer = RingBuffer(capacity)
+        self.windows = windows
+        self.clock = clock
+
+    def record(self, healthy: bool, latency: Optional[float], timestamp: Optional[float] = None) -> None:
+        self.buffer.append(self.clock() if timestamp is None else timestamp,
+                           math.nan if latency is None else latency, healthy)
+
+    def stats(self, name: str, seconds: float) -> WindowStats:
+        cutoff = self.clock() - seconds
+        rows = [row for row in self.buffer.rows() if row[0] >= cutoff]
+        if not rows:
+            return WindowStats(name, 0, None, None, None, None)
+        latencies = sorted(latency for _, latency, _ in rows if not math.isnan(latency))
+        availability = 100 * sum(healthy for _, _, healthy in rows) / len(rows)
+        return WindowStats(name, len(rows), availability, percentile(latencies, 50), percentile(latencies, 90),
+                           percentile(latencies, 99))
+
+    def summary(self) -> List[WindowStats]:
+        return [self.stats(name, seconds) for name, seconds in self.windows]
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as fobj:
+                fobj.write(self.buffer.to_bytes())
+            os.replace(fobj.name, path)
+        except OSError as err:
+            logger.warning(f'unable to save metrics {path}: {err}')
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, 'rb') as fobj:
+                self.buffer = RingBuffer.from_bytes(fobj.read(), self.buffer.capacity)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, struct.error) as err:
+            logger.warning(f'ignoring unreadable metrics {path}: {err}')
+
+
+def emf_document(namespace: str, dimensions: Dict[str, str], metrics: Dict[str, Tuple[float, str]],
+                 timestamp: float) -> Dict:
+    # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    values = {name: value for name, (value, _) in metrics.items() if value is not None}
+    return {
+        '_aws': {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in metrics.items()
+                            if value is not None]
+            }]
+        },
+        **dimensions,
+        **values
+    }
+
+
+class MetricsRecorder:
+    # Feeds every check into the rolling aggregator and logs the check and the rolling
+    # aggregates as one EMF document, which CloudWatch turns into metrics.
+    def __init__(self, stage: str, aggregator: Optional[RollingAggregator] = None, path: Optional[str] = None,
+                 namespace: str = NAMESPACE):
+        self.stage = stage
+        self.aggregator = aggregator or RollingAggregator()
+        self.path = path
+        self.namespace = namespace
+        if path:
+            self.aggregator.load(path)
+
+    def record_check(self, healthy: bool, latency: Optional[float], attempts: int, restarts: int,
+                     status: Optional[str] = None, failure: Optional[str] = None) -> Dict:
+        now = self.aggregator.clock()
+        self.aggregator.record(healthy, latency, now)
+        metrics = {
+            'Healthy': (int(healthy), 'Count'),
+            'Degraded': (int(status == 'degraded'), 'Count'),
+            'Latency': (None if latency is None else round(latency * 1000, 1), 'Milliseconds'),
+            'Attempts': (attempts, 'Count'),
+            'TorRestarts': (restarts, 'Count'),
+        }
+        for stats in self.aggregator.summary():
+            metrics[f'Availability{stats.window}'] = (stats.availability, 'Percent')
+            for name in ('p50', 'p90', 'p99'):
+                value = getattr(stats, name)
+                metrics[f'Latency{name.upper()}{stats.window}'] = (None if value is None else round(value * 1000, 1),
+                                                                   'Milliseconds')
+
+        document = emf_document(self.namespace, {'Stage': self.stage}, metrics, now)
+        # failure is searchable in the logs but not a metric
+        if failure:
+            document['Failure'] = failure
+        emf_logger.info(json.dumps(document, separators=(',', ':')))
+        if self.path:
+            self.aggregator.save(self.path)
+        return document
+
+    def record_mirror(self, target: str, healthy: bool, latency: Optional[float]) -> Dict:
+        # per mirror, and left out of the rolling aggregates, which are the main onion's
+        metrics = {
+            'Healthy': (int(healthy), 'Count'),
+            'Latency': (None if latency is None else round(latency * 1000, 1), 'Milliseconds'),
+        }
+        document = emf_document(self.namespace, {'Stage': self.stage, 'Target': target}, metrics,
+                                self.aggregator.clock())
+        emf_logger.info(json.dumps(document, separators=(',', ':')))
+        return document
+
+
+def enable_cloudwatch(session, log_group: str, stream: str = 'metrics'):
+    # watchtower is optional; without it the EMF lines only reach the local log
+    try:
+        import watchtower
+    except ImportError:
+        logger.warning('watchtower is not installed, metrics will not be sent to CloudWatch')
+        return None
+    handler = watchtower.CloudWatchLogHandler(log_group_name=log_group, log_stream_name=stream,
+                                              boto3_client=session.client('logs'))
+    # CloudWatch only recognises EMF when the log event is the bare JSON document
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    emf_logger.addHandler(handler)
+    return handler
@@ -1,16 +1,39 @@
+from __future__ import annotations
+
+import argparse
 import os
+import shlex
+import subprocess
+import sys
 import time
 import logging
-
-from typing import Optional, Union, Dict, List
-
-import requests
-from boto3 import Session
-from requests.exceptions import RequestException
-
-from src.notifications import create_email, send_message, send_email
-from securedrop import build_pages
-from src.dynamo import read_from_database, write_to_database
+from functools import lru_cache
+
+from typing import TYPE_CHECKING, Callable, Optional, Dict, List, Tuple
+
+from botocore.exceptions import ClientError
+
+from src.notifications import (DEFAULT_NOTIFICATION_STATE, ChatChannel, EmailChannel, Notification,
+                               NotificationDispatcher, create_email, mirror_notification, status_notification)
+from src.config import MissingParameters, load_config
+from src.cluster import LEASE_MARGIN, Cluster
+from src.control import TorController, controller_from_config, diagnose, recover
+from src.cache import DEFAULT_CACHE_PATH, CachedHistory, StateCache
+from src.healthcheck import (MAX_METADATA_BYTES, CheckResult, HealthcheckPolicy, Signal, combine, evaluate,
+                             metadata_url, policy_from_config, quorum_reached)
+from src.metrics import DEFAULT_METRICS_PATH, MetricsRecorder, enable_cloudwatch
+from src.dynamo import ATTEMPT_HISTORY_KEY, HISTORY_KEY, MIRROR_HISTORY_KEY
+from src.history import (DEFAULT_HISTORY_PATH, STORE_ERRORS, DynamoHistory, HistoryStore, ResultSink, SQLiteHistory,
+                         is_healthy)
+from src.probe import TOR_PROXY, ProbeResponse, QuorumClient, TorClient, parse_proxy, parse_quorum
+from src.publish import (HTML_CONTENT_TYPE, PublishResult, content_digest, publish_assets, publish_file,
+                         publish_variants, switch_pointer, variant_key)
+from src.scheduler import Outcome, RetryScheduler, TorRestartPolicy, budget_from_interval
+from src.tracing import span, traced
+
+# boto3 and Jinja2 are only imported when they are first used, see tests/test_imports.py
+if TYPE_CHECKING:
+    from boto3 import Session
 
 
 logging.basicConfig(level=logging.INFO,
@@ -20,6 +43,9 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger('securecontact.monitor')
 
+# the verdict recorded for a failure the retries could not confirm, which leaves the page as it is
+UNCONFIRMED_OUTCOME = 'False#unconfirmed'
+
 
 def get_stage(filename: str) -> str:
     stage = 'DEV'
@@ -32,7 +58,10 @@ def get_stage(filename: str) -> str:
     return stage
 
 
+@lru_cache(maxsize=None)
 def create_session(profile=None, region='eu-west-1') -> Session:
+    # sessions are expensive to create and safe to share, so there is one per profile and region
+    from boto3 import Session
     return Session(profile_name=profile, region_name=region)
 
 
@@ -44,40 +73,70 @@ def create_service_resource(session: Session, stage: str):
     return session.resource('dynamodb', endpoint_url="http://localhost:8000")
 
 
-def fetch_parameter(client, name: str) -> Union[str, None]:
-    try:
-        response = client.get_parameter(Name=name, WithDecryption=True)
-        return response['Parameter']['Value']
-    except client.exceptions.ParameterNotFound:
-        logger.warning(f'parameter not found: {name}')
-        return None
+def create_probe_client(config: Dict[str, str]) -> TorClient:
+    # the optional tor-quorum parameter, such as 2/3, probes from that many vantage points
+    # over the SOCKS ports in tor-proxies, or isolated circuits of the one Tor
+    proxies = [parse_proxy(proxy) for proxy in (config.get('TOR_PROXIES') or '').split(',') if proxy.strip()]
+    if config.get('TOR_QUORUM'):
+        return QuorumClient(*parse_quorum(config['TOR_QUORUM']), proxies=proxies or [TOR_PROXY])
+    # without a quorum only the first proxy is used, which is how the Lambda reaches Tor
+    return TorClient(proxies[0] if proxies else TOR_PROXY, isolation=config.get('TOR_ISOLATION') or 'shared')
 
 
 # N.B. this script requires Tor to be running on the server
-def send_request(onion_address: str) -> Optional[requests.Response]:
-    # TODO: handle any ConnectionRefusedError and ConnectTimeoutError
-    target = f'http://{onion_address}'
-    headers = {
-        'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0',
-        'referer': 'https://www.google.com'
-    }
-    proxies = {
-        'http': 'socks5h://127.0.0.1:9050',
-        'https': 'socks5h://127.0.0.1:9050'
-    }
-    try:
-        return requests.get(target, headers=headers, proxies=proxies, timeout=15)
-    except RequestException as err:
-        logger.error(err)
+def send_request(client: TorClient, onion_address: str) -> ProbeResponse:
+    return client.get(onion_address)
+
 
+def get_targets(config: Dict[str, str]) -> List[str]:
+    mirrors = config.get('SECUREDROP_MIRRORS') or ''
+    return [config['SECUREDROP_URL']] + [mirror.strip() for mirror in mirrors.split(',') if mirror.strip()]
 
-def healthcheck(response: Optional[requests.Response]) -> bool:
-    expected_text = 'The Guardian | SecureDrop'
+
+def healthcheck(response: Optional[ProbeResponse]) -> bool:
     if response:
         logger.info(f'response status code: {response.status_code}')
-        if response.status_code == 200 and expected_text in response.text:
-            return True
-    return False
+    return evaluate(response).healthy
+
+
+def check_quorum(client: QuorumClient, targets: List[str], policy: HealthcheckPolicy) -> List[CheckResult]:
+    # every vantage point probes every target, and each target is decided by quorum
+    def decided(sweeps: List[List[ProbeResponse]]) -> bool:
+        return all(quorum_reached([evaluate(sweep[index], policy) for sweep in sweeps], client.quorum)
+                   for index in range(len(targets)))
+
+    sweeps = client.sweep_all(targets, decided=decided, timeout=policy.timeout, marker=policy.marker.encode(),
+                              max_bytes=policy.max_bytes)
+    votes = [[evaluate(sweep[index], policy) for sweep in sweeps] for index in range(len(targets))]
+    primary = votes[0]
+    vantage = next((index for index, result in enumerate(primary) if result.healthy), None)
+    if vantage is not None and policy.check_metadata:
+        # from the first vantage point that got the page, which is the one combine reports
+        metadata = client.get(metadata_url(targets[0]), timeout=policy.timeout, vantage=vantage,
+                              max_bytes=MAX_METADATA_BYTES)
+        primary[vantage] = evaluate(sweeps[vantage][0], policy, metadata)
+    return [combine(results, client.quorum) for results in votes]
+
+
+@traced('probe')
+def check_targets(client: TorClient, targets: List[str], policy: HealthcheckPolicy,
+                  diagnose: Optional[Callable[[str], Tuple[Signal, ...]]] = None) -> List[CheckResult]:
+    if isinstance(client, QuorumClient):
+        return check_quorum(client, targets, policy)
+    # bodies are streamed and only read as far as the marker
+    responses = client.sweep(targets, timeout=policy.timeout, marker=policy.marker.encode(), max_bytes=policy.max_bytes)
+    results = [evaluate(response, policy) for response in responses]
+    primary = results[0]
+    if primary.error is not None and diagnose is not None:
+        # an unreachable onion is either down or our own Tor is, which only Tor can tell
+        with span('tor.diagnose'):
+            signals = diagnose(primary.target)
+        results[0] = evaluate(responses[0], policy, extra=signals)
+    if primary.healthy and policy.check_metadata:
+        # reuses the connection the page was fetched on
+        metadata = client.get(metadata_url(primary.target), timeout=policy.timeout, max_bytes=MAX_METADATA_BYTES)
+        results[0] = evaluate(responses[0], policy, metadata)
+    return results
 
 
 def get_uptime():
@@ -99,119 +158,473 @@ def hour_is_0900():
         return False
 
 
-def create_item(current_time: int, outcome: bool) -> Dict[str, str]:
+def create_item(current_time: int, outcome: bool, details: Optional[Dict] = None) -> Dict[str, str]:
     expiration = get_expiry(current_time)
-    return {
+    item = {
         'CheckTime': current_time,
         'ExpirationTime': expiration,
-        'Outcome': str(outcome)
+        'Outcome': str(outcome),
+        'HistoryKey': HISTORY_KEY
     }
+    # e.g. the latency, number of attempts and Tor restarts behind the outcome
+    item.update(details or {})
+    return item
+
+
+def create_unconfirmed_item(current_time: int, details: Optional[Dict] = None) -> Dict[str, str]:
+    item = create_item(current_time, False, details)
+    item['Outcome'] = UNCONFIRMED_OUTCOME
+    return item
+
+
+def create_attempt_item(current_time: int, attempt: int, outcome: bool, failure: Optional[str],
+                        result: Optional[CheckResult] = None) -> Dict[str, str]:
+    item = create_item(current_time, outcome)
+    # Outcome is part of the primary key, so the attempt number keeps attempts in the same
+    # second from overwriting each other or the verdict
+    item.update({
+        'Outcome': f'{outcome}#{attempt}',
+        'HistoryKey': ATTEMPT_HISTORY_KEY,
+        'Attempt': attempt
+    })
+    if failure:
+        item['Failure'] = failure
+    if result is not None:
+        if result.error is None:
+            item['Latency'] = round(result.elapsed, 3)
+        # degraded checks pass, so this is where they show up
+        item['Status'] = result.status
+        if result.problems:
+            item['Problems'] = list(result.problems)
+        if result.confidence < 1:
+            item['Confidence'] = result.confidence
+    return item
+
+
+def create_mirror_item(current_time: int, result: CheckResult) -> Dict[str, str]:
+    item = create_item(current_time, result.healthy)
+    # one per mirror and check, the target keeps mirrors checked in the same second apart
+    item.update({
+        'Outcome': f'{result.healthy}#{result.target}',
+        'HistoryKey': MIRROR_HISTORY_KEY,
+        'Target': result.target,
+        'Status': result.status
+    })
+    if result.error is None:
+        item['Latency'] = round(result.elapsed, 3)
+    if result.failure:
+        item['Failure'] = result.failure
+    return item
+
+
+INDEX_KEY = 'index2.html'
+PAGE_FILES = {True: 'build/index.html', False: 'build/maintenance.html'}
+
+
+def publish_mode(config: Dict[str, str]) -> str:
+    # upload puts the page itself, copy and redirect switch over to a page uploaded in advance
+    mode = config.get('PUBLISH_MODE') or 'upload'
+    return mode if mode in ('copy', 'redirect') else 'upload'
+
+
+@traced('publish.pages')
+def publish_pages(session: Session, config: Dict[str, str]) -> bool:
+    # uploads the assets and both pages under their content hash, which is only needed once per build
+    if publish_mode(config) == 'upload':
+        return True
+    client = session.client('s3')
+    assets = publish_assets(client, config['BUCKET_NAME'], 'build/static')
+    variants = publish_variants(client, config['BUCKET_NAME'], list(PAGE_FILES.values()))
+    return all(result.succeeded for result in assets + list(variants.values()))
+
 
+def redirect_location(config: Dict[str, str], body: bytes) -> str:
+    # routing in Fastly requires PROD links to include securedrop/, as in build_pages; the pages
+    # link their assets from the root, so they load the same from pages/ as from the index
+    path = 'securedrop/' if config['STAGE'] == 'PROD' else ''
+    return f'/{path}{variant_key(body)}'
 
-def upload_website_index(session: Session, config: Dict[str, str], passes_healthcheck: bool) -> None:
-    file_name = 'build/index.html' if passes_healthcheck else 'build/maintenance.html'
+
+def switch_website_index(session: Session, config: Dict[str, str], passes_healthcheck: bool) -> PublishResult:
+    with open(PAGE_FILES[passes_healthcheck], 'rb') as fobj:
+        body = fobj.read()
     client = session.client('s3')
-    client.upload_file(file_name, config['BUCKET_NAME'], 'index2.html', ExtraArgs={'ContentType': 'text/html'})
+    redirect = redirect_location(config, body) if publish_mode(config) == 'redirect' else None
+    try:
+        return switch_pointer(client, config['BUCKET_NAME'], INDEX_KEY, body, redirect)
+    except ClientError:
+        logger.warning(f'{variant_key(body)} has not been uploaded yet, publishing the pages first')
+    publish_pages(session, config)
+    try:
+        return switch_pointer(client, config['BUCKET_NAME'], INDEX_KEY, body, redirect)
+    except ClientError as err:
+        logger.error(f'unable to point s3://{config["BUCKET_NAME"]}/{INDEX_KEY} at {variant_key(body)}: {err}')
+        return PublishResult(INDEX_KEY, False, None, content_digest(body))
+
+
+def upload_website_index(session: Session, config: Dict[str, str], passes_healthcheck: bool) -> PublishResult:
+    if publish_mode(config) != 'upload':
+        return switch_website_index(session, config, passes_healthcheck)
+    file_name = PAGE_FILES[passes_healthcheck]
+    client = session.client('s3')
+    if not all(result.succeeded for result in publish_assets(client, config['BUCKET_NAME'], 'build/static')):
+        logger.warning('not all static assets could be published')
+    return publish_file(client, config['BUCKET_NAME'], INDEX_KEY, file_name, HTML_CONTENT_TYPE)
+
+
+def refresh_website_index(session: Session, config: Dict[str, str], passes_healthcheck: bool) -> PublishResult:
+    # the variants and assets the page points at expire like the page itself, so they are
+    # refreshed with it; the upload mode publishes its assets with every page
+    if publish_mode(config) != 'upload' and not publish_pages(session, config):
+        logger.warning('not all pages and assets could be refreshed')
+    return upload_website_index(session, config, passes_healthcheck)
 
 
 # talk to Kate to find out why this solution currently does not work for PROD >_< ...SADNESS
-def update_website_configuration(session: Session, bucket_name: str, passes_healthcheck: bool):
-    # TODO: this should return AWS status code so we know if the update succeeded or failed
+def update_website_configuration(session: Session, bucket_name: str, passes_healthcheck: bool) -> int:
     suffix = 'index.html' if passes_healthcheck else 'maintenance.html'
     configuration = {
         'ErrorDocument': {'Key': 'error.html'},
         'IndexDocument': {'Suffix': suffix},
     }
     s3_client = session.client('s3')
-    s3_client.put_bucket_website(Bucket=bucket_name, WebsiteConfiguration=configuration)
+    response = s3_client.put_bucket_website(Bucket=bucket_name, WebsiteConfiguration=configuration)
+    return response['ResponseMetadata']['HTTPStatusCode']
 
 
-def send_failure_email(session: Session, config: Dict[str, str]):
+def failure_email(since: int) -> Notification:
     subject = '[ALERT P1] SecureDrop Site Failing Healthcheck'
     heading = 'SecureDrop Status Update'
     message = ("Monitor will attempt to update the page content. \n"
                "Please check that the update has been applied.")
-    send_email(session, config, create_email(subject, heading, message))
+    # one per outage, so that an outage soon after another is not taken for a repeat of it
+    return Notification('email', f'failure#{since}', 'Healthcheck failed', create_email(subject, heading, message))
+
+
+def create_dispatcher(session: Session, config: Dict[str, str]) -> NotificationDispatcher:
+    channels = {
+        'chat': ChatChannel(config['PRODMON_WEBHOOK'], config['PRODMON_REDEPLOY_URL']),
+        'email': EmailChannel(session.client('ses'), config['PRODMON_SENDER'], config['PRODMON_RECIPIENT'])
+    }
+    return NotificationDispatcher(channels, state_path=config.get('NOTIFICATION_STATE') or DEFAULT_NOTIFICATION_STATE)
 
 
 def state_has_changed(healthy: bool, history: List[Dict[str, str]]) -> bool:
-    # TODO: compare result of latest check with previous record
-    pass
+    # unconfirmed failures never changed the page
+    history = [item for item in history if item['Outcome'] != UNCONFIRMED_OUTCOME]
+    # with no history we cannot know what the page shows, so treat it as a change
+    if not history:
+        return True
+    latest = max(history, key=lambda item: item['CheckTime'])
+    return latest['Outcome'] != str(healthy)
+
+
+def create_history_store(session: Session, config: Dict[str, str]) -> HistoryStore:
+    # the optional history-store parameter, sqlite or dynamodb; DEV defaults to sqlite so that
+    # it does not need DynamoDB Local
+    backend = config.get('HISTORY_STORE') or ('sqlite' if config['STAGE'] == 'DEV' else 'dynamodb')
+    if backend == 'sqlite':
+        return SQLiteHistory(config.get('HISTORY_PATH') or DEFAULT_HISTORY_PATH)
+    return DynamoHistory(create_service_resource(session, config['STAGE']), config['TABLE_NAME'])
+
+
+def create_history(store: HistoryStore, config: Dict[str, str]) -> CachedHistory:
+    cache = StateCache(config.get('STATE_CACHE') or DEFAULT_CACHE_PATH)
+    return CachedHistory(store, cache)
+
+
+def update_status(session: Session, config: Dict[str, str], history: CachedHistory, healthy: bool,
+                  notifier: NotificationDispatcher, details: Optional[Dict] = None):
+    check_time = int(time.time())
+    with span('history.latest'):
+        # enough to see past the unconfirmed failures to the last verdict
+        latest = history.latest(limit=10)
+    logger.debug(latest[:1])
+
+    changed = state_has_changed(healthy, latest)
+    if changed:
+        logger.info(f'Healthcheck: state has changed to {healthy}, updating the status page')
+        with span('publish', mode=publish_mode(config)) as publishing:
+            result = upload_website_index(session, config, healthy)
+            if not result.succeeded:
+                logger.error('Healthcheck: unable to update the status page')
+                publishing.fail('status page not updated')
+        notifier.notify(status_notification(config, healthy))
+        # we also send an email alert
+        if not healthy:
+            notifier.notify(failure_email(check_time))
+    elif hour_is_0900():
+        # once a day the page is published again, as the bucket expires objects after a week;
+        # it is only written when it is a day old, so the other checks that hour cost a HEAD
+        with span('publish', mode=publish_mode(config), refresh=True) as publishing:
+            if not refresh_website_index(session, config, healthy).succeeded:
+                logger.error('Healthcheck: unable to refresh the status page')
+                publishing.fail('status page not refreshed')
+        if healthy:
+            # a daily reminder that the monitor is still running; repeats within the hour are suppressed
+            notifier.notify(status_notification(config, healthy))
+
+    # Finally, record the latest result; state changes go to the database straight away
+    item = create_item(check_time, healthy, details)
+    with span('history.record', flush=changed):
+        history.record(item, flush=changed)
 
 
 def monitor(session: Session, config: Dict[str, str], stage: str):
-    dynamodb = create_service_resource(session, stage)
-    response = send_request(config['SECUREDROP_URL'])
-    history = read_from_database(dynamodb, config['TABLE_NAME'])
+    history = create_history(create_history_store(session, config), config)
+    with create_probe_client(config) as client:
+        response = send_request(client, config['SECUREDROP_URL'])
     healthy = healthcheck(response)
 
     logger.info(f'Healthcheck outcome: {healthy}')
-    logger.debug(history)
+    with create_dispatcher(session, config) as notifier:
+        update_status(session, config, history, healthy, notifier)
 
-    # TODO: perform update once per day regardless and give MOTD
-    if state_has_changed(healthy, history):
-        upload_website_index(session, config, healthy)
-        send_message(config, healthy)
-        # we also send an email alert
-        if not healthy:
-            send_failure_email(session, config)
 
-    # Finally, update the database with the latest result
-    item = create_item(int(time.time()), healthy)
-    write_to_database(dynamodb, config['TABLE_NAME'], item)
+def run(session: Session, config: Dict[str, str]):
+    with create_probe_client(config) as client, create_dispatcher(session, config) as notifier:
+        run_checks(session, config, client, notifier)
 
 
-def run(session: Session, config: Dict[str, str]):
+def restart_tor(command: str = 'systemctl restart tor') -> None:
+    logger.info('Healthcheck: rebuilding tor circuits')
+    try:
+        subprocess.run(shlex.split(command), check=True, timeout=60)
+    except (OSError, subprocess.SubprocessError) as err:
+        logger.error(f'unable to restart tor: {err}')
+
+
+def create_scheduler(config: Dict[str, str], allow_restart: bool = True, **kwargs) -> RetryScheduler:
+    # the daemon checks every CHECK_INTERVAL seconds, cron every CRON_INTERVAL
+    interval = float(config.get('CHECK_INTERVAL') or config.get('CRON_INTERVAL') or 1800)
+    restart = TorRestartPolicy(enabled=allow_restart and config.get('TOR_RESTART') != 'never')
+    if config.get('TOR_QUORUM'):
+        # vantage points that agree have already confirmed the verdict among themselves
+        kwargs.setdefault('confirm_failures', 1)
+    return RetryScheduler(budget=budget_from_interval(interval), restart=restart, **kwargs)
+
+
+@traced('config')
+def create_config(session: Session, stage: str, refresh: bool = False) -> Dict[str, str]:
+    return {
+        **load_config(session, stage, refresh=refresh),
+        # keep in step with the crontab in the CloudFormation UserData
+        'CRON_INTERVAL': '1800',
+        'TABLE_NAME': f'MonitorHistory-{stage}',
+        'STAGE': stage
+    }
+
+
+def create_metrics(session: Session, config: Dict[str, str]) -> MetricsRecorder:
+    if config.get('METRICS_LOG_GROUP'):
+        enable_cloudwatch(session, config['METRICS_LOG_GROUP'])
+    return MetricsRecorder(config['STAGE'], path=config.get('METRICS_PATH') or DEFAULT_METRICS_PATH)
+
+
+def create_cluster(session: Session, config: Dict[str, str]) -> Optional[Cluster]:
+    # the optional cluster parameter, dynamodb to share the work with the other monitor hosts
+    if config.get('CLUSTER') != 'dynamodb':
+        return None
+    # The leader renews its lease when a check starts and again before it publishes, so the lease
+    # only has to outlast one check, and a leader that dies is replaced within minutes rather
+    # than check intervals. Heartbeats last across a missed check, and never less than a check.
+    interval = float(config.get('CHECK_INTERVAL') or config.get('CRON_INTERVAL') or 1800)
+    lease = budget_from_interval(interval) + LEASE_MARGIN
+    return Cluster(create_service_resource(session, config['STAGE']), f'MonitorCluster-{config["STAGE"]}',
+                   lease_duration=lease, heartbeat_duration=max(2 * interval, lease))
+
+
+def run_checks(session: Session, config: Dict[str, str], client: TorClient, notifier: NotificationDispatcher):
+    store = create_history_store(session, config)
+    metrics = create_metrics(session, config)
+    with ResultSink(store) as sink:
+        check_once(session, config, client, notifier, sink, create_history(store, config), metrics=metrics,
+                   cluster=create_cluster(session, config))
+
+
+def check_share(client: TorClient, targets: List[str], policy: HealthcheckPolicy, sink: ResultSink,
+                metrics: Optional[MetricsRecorder] = None) -> List[CheckResult]:
+    # a follower probes its share of the mirrors once, the leader has the main onion
+    if not targets:
+        logger.info('Healthcheck: following the leader, with no targets of our own')
+        return []
+    results = check_targets(client, targets, policy)
+    logger.info(f'Healthcheck results: {({result.target: result.status for result in results})}')
+    record_mirrors(results, sink, metrics)
+    # the leader alerts on them, so they cannot wait in the buffer
+    sink.flush()
+    return results
+
+
+def record_mirrors(results: List[CheckResult], sink: ResultSink,
+                   metrics: Optional[MetricsRecorder] = None) -> List[Dict]:
+    now = int(time.time())
+    items = [create_mirror_item(now, result) for result in results]
+    for item, result in zip(items, results):
+        sink.add(item)
+        if metrics is not None:
+            metrics.record_mirror(result.target, result.healthy, result.elapsed if result.error is None else None)
+    return items
+
+
+def mirror_changes(mirrors: List[str], items: List[Dict]) -> Tuple[List[str], bool]:
+    # the mirrors down in their latest result, and whether any of them changed since the one before
+    unique = {(item['CheckTime'], item['Outcome']): item for item in items}.values()
+    states: Dict[str, List[bool]] = {}
+    for item in sorted(unique, key=lambda item: item['CheckTime'], reverse=True):
+        states.setdefault(item.get('Target'), []).append(is_healthy(item))
+    down = [mirror for mirror in mirrors if mirror in states and not states[mirror][0]]
+    # a mirror seen for the first time has changed if it is down
+    changed = any(states[mirror][0] != (states[mirror][1] if len(states[mirror]) > 1 else True)
+                  for mirror in mirrors if mirror in states)
+    return down, changed
+
+
+def alert_mirrors(config: Dict[str, str], history: CachedHistory, notifier: NotificationDispatcher,
+                  items: List[Dict]) -> None:
+    # Only the leader alerts, on what it probed itself and what the other nodes recorded in the
+    # history, which has to be the shared dynamodb store for it to see them. Repeats of the same
+    # alert are suppressed by the dispatcher.
+    mirrors = get_targets(config)[1:]
+    if not mirrors:
+        return
+    with span('history.mirrors'):
+        try:
+            # the latest two for each mirror, with room for the nodes that checked twice meanwhile
+            stored = history.store.latest(limit=3 * len(mirrors), history_key=MIRROR_HISTORY_KEY)
+        except STORE_ERRORS as err:
+            logger.error(f'unable to read the mirror results from {history.store.name}: {err}')
+            stored = []
+    down, changed = mirror_changes(mirrors, list(items) + stored)
+    if changed:
+        logger.info(f'Healthcheck: mirrors down: {down}')
+        notifier.notify(mirror_notification(config, down))
+
+
+@traced('check')
+def check_once(session: Session, config: Dict[str, str], client: TorClient, notifier: NotificationDispatcher,
+               sink: ResultSink, history: CachedHistory, restart: Optional[Callable[[], None]] = restart_tor,
+               metrics: Optional[MetricsRecorder] = None, scheduler: Optional[RetryScheduler] = None,
+               cluster: Optional[Cluster] = None) -> Optional[Outcome]:
+    # the benchmarks pass a scheduler with a clock that skips the waits between attempts
+    # passing restart=None never restarts Tor, though it may still be asked for new circuits
+    # with a cluster, only the leader checks the main onion and updates the status; the other
+    # nodes check their share of the mirrors and return None
+    targets = get_targets(config)
+    policy = policy_from_config(config)
+    if cluster is not None:
+        cluster.heartbeat()
+        cluster.acquire()
+        targets = cluster.share(targets)
+        if not cluster.leader:
+            check_share(client, targets, policy, sink, metrics)
+            return None
+        if cluster.elected:
+            # the previous leader recorded the latest results, which the cache has not seen
+            with span('history.reconcile'):
+                history.reconcile()
+    controller = controller_from_config(config)
     attempts = 0
-    while attempts < 10:
+    results = []
+
+    def check() -> Tuple[bool, Optional[str]]:
+        nonlocal attempts, results
         attempts += 1
-        response = send_request(config['SECUREDROP_URL'])
-        passes_healthcheck = healthcheck(response)
-        if passes_healthcheck:
-            logger.info(f'Healthcheck: passed on attempt {attempts}')
-            upload_website_index(session, config, passes_healthcheck)
-            if get_uptime() < 1600:
-                send_message(config, passes_healthcheck)
-            elif hour_is_0900():
-                send_message(config, passes_healthcheck)
-            elif attempts > 3:
-                send_message(config, passes_healthcheck)
-            break
-        logger.info(f'Healthcheck: unable to reach site on attempt {attempts}')
-        # Restart tor service on second failure, and wait for 6 minutes before attempt 2, and total possible time taken
-        # to complete all attempts should be calculated to be less than (3600*number of runs per hour)
-        if attempts == 3:
-            logger.info('Healthcheck: rebuilding tor circuits')
-            os.popen('systemctl restart tor')
-            time.sleep(300)
-        time.sleep(80)
+        results = attempt_check(client, targets, policy, controller, sink, attempts)
+        return results[0].healthy, results[0].failure
+
+    scheduler = scheduler or create_scheduler(config, allow_restart=restart is not None or controller is not None)
+    outcome = scheduler.run(check, lambda: recover(controller, restart))
+    # the mirrors as of the last attempt
+    mirrors = record_mirrors(results[1:], sink, metrics)
+    report_outcome(session, config, history, notifier, outcome, results[0], metrics, cluster, mirrors)
+    return outcome
+
+
+def attempt_check(client: TorClient, targets: List[str], policy: HealthcheckPolicy,
+                  controller: Optional[TorController], sink: ResultSink, attempt: int) -> List[CheckResult]:
+    with span('attempt', attempt=attempt, targets=len(targets)) as current:
+        # mirrors are probed alongside the main onion but only the main onion decides the page state
+        results = check_targets(client, targets, policy, lambda target: diagnose(controller, target))
+        logger.info(f'Healthcheck results: {({result.target: result.status for result in results})}')
+        result = results[0]
+        current.set(status=result.status, failure=result.failure)
+    if result.error in ('socks', 'timeout', 'inconclusive'):
+        client.rotate_circuits()
+    sink.add(create_attempt_item(int(time.time()), attempt, result.healthy, result.failure, result))
+    return results
+
+
+def previous_unconfirmed(history: CachedHistory) -> bool:
+    with span('history.latest'):
+        latest = history.latest(limit=1)
+    return bool(latest) and latest[0]['Outcome'] == UNCONFIRMED_OUTCOME
+
+
+def report_outcome(session: Session, config: Dict[str, str], history: CachedHistory,
+                   notifier: NotificationDispatcher, outcome: Outcome, result: CheckResult,
+                   metrics: Optional[MetricsRecorder] = None, cluster: Optional[Cluster] = None,
+                   mirrors: Optional[List[Dict]] = None) -> None:
+    # result is the last attempt, the one the outcome was decided on, and mirrors the items
+    # recorded for the mirrors probed with it
+    if outcome.healthy:
+        logger.info(f'Healthcheck: passed on attempt {outcome.attempts}')
     else:
-        logger.info('Healthcheck: failed healthcheck')
-        upload_website_index(session, config, False)
-        send_message(config, passed=False)
-        send_failure_email(session, config)
+        logger.info(f'Healthcheck: failed healthcheck after {outcome.attempts} attempts (confirmed={outcome.confirmed})')
+
+    latency = result.elapsed if result.error is None else None
+    details = {'Attempts': outcome.attempts, 'Restarts': outcome.restarts, 'Status': result.status}
+    if latency is not None:
+        details['Latency'] = round(latency, 3)
+    if result.failure:
+        details['Failure'] = result.failure
+    # the lease is renewed first, so that a node that lost it meanwhile cannot race the new leader
+    if cluster is None or cluster.acquire():
+        if outcome.healthy or outcome.confirmed or previous_unconfirmed(history):
+            update_status(session, config, history, outcome.healthy, notifier, details)
+        else:
+            # the retry budget ran out on failures that may only be Tor's, the page stays as it
+            # is unless the next check fails the same way
+            logger.warning('Healthcheck: failure not confirmed, leaving the status as it is')
+            with span('history.record'):
+                history.record(create_unconfirmed_item(int(time.time()), details))
+        alert_mirrors(config, history, notifier, mirrors or [])
+    else:
+        logger.warning('Healthcheck: no longer the leader, leaving the status to the new one')
+    if metrics is not None:
+        metrics.record_check(outcome.healthy, latency, outcome.attempts, outcome.restarts, result.status,
+                             result.failure)
 
 
 if __name__ == '__main__':
 
+    PARSER = argparse.ArgumentParser(description='Check the SecureDrop onion site and update the status page.')
+    PARSER.add_argument('--daemon', action='store_true', help='keep running and check every --interval seconds')
+    PARSER.add_argument('--interval', type=float, default=30, help='seconds between checks in daemon mode')
+    ARGS = PARSER.parse_args()
+
     STAGE = get_stage('/etc/stage')
     AWS_PROFILE = 'infosec' if STAGE == 'DEV' else None
     SESSION = create_session(profile=AWS_PROFILE)
-    SSM_CLIENT = SESSION.client('ssm')
 
-    logger.info(f'Fetching configuration for stage={STAGE} and profile={AWS_PROFILE}')
+    if ARGS.daemon:
+        from src.daemon import MIN_INTERVAL, Daemon
+        sys.exit(Daemon(SESSION, STAGE, max(ARGS.interval, MIN_INTERVAL)).run())
 
-    CONFIG = {
-        'BUCKET_NAME': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/securedrop-public-bucket'),
-        'PRODMON_WEBHOOK': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-webhook'),
-        'PRODMON_SENDER': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-sender'),
-        'PRODMON_RECIPIENT': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-recipient'),
-        'PRODMON_REDEPLOY_URL': fetch_parameter(SSM_CLIENT, f'/secure-contact/{STAGE}/prodmon-redeploy-url'),
-        'SECUREDROP_URL': fetch_parameter(SSM_CLIENT, "securedrop-url"),
-        'SECUREDROP_URL_HUMAN': fetch_parameter(SSM_CLIENT, "securedrop-url-human"),
-        'TABLE_NAME': f'MonitorHistory-{STAGE}'
-    }
+    logger.info(f'Fetching configuration for stage={STAGE} and profile={AWS_PROFILE}')
 
-    if CONFIG['BUCKET_NAME'] is not None:
-        build_pages(CONFIG['SECUREDROP_URL'], CONFIG['SECUREDROP_URL_HUMAN'], STAGE)
+    # the whole run is one trace, see src/tracing.py
+    with span('cycle', stage=STAGE):
+        try:
+            CONFIG = create_config(SESSION, STAGE)
+        except MissingParameters as err:
+            logger.error(f'Unable to run the monitor: {err}')
+            sys.exit(1)
+
+        from securedrop import build_pages
+        with span('build_pages') as BUILD:
+            BUILT = build_pages(CONFIG['SECUREDROP_URL'], CONFIG['SECUREDROP_URL_HUMAN'], STAGE)
+            BUILD.set(changed=bool(BUILT))
+        if BUILT:
+            publish_pages(SESSION, CONFIG)
         run(SESSION, CONFIG)
@@ -1,13 +1,22 @@
+import atexit
 import json
 import logging.handlers
-from typing import Dict, List
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
-import requests
-from boto3 import Session
-from botocore.exceptions import ClientError
-from requests.exceptions import RequestException
+from botocore.exceptions import BotoCoreError, ClientError
+
+from src.scheduler import Backoff
+from src.state import state_path
+from src.tracing import current_span, span
 
 CHARSET = "UTF-8"
+DEFAULT_NOTIFICATION_STATE = state_path('notification-state.json')
 
 
 logging.basicConfig(level=logging.INFO,
@@ -58,25 +67,6 @@ def create_email(subject: str, heading: str, text: str):
     }
 
 
-def send_email(session: Session, config: Dict[str, str], message: Dict):
-    ses_client = session.client('ses')
-    sender = config['PRODMON_SENDER']
-    recipient = config['PRODMON_RECIPIENT']
-    try:
-        response = ses_client.send_email(
-            Destination={
-                'ToAddresses': [
-                    recipient,
-                ],
-            },
-            Message=message,
-            Source=f'SecureDrop Monitor <{sender}>',
-        )
-    except ClientError as e:
-        logger.error(e.response['Error']['Message'])
-    else:
-        logger.info(f'Email sent! Message ID: {response["MessageId"]}')
-
 def generate_message(card_title: str, card_subtitle: str, message_text: str, redeploy_url: str) -> Dict:
     return {
         "text": message_text,
@@ -111,16 +101,243 @@ def generate_message(card_title: str, card_subtitle: str, message_text: str, red
     }
 
 
-def send_message(config: Dict[str, str], passed: bool):
-    # TODO: message @all to notify when healthcheck fails
+class DeliveryError(Exception):
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class Notification(NamedTuple):
+    channel: str
+    # notifications with the same key are duplicates of each other
+    key: str
+    # one line describing the notification, used when a burst is coalesced into a summary
+    summary: str
+    payload: Dict
+
+
+class ChatChannel:
     headers = {'Content-Type': 'application/json; charset=UTF-8'}
-    status = 'Status: 💚💚💚' if passed else 'Status: 💔💔💔'
-    message_text = '' if passed else '*Attention <users/all> Healthcheck has failed*'
-    message_data = json.dumps(generate_message('SecureDrop Monitor', status, message_text, config['PRODMON_REDEPLOY_URL']))
 
-    try:
-        response = requests.post(url=config['PRODMON_WEBHOOK'], headers=headers, data=message_data)
+    def __init__(self, webhook: str, redeploy_url: str, http=None, timeout: Tuple[float, float] = (5, 15)):
+        self.webhook = webhook
+        self.redeploy_url = redeploy_url
+        self.http = http
+        self.timeout = timeout
+
+    def send(self, payload: Dict) -> None:
+        # requests is only imported once there is something to send
+        import requests
+        from requests.exceptions import RequestException
+
+        if self.http is None:
+            # one session keeps the connection to chat.googleapis.com open between messages
+            self.http = requests.Session()
+        try:
+            response = self.http.post(url=self.webhook, headers=self.headers, data=json.dumps(payload),
+                                      timeout=self.timeout)
+        except RequestException as err:
+            raise DeliveryError(str(err))
+        if response.status_code >= 400:
+            retryable = response.status_code == 429 or response.status_code >= 500
+            raise DeliveryError(f'status code {response.status_code} returned from chat.googleapis.com', retryable)
         logger.info(f'Message sent to Hangouts Chat!')
         logger.info(f'Status code {response.status_code} returned from chat.googleapis.com')
-    except RequestException as err:
-        logger.error(err)
+
+    def combine(self, notifications: List[Notification]) -> Dict:
+        # the latest card wins, with every message in the burst listed in its text
+        payload = dict(notifications[-1].payload)
+        texts = [notification.payload.get('text') for notification in notifications]
+        lines = list(dict.fromkeys(text for text in texts if text))
+        lines.extend(f'• {notification.summary}' for notification in notifications)
+        payload['text'] = '\n'.join(lines)
+        return payload
+
+
+class EmailChannel:
+    def __init__(self, client, sender: str, recipient: str):
+        self.client = client
+        self.sender = sender
+        self.recipient = recipient
+
+    def send(self, payload: Dict) -> None:
+        try:
+            response = self.client.send_email(
+                Destination={
+                    'ToAddresses': [
+                        self.recipient,
+                    ],
+                },
+                Message=payload,
+                Source=f'SecureDrop Monitor <{self.sender}>',
+            )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            raise DeliveryError(e.response['Error']['Message'], retryable=code in ('Throttling', 'ServiceUnavailable'))
+        except BotoCoreError as e:
+            raise DeliveryError(str(e))
+        logger.info(f'Email sent! Message ID: {response["MessageId"]}')
+
+    def combine(self, notifications: List[Notification]) -> Dict:
+        subject = notifications[-1].payload['Subject']['Data']
+        summaries = '<br>'.join(notification.summary for notification in notifications)
+        return create_email(f'{subject} (+{len(notifications) - 1} more)', 'SecureDrop Status Update', summaries)
+
+
+def status_notification(config: Dict[str, str], passed: bool) -> Notification:
+    # TODO: message @all to notify when healthcheck fails
+    status = 'Status: 💚💚💚' if passed else 'Status: 💔💔💔'
+    message_text = '' if passed else '*Attention <users/all> Healthcheck has failed*'
+    payload = generate_message('SecureDrop Monitor', status, message_text, config['PRODMON_REDEPLOY_URL'])
+    summary = 'Healthcheck passed' if passed else 'Healthcheck failed'
+    return Notification('chat', f'status#{passed}', summary, payload)
+
+
+def mirror_notification(config: Dict[str, str], down: List[str]) -> Notification:
+    status = 'Mirrors: 💚💚💚' if not down else f'Mirrors down: {", ".join(down)}'
+    payload = generate_message('SecureDrop Monitor', status, '', config['PRODMON_REDEPLOY_URL'])
+    summary = 'All mirrors up' if not down else f'{len(down)} mirrors down'
+    return Notification('chat', f'mirrors#{",".join(down)}', summary, payload)
+
+
+class NotificationDispatcher:
+    # Delivers notifications from a background thread so that a slow webhook or SES never holds up a
+    # healthcheck. Notifications identical to the last one sent on their channel are dropped within the
+    # suppression window, and the ones that arrive together are coalesced into a single summary.
+    def __init__(self, channels: Dict, suppress_for: float = 3600, coalesce_for: float = 5, retries: int = 3,
+                 backoff: Backoff = Backoff(initial=1, maximum=30), state_path: Optional[str] = None,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep,
+                 rng: Optional[random.Random] = None):
+        self.channels = channels
+        self.suppress_for = suppress_for
+        self.coalesce_for = coalesce_for
+        self.retries = retries
+        self.backoff = backoff
+        self.state_path = state_path
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker: Optional[threading.Thread] = None
+        self.delivered = self.failed = self.suppressed = 0
+        # channel -> (key, time) of the last notification sent, kept on disk so it spans cron runs
+        self.last_sent: Dict[str, Tuple[str, float]] = self.load_state()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_state(self) -> Dict[str, Tuple[str, float]]:
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path) as fobj:
+                return {channel: (key, float(sent)) for channel, (key, sent) in json.load(fobj).items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            logger.warning(f'ignoring unreadable notification state {self.state_path}: {err}')
+            return {}
+
+    def save_state(self) -> None:
+        if not self.state_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fobj:
+                json.dump(self.last_sent, fobj)
+            os.replace(fobj.name, self.state_path)
+        except OSError as err:
+            logger.warning(f'unable to save notification state {self.state_path}: {err}')
+
+    def notify(self, notification: Notification) -> bool:
+        # returns straight away; False when the notification was dropped
+        if notification.channel not in self.channels:
+            logger.warning(f'no channel configured for {notification.channel}, dropping {notification.key}')
+            return False
+        with self.lock:
+            now = self.clock()
+            last = self.last_sent.get(notification.channel)
+            if last and last[0] == notification.key and now - last[1] < self.suppress_for:
+                logger.info(f'suppressing duplicate {notification.channel} notification {notification.key}')
+                self.suppressed += 1
+                return False
+            self.last_sent[notification.channel] = (notification.key, now)
+            self.save_state()
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='notifications', daemon=True)
+                self.worker.start()
+                # only while there is a worker, so closed dispatchers are not kept alive until exit
+                atexit.register(self.close)
+        # with the span it was sent from, to trace the delivery as part of it
+        self.queue.put((notification, current_span()))
+        return True
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            # wait a little for the rest of a burst, unless we are shutting down
+            deadline = time.monotonic() + self.coalesce_for
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # anything queued before close() is still delivered, without waiting any longer
+                    stopping = True
+                    deadline = time.monotonic()
+                    continue
+                batch.append(item)
+            for channel in dict.fromkeys(notification.channel for notification, _ in batch):
+                queued = [(notification, parent) for notification, parent in batch if notification.channel == channel]
+                with span('notify', parent=queued[-1][1], channel=channel, notifications=len(queued)) as current:
+                    if not self.deliver(channel, [notification for notification, _ in queued]):
+                        current.fail('undelivered')
+
+    def deliver(self, channel: str, notifications: List[Notification]) -> bool:
+        sender = self.channels[channel]
+        payload = notifications[0].payload if len(notifications) == 1 else sender.combine(notifications)
+        if len(notifications) > 1:
+            logger.info(f'coalesced {len(notifications)} {channel} notifications into one')
+        for attempt in range(1, self.retries + 1):
+            try:
+                sender.send(payload)
+            except DeliveryError as err:
+                if not err.retryable or attempt == self.retries:
+                    logger.error(f'unable to deliver {channel} notification after {attempt} attempts: {err}')
+                    break
+                delay = self.backoff.delay(attempt, self.rng)
+                logger.warning(f'{channel} notification failed ({err}), retrying in {delay:.1f}s')
+                self.sleep(delay)
+            else:
+                self.delivered += 1
+                return True
+
+        self.failed += 1
+        with self.lock:
+            # an undelivered notification must not suppress the next identical one
+            last = self.last_sent.get(channel)
+            if last and last[0] == notifications[-1].key:
+                del self.last_sent[channel]
+                self.save_state()
+        return False
+
+    def close(self, timeout: float = 60) -> None:
+        # waits for queued notifications to be delivered, skipping the coalescing delay
+        with self.lock:
+            worker, self.worker = self.worker, None
+        if worker is None:
+            return
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        worker.join(timeout)
+        if worker.is_alive():
+            logger.error(f'notifications still pending after {timeout}s')
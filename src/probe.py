@@ -0,0 +1,509 @@
+import asyncio
+import codecs
+import logging
+import secrets
+import socket
+import ssl
+import time
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger('securecontact.probe')
+
+# N.B. probes require Tor to be running on the server
+TOR_PROXY = ('127.0.0.1', 9050)
+
+HEADERS = {
+    'User-agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0',
+    'referer': 'https://www.google.com'
+}
+
+SOCKS_ERRORS = {
+    1: 'general SOCKS server failure',
+    2: 'connection not allowed by ruleset',
+    3: 'network unreachable',
+    4: 'host unreachable',
+    5: 'connection refused',
+    6: 'TTL expired',
+    7: 'command not supported',
+    8: 'address type not supported',
+}
+
+# shared: every target reuses whatever circuits Tor already has open, which is fastest
+# target: each target gets its own SOCKS credentials, which Tor isolates onto independent circuits
+ISOLATION_MODES = ('shared', 'target')
+READ_SIZE = 16 * 1024
+
+
+class ProbeError(Exception):
+    # kind is one of: proxy (cannot reach the local Tor daemon), socks (Tor could not
+    # reach the target), timeout or protocol (the target sent something we cannot parse)
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+class Timings(NamedTuple):
+    # connect covers the TCP connection to Tor plus the SOCKS handshake, during which Tor
+    # builds the circuit to the onion; all values are zero for phases a reused connection skips
+    connect: float = 0.0
+    tls: float = 0.0
+    first_byte: float = 0.0
+    total: float = 0.0
+
+
+class ProbeResponse(NamedTuple):
+    target: str
+    status_code: Optional[int] = None
+    text: str = ''
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    timings: Timings = Timings()
+    reused: bool = False
+    # True when reading stopped at the marker or the byte cap, so text is only the start of the body
+    truncated: bool = False
+    # the DER encoded certificate of an https target
+    certificate: Optional[bytes] = None
+
+    # mirror requests.Response so that healthcheck() treats both the same way
+    def __bool__(self) -> bool:
+        return self.error is None and self.status_code is not None and self.status_code < 400
+
+
+class Connection(NamedTuple):
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    last_used: float
+    certificate: Optional[bytes] = None
+
+
+def split_target(target: str) -> Tuple[str, str, int, str]:
+    url = urlsplit(target if '://' in target else f'http://{target}')
+    path = url.path or '/'
+    if url.query:
+        path = f'{path}?{url.query}'
+    return url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80), path
+
+
+async def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b''
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ProbeError('proxy', 'SOCKS proxy closed the connection during the handshake')
+        data += chunk
+    return data
+
+
+async def socks5_connect(sock: socket.socket, host: str, port: int,
+                         username: Optional[str] = None, password: Optional[str] = None) -> None:
+    # the hostname is resolved by the proxy (socks5h), which is required for onion addresses
+    loop = asyncio.get_running_loop()
+    method = 2 if username is not None else 0
+    await loop.sock_sendall(sock, bytes([5, 1, method]))
+    version, chosen = await recv_exactly(sock, 2)
+    if version != 5 or chosen != method:
+        raise ProbeError('proxy', f'SOCKS proxy refused authentication method {method}')
+
+    if method == 2:
+        user, secret = username.encode(), (password or '').encode()
+        await loop.sock_sendall(sock, bytes([1, len(user)]) + user + bytes([len(secret)]) + secret)
+        _, status = await recv_exactly(sock, 2)
+        if status != 0:
+            raise ProbeError('proxy', 'SOCKS proxy rejected the credentials')
+
+    name = host.encode('idna')
+    await loop.sock_sendall(sock, bytes([5, 1, 0, 3, len(name)]) + name + port.to_bytes(2, 'big'))
+    _, reply, _, address_type = await recv_exactly(sock, 4)
+    if reply != 0:
+        raise ProbeError('socks', SOCKS_ERRORS.get(reply, f'SOCKS error {reply:#x}'))
+
+    if address_type == 1:
+        await recv_exactly(sock, 4 + 2)
+    elif address_type == 4:
+        await recv_exactly(sock, 16 + 2)
+    else:
+        length = (await recv_exactly(sock, 1))[0]
+        await recv_exactly(sock, length + 2)
+
+
+def response_charset(content_type: str) -> str:
+    # the charset parameter of e.g. text/html; charset=utf-8; format=flowed, when Python knows it
+    for parameter in content_type.split(';')[1:]:
+        name, _, value = parameter.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = value.strip().strip('"\'')
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                break
+    return 'utf-8'
+
+
+async def read_response(reader: asyncio.StreamReader, marker: Optional[bytes] = None,
+                        max_bytes: Optional[int] = None) -> Tuple[int, Dict[str, str], bytes, float, bool]:
+    # The body is read as it arrives and reading stops once it contains the marker or reaches
+    # max_bytes. The last value returned says whether reading stopped before the end of the body.
+    status_line = await reader.readline()
+    first_byte = time.monotonic()
+    if not status_line:
+        raise asyncio.IncompleteReadError(b'', None)
+    try:
+        _, status, *_ = status_line.decode('latin-1').split(' ', 2)
+        status_code = int(status)
+    except ValueError:
+        raise ProbeError('protocol', f'malformed status line: {status_line[:80]!r}')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = None
+    if headers.get('transfer-encoding', '').lower() != 'chunked' and 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ProbeError('protocol', f'malformed content-length: {headers["content-length"][:80]!r}')
+    elif headers.get('transfer-encoding', '').lower() != 'chunked':
+        headers['connection'] = 'close'
+
+    body = bytearray()
+    chunks = body_chunks(reader, headers, length)
+    try:
+        async for chunk in chunks:
+            body += chunk
+            if max_bytes is not None and len(body) >= max_bytes:
+                break
+            # a short remainder is still read so that the connection can be reused
+            found = marker is not None and marker in body[-(len(chunk) + len(marker)):]
+            if found and not (length is not None and max_bytes is not None and length <= max_bytes):
+                break
+        else:
+            return status_code, headers, bytes(body), first_byte, False
+    finally:
+        await chunks.aclose()
+
+    # the rest of the body is still on its way, so the connection cannot be used again
+    headers['connection'] = 'close'
+    return status_code, headers, bytes(body[:max_bytes]), first_byte, True
+
+
+async def body_chunks(reader: asyncio.StreamReader, headers: Dict[str, str],
+                      length: Optional[int]) -> AsyncIterator[bytes]:
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            line = await reader.readline()
+            try:
+                size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise ProbeError('protocol', f'malformed chunk size: {line[:80]!r}')
+            if size == 0:
+                await reader.readline()
+                return
+            chunk = await reader.readexactly(size)
+            await reader.readexactly(2)
+            yield chunk
+    elif length is not None:
+        remaining = length
+        while remaining:
+            chunk = await reader.read(min(remaining, READ_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class TorClient:
+    # Keeps HTTP connections through the Tor SOCKS proxy open between probes so that
+    # repeated attempts, and targets sharing an onion, skip the SOCKS handshake and
+    # circuit setup. The synchronous methods run on a loop owned by the client so
+    # that pooled connections survive between calls.
+    def __init__(self, proxy: Tuple[str, int] = TOR_PROXY, isolation: str = 'shared',
+                 max_idle: int = 4, idle_timeout: float = 60):
+        if isolation not in ISOLATION_MODES:
+            raise ValueError(f'unknown isolation mode: {isolation}')
+        self.proxy = proxy
+        self.isolation = isolation
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self._pool: Dict[tuple, List[Connection]] = {}
+        self._nonce = secrets.token_hex(8)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def credentials(self, host: str) -> Tuple[Optional[str], Optional[str]]:
+        # Tor's IsolateSOCKSAuth puts streams with different credentials on different circuits
+        if self.isolation == 'target':
+            return f'securecontact-{host}', self._nonce
+        return None, None
+
+    def rotate_circuits(self) -> None:
+        # new credentials force Tor onto fresh circuits for every subsequent probe
+        self._nonce = secrets.token_hex(8)
+        self._drop_pool()
+
+    async def _open(self, scheme: str, host: str, port: int) -> Tuple[Connection, float, float]:
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            try:
+                await loop.sock_connect(sock, self.proxy)
+            except OSError as err:
+                raise ProbeError('proxy', f'cannot connect to SOCKS proxy {self.proxy[0]}:{self.proxy[1]}: {err}')
+            await socks5_connect(sock, host, port, *self.credentials(host))
+        except BaseException:
+            sock.close()
+            raise
+        connected = time.monotonic()
+        self.opened += 1
+
+        context = None
+        if scheme == 'https':
+            # onion services commonly use self-signed certificates, the onion address authenticates the host
+            context = ssl.create_default_context()
+            if host.endswith('.onion'):
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        reader, writer = await asyncio.open_connection(
+            sock=sock, ssl=context, server_hostname=host if context else None
+        )
+        ssl_object = writer.get_extra_info('ssl_object')
+        certificate = ssl_object.getpeercert(binary_form=True) if ssl_object else None
+        connection = Connection(reader, writer, time.monotonic(), certificate)
+        return connection, connected - start, time.monotonic() - connected
+
+    def _checkout(self, key: tuple) -> Optional[Connection]:
+        idle = self._pool.get(key, [])
+        while idle:
+            connection = idle.pop()
+            expired = time.monotonic() - connection.last_used > self.idle_timeout
+            if expired or connection.writer.is_closing() or connection.reader.at_eof():
+                connection.writer.close()
+                continue
+            self.reused += 1
+            return connection
+        return None
+
+    def _checkin(self, key: tuple, connection: Connection) -> None:
+        idle = self._pool.setdefault(key, [])
+        if len(idle) < self.max_idle:
+            idle.append(connection._replace(last_used=time.monotonic()))
+        else:
+            connection.writer.close()
+
+    def _drop_pool(self) -> None:
+        for idle in self._pool.values():
+            for connection in idle:
+                connection.writer.close()
+        self._pool.clear()
+
+    async def fetch(self, target: str, marker: Optional[bytes] = None,
+                    max_bytes: Optional[int] = None) -> ProbeResponse:
+        scheme, host, port, path = split_target(target)
+        key = (scheme, host, port, self.credentials(host))
+        connection = self._checkout(key)
+        try:
+            if connection is not None:
+                try:
+                    return await self._request(target, key, connection, host, path, marker, max_bytes)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    # the server closed the idle connection under us, try once more on a fresh one
+                    pass
+            return await self._request(target, key, None, host, path, marker, max_bytes)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise ProbeError('protocol', 'connection closed before the response was complete')
+
+    async def _request(self, target: str, key: tuple, connection: Optional[Connection], host: str, path: str,
+                       marker: Optional[bytes] = None, max_bytes: Optional[int] = None) -> ProbeResponse:
+        start = time.monotonic()
+        connect = tls = 0.0
+        reused = connection is not None
+        if connection is None:
+            connection, connect, tls = await self._open(*key[:3])
+
+        keep = False
+        try:
+            request_headers = ''.join(f'{name}: {value}\r\n' for name, value in HEADERS.items())
+            connection.writer.write(
+                f'GET {path} HTTP/1.1\r\nHost: {host}\r\n{request_headers}Connection: keep-alive\r\n\r\n'.encode()
+            )
+            sent = time.monotonic()
+            await connection.writer.drain()
+            status_code, headers, body, first_byte, truncated = await read_response(
+                connection.reader, marker, max_bytes
+            )
+            keep = headers.get('connection', '').lower() != 'close'
+        finally:
+            if keep:
+                self._checkin(key, connection)
+            else:
+                connection.writer.close()
+
+        finished = time.monotonic()
+        timings = Timings(connect=connect, tls=tls, first_byte=first_byte - sent, total=finished - start)
+        logger.info(f'{target}: connect={timings.connect:.3f}s tls={timings.tls:.3f}s '
+                    f'first_byte={timings.first_byte:.3f}s total={timings.total:.3f}s reused={reused}')
+        return ProbeResponse(
+            target=target,
+            status_code=status_code,
+            text=body.decode(response_charset(headers.get('content-type', '')), errors='replace'),
+            elapsed=timings.total,
+            timings=timings,
+            reused=reused,
+            truncated=truncated,
+            certificate=connection.certificate
+        )
+
+    async def probe(self, target: str, timeout: float, limit: asyncio.Semaphore, target_limit: asyncio.Semaphore,
+                    marker: Optional[bytes] = None, max_bytes: Optional[int] = None) -> ProbeResponse:
+        start = time.monotonic()
+        async with limit, target_limit:
+            try:
+                return await asyncio.wait_for(self.fetch(target, marker, max_bytes), timeout)
+            except asyncio.TimeoutError:
+                error = ProbeError('timeout', f'no response within {timeout}s')
+            except ProbeError as err:
+                error = err
+            except OSError as err:
+                error = ProbeError('socks', str(err))
+            except (ValueError, LookupError) as err:
+                # anything else the target sent that we could not make sense of
+                error = ProbeError('protocol', str(err))
+        logger.error(f'{target}: {error}')
+        return ProbeResponse(target=target, elapsed=time.monotonic() - start, error=error.kind)
+
+    async def sweep_async(self, targets: Sequence[str], timeout: float = 15,
+                          timeouts: Optional[Dict[str, float]] = None, limit: int = 10,
+                          per_target_limit: int = 1, marker: Optional[bytes] = None,
+                          max_bytes: Optional[int] = None) -> List[ProbeResponse]:
+        # every target is probed concurrently, so a sweep takes as long as the slowest probe
+        timeouts = timeouts or {}
+        overall = asyncio.Semaphore(limit)
+        per_target = {target: asyncio.Semaphore(per_target_limit) for target in targets}
+        return list(await asyncio.gather(*[
+            self.probe(target, timeouts.get(target, timeout), overall, per_target[target], marker, max_bytes)
+            for target in targets
+        ]))
+
+    def sweep(self, targets: Sequence[str], **kwargs) -> List[ProbeResponse]:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.sweep_async(targets, **kwargs))
+
+    def get(self, target: str, timeout: float = 15, **kwargs) -> ProbeResponse:
+        return self.sweep([target], timeout=timeout, **kwargs)[0]
+
+    def close(self) -> None:
+        self._drop_pool()
+        if self._loop is not None:
+            # give the transports a chance to close before the loop goes away
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+            self._loop = None
+
+
+def parse_proxy(value: str) -> Tuple[str, int]:
+    # host:port, or just the port of a proxy on localhost
+    host, _, port = value.strip().rpartition(':')
+    return host or TOR_PROXY[0], int(port)
+
+
+def parse_quorum(value: str) -> Tuple[int, int]:
+    # e.g. 2/3, two out of three vantage points have to agree
+    quorum, _, vantages = value.partition('/')
+    quorum, vantages = int(quorum), int(vantages)
+    # with a majority the two verdicts can never both reach the quorum
+    if not vantages / 2 < quorum <= vantages:
+        raise ValueError(f'a quorum of {quorum} out of {vantages} is not a majority')
+    return quorum, vantages
+
+
+class QuorumClient:
+    # Probes every target from several vantage points at once. Each vantage point is a
+    # TorClient with its own SOCKS credentials, which Tor puts on circuits of their own; given
+    # several proxies, the vantage points are spread over those separate Tor instances. The
+    # vantage points share one loop, so their sweeps run in parallel and a round takes as long
+    # as the slowest of them.
+    def __init__(self, quorum: int, vantages: int, proxies: Sequence[Tuple[str, int]] = (TOR_PROXY,), **kwargs):
+        self.quorum = quorum
+        self.clients = [TorClient(proxies[index % len(proxies)], isolation='target', **kwargs)
+                        for index in range(vantages)]
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, coroutine):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coroutine)
+
+    async def sweep_all_async(self, targets: Sequence[str],
+                              decided: Optional[Callable[[List[List[ProbeResponse]]], bool]] = None,
+                              **kwargs) -> List[List[ProbeResponse]]:
+        # The responses of every vantage point, in the order of the vantage points. Once decided
+        # returns True for the sweeps finished so far, the others are cancelled and their
+        # responses have the error cancelled, so that a slow circuit does not hold up a verdict.
+        tasks = [asyncio.ensure_future(client.sweep_async(targets, **kwargs)) for client in self.clients]
+        pending = set(tasks)
+        while pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending and decided is not None and decided([task.result() for task in tasks if task.done()]):
+                break
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return [[ProbeResponse(target, error='cancelled') for target in targets] if task.cancelled() else task.result()
+                for task in tasks]
+
+    def sweep_all(self, targets: Sequence[str], **kwargs) -> List[List[ProbeResponse]]:
+        return self._run(self.sweep_all_async(targets, **kwargs))
+
+    def sweep(self, targets: Sequence[str], vantage: int = 0, **kwargs) -> List[ProbeResponse]:
+        return self._run(self.clients[vantage].sweep_async(targets, **kwargs))
+
+    def get(self, target: str, timeout: float = 15, vantage: int = 0, **kwargs) -> ProbeResponse:
+        return self.sweep([target], vantage, timeout=timeout, **kwargs)[0]
+
+    def rotate_circuits(self) -> None:
+        for client in self.clients:
+            client.rotate_circuits()
+
+    def close(self) -> None:
+        for client in self.clients:
+            client.close()
+        if self._loop is not None:
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+            self._loop = None
+
+
+def probe_targets(targets: Sequence[str], proxy: Tuple[str, int] = TOR_PROXY, **kwargs) -> List[ProbeResponse]:
+    with TorClient(proxy) as client:
+        return client.sweep(targets, **kwargs)
@@ -0,0 +1,191 @@
+import base64
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+logger = logging.getLogger('securecontact.publish')
+
+# the status page has to change quickly when SecureDrop goes down
+PAGE_CACHE_CONTROL = 'public, max-age=60'
+# content-hashed assets never change under the same name
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DIGEST_METADATA = 'content-sha256'
+COMPRESSIBLE_TYPES = ('text/', 'image/svg+xml', 'application/javascript', 'application/json')
+# every rendered page is kept under its content hash, and the status page only points at one
+VARIANT_PREFIX = 'pages/'
+HTML_CONTENT_TYPE = 'text/html; charset=utf-8'
+# the public bucket expires objects a week after they were last written, see its lifecycle
+# rule in cloudformation/secure-contact-lambda.yaml, so unchanged objects are written again
+# once they are this old
+REFRESH_AGE = timedelta(days=1)
+
+
+class PublishResult(NamedTuple):
+    key: str
+    published: bool
+    # the HTTP status code AWS returned for the request that decided the outcome, None if it failed
+    status_code: Optional[int]
+    digest: str
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status_code is not None and self.status_code < 300
+
+
+def content_digest(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def compress(body: bytes) -> bytes:
+    # a fixed mtime keeps the output, and so the ETag, identical for identical input
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def is_current(client, bucket: str, key: str, digest: str, payload_md5: str,
+               max_age: timedelta = REFRESH_AGE) -> Optional[int]:
+    # returns the HEAD status code when the live object already matches, and is recent enough, None otherwise
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.warning(f'unable to check s3://{bucket}/{key}: {err}')
+        return None
+    except BotoCoreError as err:
+        logger.warning(f'unable to check s3://{bucket}/{key}: {err}')
+        return None
+
+    # objects uploaded before the digest metadata existed can still be matched on their ETag
+    if head.get('Metadata', {}).get(DIGEST_METADATA) != digest and head.get('ETag', '').strip('"') != payload_md5:
+        return None
+    modified = head.get('LastModified')
+    if modified is not None and datetime.now(timezone.utc) - modified > max_age:
+        logger.info(f's3://{bucket}/{key} was last written at {modified:%Y-%m-%d %H:%M}, writing it again')
+        return None
+    return head['ResponseMetadata']['HTTPStatusCode']
+
+
+def publish_object(client, bucket: str, key: str, body: bytes, content_type: str,
+                   cache_control: str = PAGE_CACHE_CONTROL, gzipped: bool = True) -> PublishResult:
+    digest = content_digest(body)
+    payload = compress(body) if gzipped else body
+    payload_md5 = hashlib.md5(payload)
+
+    status_code = is_current(client, bucket, key, digest, payload_md5.hexdigest())
+    if status_code is not None:
+        logger.info(f's3://{bucket}/{key} is up to date, skipping upload')
+        return PublishResult(key, False, status_code, digest)
+
+    extra = {'ContentEncoding': 'gzip'} if gzipped else {}
+    try:
+        response = client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=payload,
+            ContentType=content_type,
+            CacheControl=cache_control,
+            ContentMD5=base64.b64encode(payload_md5.digest()).decode(),
+            Metadata={DIGEST_METADATA: digest},
+            **extra
+        )
+    except (BotoCoreError, ClientError) as err:
+        logger.error(f'unable to upload s3://{bucket}/{key}: {err}')
+        return PublishResult(key, False, None, digest)
+
+    status_code = response['ResponseMetadata']['HTTPStatusCode']
+    logger.info(f'uploaded s3://{bucket}/{key} ({len(payload)} bytes), status code {status_code}')
+    return PublishResult(key, True, status_code, digest)
+
+
+def publish_file(client, bucket: str, key: str, file_name: str, content_type: str, **kwargs) -> PublishResult:
+    with open(file_name, 'rb') as fobj:
+        return publish_object(client, bucket, key, fobj.read(), content_type, **kwargs)
+
+
+def publish_assets(client, bucket: str, static_dir: str, prefix: str = 'static/') -> List[PublishResult]:
+    # the pages link to their assets, so these have to be in place before a page is published
+    from assets import is_hashed
+
+    results = []
+    for name in sorted(os.listdir(static_dir)):
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        cache_control = ASSET_CACHE_CONTROL if is_hashed(name) else PAGE_CACHE_CONTROL
+        results.append(publish_file(
+            client, bucket, prefix + name, os.path.join(static_dir, name), content_type,
+            cache_control=cache_control, gzipped=content_type.startswith(COMPRESSIBLE_TYPES)
+        ))
+    return results
+
+
+def variant_key(body: bytes, prefix: str = VARIANT_PREFIX) -> str:
+    return f'{prefix}{content_digest(body)[:16]}.html'
+
+
+def publish_variants(client, bucket: str, file_names: List[str]) -> Dict[str, PublishResult]:
+    # uploads each page under its content hash, where it never changes, so each is only uploaded once
+    results = {}
+    for file_name in file_names:
+        with open(file_name, 'rb') as fobj:
+            body = fobj.read()
+        results[file_name] = publish_object(client, bucket, variant_key(body), body, HTML_CONTENT_TYPE,
+                                            cache_control=ASSET_CACHE_CONTROL)
+    return results
+
+
+def switch_pointer(client, bucket: str, key: str, body: bytes, redirect: Optional[str] = None) -> PublishResult:
+    # Points key at the variant of body that publish_variants uploaded, with a single request
+    # that carries no page: a server side copy, or with redirect an empty object that the S3
+    # website endpoint answers with a redirect to that location. Raises the ClientError when
+    # the variant is missing, so that the caller can upload it.
+    digest = content_digest(body)
+    source = variant_key(body)
+    # only a copy has the page's ETag, a redirect is matched on its digest
+    payload_md5 = hashlib.md5(compress(body)).hexdigest() if redirect is None else ''
+    status_code = is_current(client, bucket, key, digest, payload_md5)
+    if status_code is not None:
+        logger.info(f's3://{bucket}/{key} already points at {source}, skipping switch')
+        return PublishResult(key, False, status_code, digest)
+
+    try:
+        if redirect is None:
+            # the metadata is replaced, as the variant is cached for a year and the status page is not
+            response = client.copy_object(
+                Bucket=bucket,
+                Key=key,
+                CopySource={'Bucket': bucket, 'Key': source},
+                MetadataDirective='REPLACE',
+                ContentType=HTML_CONTENT_TYPE,
+                ContentEncoding='gzip',
+                CacheControl=PAGE_CACHE_CONTROL,
+                Metadata={DIGEST_METADATA: digest}
+            )
+        else:
+            # unlike a copy, a redirect would happily point at a variant that is not there
+            client.head_object(Bucket=bucket, Key=source)
+            response = client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=b'',
+                ContentType=HTML_CONTENT_TYPE,
+                CacheControl=PAGE_CACHE_CONTROL,
+                WebsiteRedirectLocation=redirect,
+                Metadata={DIGEST_METADATA: digest}
+            )
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise
+        logger.error(f'unable to point s3://{bucket}/{key} at {source}: {err}')
+        return PublishResult(key, False, None, digest)
+    except BotoCoreError as err:
+        logger.error(f'unable to point s3://{bucket}/{key} at {source}: {err}')
+        return PublishResult(key, False, None, digest)
+
+    status_code = response['ResponseMetadata']['HTTPStatusCode']
+    logger.info(f'pointed s3://{bucket}/{key} at {source}, status code {status_code}')
+    return PublishResult(key, True, status_code, digest)
@@ -0,0 +1,142 @@
+import logging
+import random
+import time
+from typing import Callable, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger('securecontact.scheduler')
+
+# failures where the onion answered but the answer was wrong, or Tor found no descriptor
+# for it; anything else (proxy, tor, socks, timeout, protocol, inconclusive) may be Tor or
+# the network and is worth retrying
+CONFIRMED_FAILURES = ('http', 'descriptor')
+# failures of the local Tor daemon rather than of the circuits it built
+LOCAL_FAILURES = ('proxy', 'tor')
+
+
+class Clock:
+    def now(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+
+class Backoff(NamedTuple):
+    initial: float = 5
+    factor: float = 2
+    maximum: float = 120
+    # each delay is randomised by up to this fraction in either direction
+    jitter: float = 0.2
+
+    def delay(self, attempt: int, rng: random.Random) -> float:
+        base = min(self.maximum, self.initial * self.factor ** (attempt - 1))
+        return base * rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class TorRestartPolicy(NamedTuple):
+    enabled: bool = True
+    # consecutive failures to reach the local SOCKS port, which points at Tor itself
+    proxy_failures: int = 2
+    # consecutive failures to reach the onion through Tor
+    circuit_failures: int = 4
+    settle: float = 30
+    # new circuits after SIGNAL NEWNYM are ready within seconds
+    renew_settle: float = 5
+    max_restarts: int = 1
+
+    def should_restart(self, kind: Optional[str], streak: int, restarts: int) -> bool:
+        if not self.enabled or restarts >= self.max_restarts:
+            return False
+        if kind in LOCAL_FAILURES:
+            return streak >= self.proxy_failures
+        return kind in ('socks', 'timeout') and streak >= self.circuit_failures
+
+
+class Outcome(NamedTuple):
+    healthy: bool
+    attempts: int
+    # False when the budget ran out before a definite answer
+    confirmed: bool
+    restarts: int
+    elapsed: float
+    # times Tor was asked for new circuits instead of being restarted
+    renewals: int = 0
+
+
+class RetryState(NamedTuple):
+    # how far a run of attempts has got, which the Lambda handler carries between invocations
+    start: float
+    attempts: int = 0
+    restarts: int = 0
+    renewals: int = 0
+    # consecutive failures of the same kind
+    streak: int = 0
+    last_kind: Optional[str] = None
+
+
+# enough for a few attempts, their backoff and a Tor restart, however often the checks run
+MIN_BUDGET = 300
+
+
+def budget_from_interval(interval: float, share: float = 0.5, minimum: float = MIN_BUDGET) -> float:
+    # leave the rest of the cron interval free so runs never overlap; a daemon checking more
+    # often than that skips the ticks a check runs over
+    return max(interval * share, minimum)
+
+
+class RetryScheduler:
+    def __init__(self, budget: float, backoff: Backoff = Backoff(), restart: TorRestartPolicy = TorRestartPolicy(),
+                 confirm_failures: int = 2, clock: Optional[Clock] = None, rng: Optional[random.Random] = None):
+        self.budget = budget
+        self.backoff = backoff
+        self.restart = restart
+        self.confirm_failures = confirm_failures
+        self.clock = clock or Clock()
+        self.rng = rng or random.Random()
+
+    def run(self, check: Callable[[], Tuple[bool, Optional[str]]],
+            restart_tor: Callable[[], Optional[bool]] = lambda: None) -> Outcome:
+        # restart_tor returns False when it only renewed the circuits
+        state = RetryState(self.clock.now())
+        while True:
+            state, outcome, delay = self.attempt(state, check, restart_tor)
+            if outcome is not None:
+                return outcome
+            self.clock.sleep(delay)
+
+    def attempt(self, state: RetryState, check: Callable[[], Tuple[bool, Optional[str]]],
+                restart_tor: Callable[[], Optional[bool]] = lambda: None) -> Tuple[RetryState, Optional[Outcome], float]:
+        # One attempt, with the outcome once there is one, or else the wait before the next. Run
+        # does the waiting itself; the Lambda handler is invoked again when the wait is over.
+        attempts = state.attempts + 1
+        restarts, renewals = state.restarts, state.renewals
+        attempt_start = self.clock.now()
+        healthy, kind = check()
+        elapsed = self.clock.now() - state.start
+        if healthy:
+            logger.info(f'attempt {attempts}: healthy')
+            return state, Outcome(True, attempts, True, restarts, elapsed, renewals), 0
+
+        streak = state.streak + 1 if kind == state.last_kind else 1
+        logger.info(f'attempt {attempts}: failed with {kind} ({streak} in a row)')
+        if kind in CONFIRMED_FAILURES and streak >= self.confirm_failures:
+            return state, Outcome(False, attempts, True, restarts, elapsed, renewals), 0
+
+        delay = self.backoff.delay(attempts, self.rng)
+        if self.restart.should_restart(kind, streak, restarts):
+            logger.info('recovering tor')
+            if restart_tor() is False:
+                renewals += 1
+                delay = max(delay, self.restart.renew_settle)
+            else:
+                restarts += 1
+                delay = max(delay, self.restart.settle)
+            streak = 0
+
+        # stop early if there is no time left for the wait and another attempt like the last one
+        attempt_time = self.clock.now() - attempt_start
+        if self.clock.now() + delay + attempt_time > state.start + self.budget:
+            logger.info(f'retry budget of {self.budget}s exhausted after {attempts} attempts')
+            return state, Outcome(False, attempts, False, restarts, self.clock.now() - state.start, renewals), 0
+        return RetryState(state.start, attempts, restarts, renewals, streak, kind), None, delay
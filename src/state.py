@@ -0,0 +1,12 @@
+import os
+
+
+# The caches and state the monitor keeps between runs are all in one directory, by default the
+# working directory: /secure-contact, which cron runs the monitor from, or /tmp/secure-contact
+# in Lambda. SECURE_CONTACT_STATE_DIR moves them elsewhere.
+STATE_DIR_VARIABLE = 'SECURE_CONTACT_STATE_DIR'
+STATE_DIR = os.environ.get(STATE_DIR_VARIABLE, '')
+
+
+def state_path(name: str) -> str:
+    return os.path.join(STATE_DIR, name)
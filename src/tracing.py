@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+# bound here, so that tests patching time.time do not also patch the spans
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+# imported when profiling is enabled, everything is imported by the monitor on every run
+if TYPE_CHECKING:
+    import cProfile
+
+
+logger = logging.getLogger('securecontact.trace')
+
+# Every finished span is logged as one line of JSON on the securecontact.trace logger, so it
+# ends up in the cron log with everything else:
+#
+#   python -m src.tracing --runs 20
+#
+# summarises the slowest stages of the last runs in that log. Setting SECURE_CONTACT_PROFILE
+# to a directory also runs cProfile for every run, and saves the stats there as
+# <trace id>.prof, for python -m pstats or snakeviz.
+PROFILE_VARIABLE = 'SECURE_CONTACT_PROFILE'
+# where the crontab in the CloudFormation UserData sends the output of each run
+DEFAULT_LOG = '/secure-contact/cron-lastrun.log'
+
+
+def new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[Dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time()
+        self.duration: Optional[float] = None
+        # ok or error
+        self.status = 'ok'
+        self.error: Optional[str] = None
+        self._started = perf_counter()
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def fail(self, error: str) -> None:
+        # for stages that handle their own errors rather than raise them
+        self.status = 'error'
+        self.error = error
+
+    def record(self) -> Dict:
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 3),
+            'duration': round(self.duration, 6) if self.duration is not None else None,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar('securecontact_span', default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def start_profile() -> Optional['cProfile.Profile']:
+    # cProfile only sees the thread it was started on, and only one can run at a time
+    if not os.environ.get(PROFILE_VARIABLE) or threading.current_thread() is not threading.main_thread():
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as err:
+        logger.warning(f'unable to start the profiler: {err}')
+        return None
+    return profiler
+
+
+def save_profile(profiler: 'cProfile.Profile', current: Span) -> None:
+    profiler.disable()
+    directory = os.environ[PROFILE_VARIABLE]
+    path = os.path.join(directory, f'{current.trace_id}.prof')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(path)
+    except OSError as err:
+        logger.warning(f'unable to save the profile to {path}: {err}')
+    else:
+        current.set(profile=path)
+
+
+@contextlib.contextmanager
+def span(name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+    # A span started outside any other starts a new trace, and is profiled when enabled. Work
+    # handed to another thread passes the span it was handed over from as the parent.
+    parent = parent or _current.get()
+    current = Span(name, parent.trace_id if parent else new_id(16), parent.span_id if parent else None,
+                   attributes)
+    token = _current.set(current)
+    profiler = start_profile() if parent is None else None
+    try:
+        yield current
+    except BaseException as err:
+        current.fail(f'{type(err).__name__}: {err}')
+        raise
+    finally:
+        current.duration = perf_counter() - current._started
+        _current.reset(token)
+        if profiler is not None:
+            save_profile(profiler, current)
+        logger.info(json.dumps(current.record(), default=str, sort_keys=True))
+
+
+def traced(name: str) -> Callable:
+    # runs every call of the decorated function in a span of its own
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_spans(lines: Iterable[str]) -> List[Dict]:
+    # the spans in a log, with whatever the log format put in front of each of them
+    spans = []
+    for line in lines:
+        if logger.name not in line or '{' not in line:
+            continue
+        try:
+            record = json.loads(line[line.index('{'):])
+        except ValueError:
+            continue
+        if isinstance(record, dict) and 'trace' in record and 'name' in record:
+            spans.append(record)
+    return spans
+
+
+class StageSummary(NamedTuple):
+    name: str
+    # the number of spans, and the runs they were in
+    count: int
+    runs: int
+    total: float
+    mean: float
+    p50: float
+    max: float
+    errors: int
+
+
+def summarise(spans: List[Dict], runs: int = 10, root: str = 'cycle') -> List[StageSummary]:
+    # the stages of the last runs, a run being a trace with a root span of that name, slowest first
+    roots = sorted((record for record in spans if record['parent'] is None and record['name'] == root),
+                   key=lambda record: record['start'])[-runs:]
+    traces = {record['trace'] for record in roots}
+    stages: Dict[str, List[Dict]] = {}
+    for record in spans:
+        if record['trace'] in traces and record.get('duration') is not None:
+            stages.setdefault(record['name'], []).append(record)
+    summaries = []
+    for name, records in stages.items():
+        durations = sorted(record['duration'] for record in records)
+        middle = len(durations) // 2
+        median = durations[middle] if len(durations) % 2 else (durations[middle - 1] + durations[middle]) / 2
+        summaries.append(StageSummary(
+            name, len(records), len({record['trace'] for record in records}), sum(durations),
+            sum(durations) / len(durations), median, durations[-1],
+            sum(record['status'] == 'error' for record in records)
+        ))
+    return sorted(summaries, key=lambda summary: summary.total, reverse=True)
+
+
+def report(summaries: List[StageSummary], runs: int) -> None:
+    print(f'{"stage":<20} {"runs":>5} {"spans":>6} {"total (s)":>10} {"mean (s)":>9} {"p50 (s)":>8} '
+          f'{"max (s)":>8} {"errors":>7}')
+    for summary in summaries:
+        print(f'{summary.name:<20} {summary.runs:>5} {summary.count:>6} {summary.total:>10.3f} '
+              f'{summary.mean:>9.3f} {summary.p50:>8.3f} {summary.max:>8.3f} {summary.errors:>7}')
+    if summaries:
+        # every stage is within the cycle, so the cycle itself tops the list
+        print(f'{min(runs, summaries[0].runs)} runs')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Summarise the slowest stages of the last monitor runs.')
+    parser.add_argument('--log', default=DEFAULT_LOG, help='the log the monitor writes its spans to')
+    parser.add_argument('--runs', type=int, default=10, help='how many of the last runs to summarise')
+    parser.add_argument('--root', default='cycle', help='the span that covers a whole run')
+    args = parser.parse_args()
+
+    try:
+        with open(args.log, errors='replace') as fobj:
+            spans = read_spans(fobj)
+    except OSError as err:
+        print(f'unable to read {args.log}: {err}', file=sys.stderr)
+        return 1
+    summaries = summarise(spans, args.runs, args.root)
+    if not summaries:
+        print(f'no {args.root} spans in {args.log}', file=sys.stderr)
+        return 1
+    report(summaries, args.runs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from assets import (STYLESHEETS, Used, build_assets, build_stylesheet, is_critical, is_hashed, minify,
+                    selector_is_used)
+from securedrop import STATIC_DIR, build_pages
+
+ONION = 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion'
+HUMAN = 'theguardian.securedrop.tor.onion'
+# what the browser has to download or parse before the page is styled
+CSS_BUDGET = 15 * 1024
+
+
+class TestAssets(unittest.TestCase):
+    def test_selector_is_used(self):
+        used = Used({'html', 'body', 'a', 'p'}, {'sd-status', 'container'}, {'main'})
+        self.assertTrue(selector_is_used('.sd-status', used))
+        self.assertTrue(selector_is_used('.container > p a:hover', used))
+        self.assertTrue(selector_is_used('#main[data-x="y"]', used))
+        self.assertFalse(selector_is_used('.btn', used))
+        self.assertFalse(selector_is_used('table td', used))
+        self.assertFalse(selector_is_used('.container .card', used))
+
+    def test_minify(self):
+        self.assertEqual('a:hover>b', minify('a:hover > b'))
+        self.assertEqual('color:red;content:"a  b"', minify(' color : red ;\n content: "a  b"', declarations=True))
+
+    def test_is_critical(self):
+        self.assertTrue(is_critical('.sd-status__message'))
+        self.assertFalse(is_critical('.container'))
+
+    def test_purges_unused_rules_and_keyframes(self):
+        css = ('/*! licence */ .used{color:red} .unused{color:blue} '
+               '@media (min-width:600px){.unused{margin:0}.used{margin:1px}} '
+               '@keyframes spin{to{transform:rotate(1turn)}} @keyframes fade{to{opacity:0}} '
+               '.used span{animation:fade 1s} .sd-status{display:block}')
+        page = '<div class="used sd-status"><span>hi</span></div>'
+        stylesheet = build_stylesheet([css], [page])
+        self.assertTrue(stylesheet.css.startswith('/*! licence */'))
+        self.assertIn('.used{color:red}', stylesheet.css)
+        self.assertIn('@media (min-width:600px){.used{margin:1px}}', stylesheet.css)
+        self.assertNotIn('.unused', stylesheet.css)
+        self.assertIn('@keyframes fade', stylesheet.css)
+        self.assertNotIn('spin', stylesheet.css)
+        self.assertEqual('.sd-status{display:block}', stylesheet.critical)
+
+    def test_replaces_previous_stylesheet(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            first = build_assets(STATIC_DIR, output_dir, ['<p class="sd-status"></p>'])
+            second = build_assets(STATIC_DIR, output_dir, ['<p class="sd-status container"></p>'])
+            self.assertNotEqual(first.stylesheet, second.stylesheet)
+            self.assertEqual([second.stylesheet], [name for name in os.listdir(output_dir) if is_hashed(name)])
+            self.assertFalse(any(name in os.listdir(output_dir) for name in STYLESHEETS))
+
+    def test_css_size_budget(self):
+        with tempfile.TemporaryDirectory() as build_dir:
+            build_pages(ONION, HUMAN, 'PROD', build_dir)
+            static_dir = os.path.join(build_dir, 'static')
+            stylesheets = [name for name in os.listdir(static_dir) if name.endswith('.css')]
+            self.assertEqual(1, len(stylesheets))
+            self.assertTrue(is_hashed(stylesheets[0]))
+            with open(os.path.join(build_dir, 'index.html')) as fobj:
+                index = fobj.read()
+            self.assertIn(f'href="/securedrop/static/{stylesheets[0]}"', index)
+            self.assertIn('<style>', index)
+
+            size = os.path.getsize(os.path.join(static_dir, stylesheets[0]))
+            inline = index[index.index('<style>'):index.index('</style>')]
+            self.assertLess(size + len(inline), CSS_BUDGET)
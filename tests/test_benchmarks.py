@@ -0,0 +1,50 @@
+import random
+import unittest
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+from benchmarks.bench_cycle import Harness, Scenario, VirtualClock, compare, working_directory
+from benchmarks.fakes import FakeDynamoDB, FakeS3, FaultInjector, Faults
+
+
+class TestFaultInjector(unittest.TestCase):
+    def test_injects_faults(self):
+        clock = VirtualClock()
+        s3 = FaultInjector(FakeS3(), Faults(latency=0.5, error_rate=1.0), random.Random(1), sleep=clock.sleep)
+        with self.assertRaises(ClientError) as context:
+            s3.put_object(Bucket='bucket', Key='index.html', Body=b'')
+        self.assertEqual('ServiceUnavailable', context.exception.response['Error']['Code'])
+        self.assertEqual(0.5, clock.skipped)
+
+        s3 = FaultInjector(FakeS3(), Faults(timeout_rate=1.0, timeout=5), random.Random(1), sleep=clock.sleep)
+        with self.assertRaises(ReadTimeoutError):
+            s3.head_object(Bucket='bucket', Key='index.html')
+        self.assertEqual(5.5, clock.skipped)
+
+    def test_logs_nested_calls(self):
+        dynamodb = FaultInjector(FakeDynamoDB(), clock=lambda: 1.0)
+        dynamodb.Table('MonitorHistory-CODE').put_item(Item={'CheckTime': 1, 'Outcome': 'True'})
+        self.assertEqual([(1.0, 'put_item', {'Item': {'CheckTime': 1, 'Outcome': 'True'}})], dynamodb.log)
+
+
+class TestCycle(unittest.TestCase):
+    def test_detects_and_publishes_outage(self):
+        with working_directory(), Harness(Scenario('baseline', delay=0)) as harness:
+            results = harness.run(cycles=1)
+            sent = harness.ses.sent
+        self.assertEqual(0, results['errors'])
+        self.assertEqual(0, results['false_alarms'])
+        # confirmed on the second attempt, after the first backoff
+        self.assertGreater(results['detect'], 4)
+        self.assertGreaterEqual(results['publish'], results['detect'])
+        # the initial status and the outage on the webhook, the failure email through SES
+        self.assertEqual(2, results['notifications'])
+        self.assertEqual('[ALERT P1] SecureDrop Site Failing Healthcheck', sent[0]['Message']['Subject']['Data'])
+
+    def test_compare(self):
+        baseline = {'flaky': {'cycle': 1.0, 'detect': 10.0, 'publish': 12.0, 'false_alarms': 1}}
+        results = {'flaky': {'cycle': 1.2, 'detect': 14.0, 'publish': None, 'false_alarms': 2}}
+        self.assertEqual(['flaky detect: 14.000s, baseline 10.000s',
+                          'flaky publish: never happened, baseline 12.000s',
+                          'flaky false_alarms: 2, baseline 1'], compare(results, baseline, tolerance=0.25))
+        self.assertEqual([], compare(results, {}))
@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+
+from botocore.exceptions import EndpointConnectionError
+
+from benchmarks.fakes import FakeDynamoDB
+from src.cache import CachedHistory, StateCache
+from src.history import DynamoHistory
+from src.monitor import create_item
+
+TABLE_NAME = 'MonitorHistory-DEV'
+NOW = 1570701600
+
+
+class TestStateCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'state-cache.json')
+        self.now = NOW
+        self.dynamodb = FakeDynamoDB()
+        self.table = self.dynamodb.Table(TABLE_NAME)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def cache(self) -> StateCache:
+        return StateCache(self.path, clock=lambda: self.now)
+
+    def history(self) -> CachedHistory:
+        return CachedHistory(DynamoHistory(self.dynamodb, TABLE_NAME), self.cache())
+
+    def test_missing_cache_reads_through(self):
+        self.table.put_item(Item=create_item(NOW - 1800, True))
+        self.assertEqual('True', self.history().latest(1)[0]['Outcome'])
+        self.assertEqual(1, self.table.calls['query'])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_fresh_cache_skips_dynamodb(self):
+        self.table.put_item(Item=create_item(NOW - 1800, False))
+        self.history().latest(1)
+        self.now += 600
+        self.assertEqual('False', self.history().latest(1)[0]['Outcome'])
+        self.assertEqual(1, self.table.calls['query'])
+
+    def test_corrupted_cache_is_ignored(self):
+        self.table.put_item(Item=create_item(NOW - 1800, True))
+        for content in ('{not json', '[]', json.dumps({'version': 99}),
+                        json.dumps({'version': 1, 'reconciled_at': NOW, 'items': [{'Outcome': 'True'}], 'pending': []})):
+            with open(self.path, 'w') as fobj:
+                fobj.write(content)
+            self.assertEqual([], self.cache().items)
+            self.assertEqual('True', self.history().latest(1)[0]['Outcome'])
+
+    def test_ttl_eviction(self):
+        cache = self.cache()
+        cache.add(create_item(NOW - 7 * 3600, True), pending=False)
+        cache.add(create_item(NOW - 60, False), pending=False)
+        self.assertEqual([NOW - 60], [item['CheckTime'] for item in cache.items])
+
+    def test_writes_are_deferred_until_reconciliation(self):
+        history = self.history()
+        history.record(create_item(NOW, True), flush=True)
+        self.now += 1800
+        history.record(create_item(self.now, True))
+        self.assertEqual(1, len(self.table.items))
+        self.assertEqual(1, len(self.cache().pending))
+
+        self.now += 3600
+        self.assertEqual(self.now - 3600, history.latest(1)[0]['CheckTime'])
+        self.assertEqual(2, len(self.table.items))
+        self.assertEqual([], self.cache().pending)
+
+    def test_flush_writes_immediately(self):
+        self.history().record(create_item(NOW, False), flush=True)
+        self.assertEqual(1, len(self.table.items))
+
+    def test_unreachable_dynamodb_keeps_pending_results(self):
+        history = self.history()
+        self.table.batch_writer = self.table.query = unreachable
+        history.record(create_item(NOW, False), flush=True)
+        self.assertEqual('False', history.latest(1)[0]['Outcome'])
+        self.assertEqual(1, len(self.cache().pending))
+
+
+def unreachable(**kwargs):
+    raise EndpointConnectionError(endpoint_url='http://localhost:8000')
+
+
+if __name__ == '__main__':
+    unittest.main()
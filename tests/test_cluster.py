@@ -0,0 +1,149 @@
+import unittest
+from unittest import mock
+
+from benchmarks.fakes import FakeDynamoDB, FakeSession
+from src.cluster import Cluster, rendezvous_owner
+from src.dynamo import MIRROR_HISTORY_KEY
+from src.healthcheck import CheckResult
+from src.history import DynamoHistory, ResultSink
+from src.monitor import check_once, create_cluster
+
+TABLE_NAME = 'MonitorCluster-CODE'
+MIRRORS = [f'mirror{index}.onion' for index in range(12)]
+CONFIG = {'SECUREDROP_URL': 'main.onion', 'SECUREDROP_MIRRORS': ','.join(MIRRORS), 'TOR_CONTROL': 'never',
+          'HEALTHCHECK_METADATA': 'never', 'PRODMON_REDEPLOY_URL': 'https://example.com/redeploy'}
+
+
+class TestCluster(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dynamodb = FakeDynamoDB()
+        self.now = 1570701600
+
+    def node(self, name: str) -> Cluster:
+        return Cluster(self.dynamodb, TABLE_NAME, name, lease_duration=60, clock=lambda: self.now)
+
+    def test_leader_lease(self):
+        first, second = self.node('a'), self.node('b')
+        self.assertTrue(first.acquire())
+        self.assertTrue(first.elected)
+        self.assertFalse(second.acquire())
+        # renewing is not a new election
+        self.now += 30
+        self.assertTrue(first.acquire())
+        self.assertFalse(first.elected)
+
+        # the leader stops renewing
+        self.now += 60
+        self.assertTrue(second.acquire())
+        self.assertTrue(second.elected)
+        self.assertFalse(first.acquire())
+        self.assertFalse(first.leader)
+
+    def test_release(self):
+        first, second = self.node('a'), self.node('b')
+        first.acquire()
+        second.release()
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+
+    def test_share_rebalances(self):
+        nodes = [self.node(name) for name in ('a', 'b', 'c')]
+        for node in nodes:
+            node.heartbeat()
+        nodes[0].acquire()
+        shares = [node.share(['main.onion'] + MIRRORS) for node in nodes]
+        self.assertEqual('main.onion', shares[0][0])
+        self.assertEqual(sorted(MIRRORS), sorted(shares[0][1:] + shares[1] + shares[2]))
+        self.assertTrue(all(shares))
+
+        # c stops sending heartbeats, and only its mirrors move
+        self.now += 61
+        for node in nodes[:2]:
+            node.heartbeat()
+        self.assertEqual(['a', 'b'], nodes[0].nodes())
+        rebalanced = [node.share(['main.onion'] + MIRRORS) for node in nodes[:2]]
+        self.assertEqual(sorted(MIRRORS), sorted(rebalanced[0][1:] + rebalanced[1]))
+        self.assertTrue(set(shares[1]) <= set(rebalanced[1]))
+
+    def test_create_cluster(self):
+        config = {'CLUSTER': 'dynamodb', 'STAGE': 'CODE', 'CRON_INTERVAL': '1800'}
+        cluster = create_cluster(FakeSession(dynamodb=self.dynamodb), config)
+        # a dead leader holds the status for a check, not an hour
+        self.assertEqual((1020, 3600), (cluster.lease_duration, cluster.heartbeat_duration))
+        # a daemon's checks can take longer than its interval
+        cluster = create_cluster(FakeSession(dynamodb=self.dynamodb), dict(config, CHECK_INTERVAL='30'))
+        self.assertEqual((420, 420), (cluster.lease_duration, cluster.heartbeat_duration))
+
+    def test_rendezvous_owner(self):
+        self.assertEqual(rendezvous_owner('x.onion', ['a', 'b']), rendezvous_owner('x.onion', ['b', 'a']))
+
+
+@mock.patch('src.monitor.update_status')
+@mock.patch('src.monitor.check_targets',
+            side_effect=lambda client, targets, *args: [CheckResult(target, 'up') for target in targets])
+class TestClusterChecks(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dynamodb = FakeDynamoDB()
+        # every node writes to the same history table
+        self.store = DynamoHistory(self.dynamodb, 'MonitorHistory-CODE')
+        self.notifier = mock.Mock()
+        self.metrics = mock.Mock()
+        self.now = 1570701600
+
+    def check(self, cluster: Cluster):
+        self.now += 60
+        with mock.patch('time.time', return_value=self.now):
+            return check_once(None, CONFIG, mock.Mock(), self.notifier, ResultSink(self.store),
+                              mock.Mock(store=self.store), restart=None, metrics=self.metrics, cluster=cluster)
+
+    def test_only_the_leader_updates_the_status(self, check_targets, update_status):
+        leader, follower = Cluster(self.dynamodb, TABLE_NAME, 'a'), Cluster(self.dynamodb, TABLE_NAME, 'b')
+        self.assertTrue(self.check(leader).healthy)
+        self.assertIsNone(self.check(follower))
+        self.assertEqual(1, update_status.call_count)
+
+        leader_targets, follower_targets = (call.args[1] for call in check_targets.call_args_list)
+        self.assertEqual('main.onion', leader_targets[0])
+        self.assertNotIn('main.onion', follower_targets)
+
+    def test_lost_lease_skips_the_status(self, check_targets, update_status):
+        leader = Cluster(self.dynamodb, TABLE_NAME, 'a')
+
+        def take_over(client, targets, *args):
+            # another node takes the lease while the check runs
+            self.dynamodb.Table(TABLE_NAME).items[('lease', 'leader')]['Owner'] = 'b'
+            return [CheckResult(target, 'up') for target in targets]
+        check_targets.side_effect = take_over
+        self.assertTrue(self.check(leader).healthy)
+        update_status.assert_not_called()
+
+    def test_follower_results_reach_the_leader(self, check_targets, update_status):
+        leader, follower = Cluster(self.dynamodb, TABLE_NAME, 'a'), Cluster(self.dynamodb, TABLE_NAME, 'b')
+        follower.heartbeat()
+        self.check(leader)
+        self.check(follower)
+        follower_targets = check_targets.call_args.args[1]
+        # the follower writes its results straight away, the leader's may wait in its buffer
+        self.assertEqual(sorted(follower_targets), sorted(
+            item['Target'] for item in self.store.latest(limit=100, history_key=MIRROR_HISTORY_KEY)))
+        self.assertEqual(len(MIRRORS), self.metrics.record_mirror.call_count)
+        self.notifier.notify.assert_not_called()
+
+        # one of the follower's mirrors goes down, and the leader alerts on it once
+        down = follower_targets[0]
+        check_targets.side_effect = lambda client, targets, *args: [
+            CheckResult(target, 'down' if target == down else 'up', error='timeout' if target == down else None)
+            for target in targets
+        ]
+        self.check(follower)
+        self.check(leader)
+        notification, = (call.args[0] for call in self.notifier.notify.call_args_list)
+        self.assertEqual(f'mirrors#{down}', notification.key)
+        self.assertIsNone(self.check(follower))
+        self.check(leader)
+        self.assertEqual(1, self.notifier.notify.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
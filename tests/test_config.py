@@ -0,0 +1,131 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from benchmarks.fakes import FakeSSM, client_error
+from src.config import (ConfigCache, ConfigLoader, MissingParameters, Snapshot, create_cipher,
+                        STAGE_PARAMETERS, fetch_config, parameter_names)
+from src.healthcheck import HealthcheckPolicy, policy_from_config
+
+STAGE = 'CODE'
+
+
+def parameters(stage: str = STAGE, **overrides) -> dict:
+    values = {name: f'value of {name}' for name in parameter_names(stage).values()}
+    values.update(overrides)
+    return {name: value for name, value in values.items() if value is not None}
+
+
+class ReversedCipher:
+    # enough to check the cache never stores the plain text
+    def encrypt(self, data: bytes) -> bytes:
+        return data[::-1]
+
+    def decrypt(self, token: bytes) -> bytes:
+        return token[::-1]
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'config-cache.bin')
+        self.time = 100000.0
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def loader(self, client: FakeSSM, **kwargs) -> ConfigLoader:
+        return ConfigLoader(client, STAGE, ConfigCache(self.path, ReversedCipher()), clock=lambda: self.time, **kwargs)
+
+    def test_fetch_config_batches_calls(self):
+        client = FakeSSM(parameters(), page_size=3)
+        values = fetch_config(client, STAGE)
+        self.assertEqual('value of /secure-contact/CODE/prodmon-webhook', values['PRODMON_WEBHOOK'])
+        self.assertEqual('value of securedrop-url', values['SECUREDROP_URL'])
+        # pages of three parameters under the path, plus one call for the names shared between stages
+        pages = -(-len(STAGE_PARAMETERS) // 3)
+        self.assertEqual({'get_parameters_by_path': pages, 'get_parameters': 1}, client.calls)
+
+    def test_reports_every_missing_parameter(self):
+        client = FakeSSM(parameters(**{'securedrop-url': None, '/secure-contact/CODE/prodmon-sender': None,
+                                       '/secure-contact/CODE/tor-restart': None}))
+        with self.assertRaises(MissingParameters) as context:
+            self.loader(client).load()
+        self.assertEqual(['/secure-contact/CODE/prodmon-sender', 'securedrop-url'], context.exception.names)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_optional_parameters(self):
+        client = FakeSSM(parameters(**{'/secure-contact/CODE/tor-restart': None}))
+        self.assertIsNone(self.loader(client).load()['TOR_RESTART'])
+
+    def test_healthcheck_parameters(self):
+        client = FakeSSM(parameters(**{'/secure-contact/CODE/healthcheck-metadata': 'never',
+                                       '/secure-contact/CODE/healthcheck-timeout': '30',
+                                       '/secure-contact/CODE/healthcheck-slow': None}))
+        policy = policy_from_config(self.loader(client).load())
+        self.assertFalse(policy.check_metadata)
+        self.assertEqual((30.0, HealthcheckPolicy().slow), (policy.timeout, policy.slow))
+
+    def test_uses_fresh_cache(self):
+        client = FakeSSM(parameters())
+        first = self.loader(client, ttl=900).load()
+        calls = dict(client.calls)
+        self.time += 600
+        self.assertEqual(first, self.loader(client, ttl=900).load())
+        self.assertEqual(calls, client.calls)
+        with open(self.path, 'rb') as fobj:
+            self.assertNotIn(b'prodmon-webhook', fobj.read())
+
+    def test_stale_cache_is_refreshed_in_background(self):
+        client = FakeSSM(parameters())
+        self.loader(client).load()
+        client.parameters['/secure-contact/CODE/tor-isolation'] = 'target'
+        self.time += 3600
+        loader = self.loader(client, ttl=900)
+        self.assertEqual('value of /secure-contact/CODE/tor-isolation', loader.load()['TOR_ISOLATION'])
+        loader.refresher.join(5)
+        self.assertEqual('target', self.loader(client).load()['TOR_ISOLATION'])
+
+    def test_finished_refresh_is_not_joined_at_exit(self):
+        client = FakeSSM(parameters())
+        self.loader(client).load()
+        self.time += 3600
+        loader = self.loader(client, ttl=900)
+        with mock.patch('src.config.atexit') as atexit:
+            loader.load()
+            loader.refresher.join(5)
+        atexit.register.assert_called_once_with(loader.wait)
+        atexit.unregister.assert_called_once_with(loader.wait)
+
+    def test_falls_back_to_cache_when_ssm_fails(self):
+        client = FakeSSM(parameters())
+        expected = self.loader(client).load()
+        client.error = client_error('ThrottlingException', 'GetParametersByPath')
+        self.time += 7 * 24 * 3600
+        self.assertEqual(expected, self.loader(client).load())
+
+    def test_raises_without_cache(self):
+        client = FakeSSM(error=client_error('AccessDeniedException', 'GetParametersByPath'))
+        with self.assertRaises(Exception):
+            self.loader(client).load()
+
+    def test_ignores_unreadable_cache(self):
+        with open(self.path, 'wb') as fobj:
+            fobj.write(b'not json')
+        self.assertIsNone(ConfigCache(self.path, ReversedCipher()).load())
+
+    @unittest.skipIf(importlib.util.find_spec('cryptography') is None, 'cryptography is not installed')
+    def test_encrypted_cache(self):
+        key_path = os.path.join(self.directory.name, 'key')
+        cache = ConfigCache(self.path, create_cipher(key_path))
+        cache.save(Snapshot({'BUCKET_NAME': 'bucket'}, 1.0))
+        self.assertEqual(0o600, os.stat(key_path).st_mode & 0o777)
+        self.assertEqual({'BUCKET_NAME': 'bucket'}, ConfigCache(self.path, create_cipher(key_path)).load().values)
+        other = os.path.join(self.directory.name, 'other-key')
+        self.assertIsNone(ConfigCache(self.path, create_cipher(other)).load())
+
+
+if __name__ == '__main__':
+    unittest.main()
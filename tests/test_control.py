@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks.fakes import FakeTorController
+from src.control import (ControlError, TorController, TorStatus, controller_from_config, diagnose,
+                         onion_service_id, recover)
+from src.healthcheck import Signal, evaluate
+from src.probe import ProbeResponse
+
+SERVICE_ID = 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd'
+ONION = f'http://{SERVICE_ID}.onion/'
+
+
+class TestTorController(unittest.TestCase):
+    def controller(self, fake: FakeTorController, **kwargs) -> TorController:
+        return TorController(fake.address, cookie_path=kwargs.pop('cookie_path', '/nonexistent'), timeout=2,
+                             **kwargs)
+
+    def test_onion_service_id(self):
+        self.assertEqual(SERVICE_ID, onion_service_id(ONION))
+        self.assertEqual(SERVICE_ID, onion_service_id(f'{SERVICE_ID}.onion'))
+
+    def test_cookie_authentication(self):
+        with tempfile.TemporaryDirectory() as directory, FakeTorController(cookie=b'\x01' * 32) as fake:
+            path = os.path.join(directory, 'control.authcookie')
+            with open(path, 'wb') as fobj:
+                fobj.write(b'\x01' * 32)
+            with self.controller(fake, cookie_path=path) as controller:
+                controller.newnym()
+            self.assertEqual(1, fake.newnym)
+            controller = self.controller(fake)
+            with self.assertRaises(ControlError) as context:
+                with controller:
+                    pass
+            self.assertEqual('515', context.exception.code)
+            # the connection is not left open
+            self.assertIsNone(controller._sock)
+
+    def test_status(self):
+        with FakeTorController(circuits=('BUILT', 'LAUNCHED', 'BUILT'), descriptors={SERVICE_ID: 'RECEIVED'}) as fake:
+            with self.controller(fake) as controller:
+                self.assertEqual(TorStatus(100, 2, 'received'), controller.status(ONION))
+            # the event subscription is dropped again
+            self.assertIn('SETEVENTS', fake.commands[fake.commands.index(f'HSFETCH {SERVICE_ID}'):])
+
+    def test_missing_descriptor(self):
+        with FakeTorController(descriptors={SERVICE_ID: 'FAILED'}) as fake, self.controller(fake) as controller:
+            status = controller.status(ONION)
+        self.assertEqual('failed: not_found', status.descriptor)
+        self.assertEqual((Signal('tor', 'ok', 'bootstrapped 100%, 1 circuits built'),
+                          Signal('descriptor', 'failed', 'failed: not_found')), status.signals())
+
+    def test_descriptor_timeout(self):
+        with FakeTorController() as fake, self.controller(fake) as controller:
+            self.assertIsNone(controller.fetch_descriptor(ONION, timeout=0.1))
+            # the connection is still usable afterwards
+            self.assertEqual(100, controller.bootstrap())
+
+    def test_skips_descriptor_without_circuits(self):
+        with FakeTorController(bootstrap=45, circuits=()) as fake, self.controller(fake) as controller:
+            status = controller.status(ONION)
+        self.assertTrue(status.broken)
+        self.assertIsNone(status.descriptor)
+        self.assertNotIn(f'HSFETCH {SERVICE_ID}', fake.commands)
+
+    def test_controller_from_config(self):
+        self.assertIsNone(controller_from_config({'TOR_CONTROL': 'never'}))
+        self.assertEqual(('127.0.0.1', 9051), controller_from_config({}).address)
+        self.assertEqual(('127.0.0.1', 9151), controller_from_config({'TOR_CONTROL': '9151'}).address)
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.restarts = 0
+
+    def restart(self):
+        self.restarts += 1
+
+    def test_renews_circuits(self):
+        with FakeTorController() as fake:
+            self.assertFalse(recover(TorController(fake.address, cookie_path='/nonexistent'), self.restart))
+        self.assertEqual(1, fake.newnym)
+        self.assertEqual(0, self.restarts)
+
+    def test_restarts_broken_tor(self):
+        with FakeTorController(bootstrap=100, circuits=('FAILED',)) as fake:
+            self.assertTrue(recover(TorController(fake.address, cookie_path='/nonexistent'), self.restart))
+        self.assertEqual(1, self.restarts)
+
+    def test_restarts_without_control_port(self):
+        with FakeTorController() as fake:
+            address = fake.address
+        self.assertTrue(recover(TorController(address, timeout=1), self.restart))
+        self.assertTrue(recover(None, self.restart))
+        self.assertFalse(recover(None, None))
+        self.assertEqual(2, self.restarts)
+
+    def test_diagnosis_explains_failure(self):
+        response = ProbeResponse(ONION, error='socks')
+        with FakeTorController(circuits=()) as fake:
+            signals = diagnose(TorController(fake.address, cookie_path='/nonexistent'), ONION)
+        result = evaluate(response, extra=signals)
+        self.assertEqual('down', result.status)
+        self.assertEqual('tor', result.failure)
+
+        result = evaluate(response, extra=TorStatus(100, 3, 'failed: not_found').signals())
+        self.assertEqual('descriptor', result.failure)
+        self.assertEqual('socks', evaluate(response, extra=(Signal('tor', 'skipped'),)).failure)
@@ -0,0 +1,94 @@
+import unittest
+from unittest import mock
+
+from benchmarks.fakes import FakeDynamoDB
+from src.daemon import Daemon, Ticker
+from src.history import DynamoHistory
+
+CONFIG = {
+    'SECUREDROP_URL': 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion',
+    'SECUREDROP_URL_HUMAN': 'theguardian.securedrop.tor.onion',
+    'TOR_ISOLATION': 'shared',
+    'TABLE_NAME': 'MonitorHistory-CODE',
+    'STAGE': 'CODE'
+}
+
+
+class TestTicker(unittest.TestCase):
+    def test_corrects_drift(self):
+        ticker = Ticker(30, start=0)
+        self.assertEqual(25, ticker.advance(5))
+        # a slow check shortens the following wait instead of delaying every later check
+        self.assertEqual(10, ticker.advance(50))
+
+    def test_skips_missed_ticks(self):
+        ticker = Ticker(30, start=0)
+        self.assertEqual(25, ticker.advance(95))
+        self.assertEqual(120, ticker.next)
+
+
+@mock.patch('securedrop.build_pages')
+@mock.patch('src.daemon.create_history')
+@mock.patch('src.daemon.create_history_store', return_value=DynamoHistory(FakeDynamoDB(), 'MonitorHistory-CODE'))
+@mock.patch('src.daemon.create_dispatcher')
+@mock.patch('src.daemon.create_probe_client')
+@mock.patch('src.daemon.create_config', side_effect=lambda *args, **kwargs: dict(CONFIG))
+class TestDaemon(unittest.TestCase):
+    def daemon(self, **kwargs) -> Daemon:
+        daemon = Daemon(None, 'CODE', interval=0.01, **kwargs)
+        daemon.install_signal_handlers = lambda: None
+        return daemon
+
+    def test_checks_until_stopped(self, config, client, dispatcher, *_):
+        daemon = self.daemon()
+        checks = []
+
+        def check(*args, **kwargs):
+            checks.append(args)
+            if len(checks) == 3:
+                daemon.stop()
+
+        with mock.patch('src.daemon.check_once', side_effect=check):
+            self.assertEqual(0, daemon.run())
+        self.assertEqual(3, len(checks))
+        # the same client and configuration are used for every check
+        self.assertEqual(1, config.call_count)
+        self.assertEqual(1, client.call_count)
+        self.assertEqual('0.01', checks[0][1]['CHECK_INTERVAL'])
+        client.return_value.close.assert_called_once()
+        dispatcher.return_value.close.assert_called()
+
+    def test_reloads_configuration(self, config, client, *_):
+        daemon = self.daemon()
+        checks = []
+
+        def check(*args, **kwargs):
+            checks.append(args)
+            if len(checks) == 1:
+                config.side_effect = lambda *args, **kwargs: dict(CONFIG, TOR_ISOLATION='target')
+                daemon.request_reload()
+            else:
+                daemon.stop()
+
+        with mock.patch('src.daemon.check_once', side_effect=check):
+            daemon.run()
+        self.assertEqual([mock.call(None, 'CODE', refresh=False), mock.call(None, 'CODE', refresh=True)],
+                         config.call_args_list)
+        self.assertEqual('target', checks[1][1]['TOR_ISOLATION'])
+        # a new isolation mode needs a new client
+        self.assertEqual(2, client.call_count)
+
+    def test_restart_cooldown(self, *_):
+        now = [1000.0]
+        daemon = self.daemon(restart_cooldown=600, clock=lambda: now[0])
+        self.assertTrue(daemon.can_restart_tor())
+        with mock.patch('src.daemon.restart_tor'):
+            daemon.restart_tor()
+        now[0] += 300
+        self.assertFalse(daemon.can_restart_tor())
+        now[0] += 300
+        self.assertTrue(daemon.can_restart_tor())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,16 @@
+import decimal
 import unittest
 import boto3
 import time
+from collections import OrderedDict
 
-from src.monitor import create_item
-from src.dynamo import write_to_database, read_from_database
+from botocore.exceptions import ClientError
+
+from benchmarks.fakes import FakeDynamoDB
+from src.monitor import create_attempt_item, create_item
+from src.dynamo import HISTORY_INDEX, dump_to_dynamodb, load_from_dynamodb, write_to_database, \
+    read_from_database, read_latest_outcomes
+from src.history import DynamoHistory, ResultSink
 
 # !! ~~ Only use this module for local testing ~~ !!
 
@@ -32,6 +39,32 @@ def create_table(client, table_name: str):
                 {
                     'AttributeName': 'Outcome',
                     'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'HistoryKey',
+                    'AttributeType': 'S'
+                }
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': HISTORY_INDEX,
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'HistoryKey',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'CheckTime',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    },
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 1,
+                        'WriteCapacityUnits': 1
+                    }
                 }
             ],
             ProvisionedThroughput={
@@ -104,15 +137,112 @@ class TestDatabase(unittest.TestCase):
 
     def test_read_and_write(self):
         first_result = read_from_database(self.dynamodb, self.table_name)
-        self.assertEqual(6, first_result.get('ScannedCount'))
-        self.assertEqual(4, len(first_result.get('Items')))
+        self.assertEqual(4, len(first_result))
 
         new_item = create_item(int(time.time()), True)
         write_to_database(self.dynamodb, self.table_name, new_item)
 
         second_result = read_from_database(self.dynamodb, self.table_name)
-        self.assertEqual(7, second_result.get('ScannedCount'))
-        self.assertEqual(5, len(second_result.get('Items')))
+        self.assertEqual(5, len(second_result))
+
+    def test_read_latest_outcomes(self):
+        latest = read_latest_outcomes(self.dynamodb, self.table_name, limit=2)
+        self.assertEqual(2, len(latest))
+        self.assertGreater(latest[0]['CheckTime'], latest[1]['CheckTime'])
+
+
+class TestSerializer(unittest.TestCase):
+    def test_dump_converts_numbers(self):
+        item = {'CheckTime': 1570701600, 'Latency': 1.5, 'Ok': True, 'Tags': ('a', 1), 'Ids': {1, 2}, 'Note': None}
+        expected = {
+            'CheckTime': decimal.Decimal(1570701600),
+            'Latency': decimal.Decimal('1.5'),
+            'Ok': True,
+            'Tags': ['a', decimal.Decimal(1)],
+            'Ids': {decimal.Decimal(1), decimal.Decimal(2)},
+            'Note': None
+        }
+        self.assertEqual(expected, dump_to_dynamodb(item))
+        self.assertIsInstance(dump_to_dynamodb(item)['Ok'], bool)
+
+    def test_dump_does_not_mutate_input(self):
+        item = {'CheckTime': 1570701600, 'Nested': {'Attempt': 1}}
+        dump_to_dynamodb(item)
+        self.assertEqual({'CheckTime': 1570701600, 'Nested': {'Attempt': 1}}, item)
+
+    def test_dump_handles_other_mappings(self):
+        self.assertEqual({'a': decimal.Decimal(1)}, dump_to_dynamodb(OrderedDict(a=1)))
+
+    def test_round_trip(self):
+        item = {'CheckTime': 1570701600, 'Latency': 0.25, 'Outcome': 'True', 'Samples': [1, 2.5], 'Ids': {3}}
+        loaded = load_from_dynamodb(dump_to_dynamodb(item))
+        self.assertEqual(item, loaded)
+        self.assertIsInstance(loaded['CheckTime'], int)
+        self.assertIsInstance(loaded['Latency'], float)
+
+
+def throttled(**kwargs):
+    raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'}},
+                      'BatchWriteItem')
+
+
+class TestResultSink(unittest.TestCase):
+    def setUp(self) -> None:
+        self.table_name = 'MonitorHistory-DEV'
+        self.dynamodb = FakeDynamoDB()
+        self.table = self.dynamodb.Table(self.table_name)
+        self.now = 0.0
+        self.sleeps = []
+
+    def sink(self, **kwargs) -> ResultSink:
+        return ResultSink(DynamoHistory(self.dynamodb, self.table_name), clock=lambda: self.now, sleep=self.sleeps.append, **kwargs)
+
+    def test_flushes_at_size_threshold(self):
+        with self.sink(max_items=3) as sink:
+            for attempt in range(1, 4):
+                sink.add(create_attempt_item(1570701600, attempt, False, 'timeout'))
+            self.assertEqual([], sink.buffer)
+            self.assertEqual(3, len(self.table.items))
+            self.assertEqual(1, self.table.calls['batch_write_item'])
+
+    def test_flushes_at_age_threshold(self):
+        with self.sink(max_age=60) as sink:
+            sink.add(create_attempt_item(1570701600, 1, False, 'timeout'))
+            self.assertEqual(0, len(self.table.items))
+            self.now += 60
+            sink.add(create_attempt_item(1570701660, 2, True, None))
+            self.assertEqual(2, len(self.table.items))
+
+    def test_close_flushes(self):
+        with self.sink() as sink:
+            for attempt in range(1, 31):
+                sink.add(create_attempt_item(1570701600 + attempt, attempt, False, 'socks'))
+        self.assertEqual(30, len(self.table.items))
+        self.assertEqual(2, self.table.calls['batch_write_item'])
+
+    def test_retries_failed_writes(self):
+        sink = self.sink(retries=3, backoff=1)
+        sink.add(create_item(1570701600, True))
+        batch_writer = self.table.batch_writer
+        failures = iter([True, False])
+        self.table.batch_writer = lambda **kwargs: throttled() if next(failures) else batch_writer(**kwargs)
+        self.assertTrue(sink.close())
+        self.assertEqual([1], self.sleeps)
+        self.assertEqual(1, len(self.table.items))
+
+    def test_keeps_results_when_giving_up(self):
+        sink = self.sink(retries=2)
+        sink.add(create_item(1570701600, True))
+        self.table.batch_writer = throttled
+        self.assertFalse(sink.close())
+        self.assertEqual(1, len(sink.buffer))
+
+    def test_attempts_do_not_overwrite_the_verdict(self):
+        with self.sink() as sink:
+            sink.add(create_attempt_item(1570701600, 1, True, None))
+            sink.add(create_item(1570701600, True))
+        self.assertEqual(2, len(self.table.items))
+        self.assertEqual(1, len(read_latest_outcomes(self.dynamodb, self.table_name)))
 
 
 if __name__ == '__main__':
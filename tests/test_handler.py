@@ -0,0 +1,81 @@
+import json
+import unittest
+from unittest import mock
+
+from benchmarks.fakes import FakeDynamoDB
+from src.handler import CONFIG_TTL, LambdaMonitor
+from src.healthcheck import CheckResult
+from src.history import DynamoHistory
+
+CONFIG = {
+    'SECUREDROP_URL': 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion',
+    'SECUREDROP_URL_HUMAN': 'theguardian.securedrop.tor.onion',
+    'TOR_PROXIES': 'tor.internal:9050',
+    'TOR_CONTROL': 'never',
+    'HEALTHCHECK_METADATA': 'never',
+    'TABLE_NAME': 'MonitorHistory-CODE',
+    'STAGE': 'CODE'
+}
+
+
+def results(*statuses):
+    statuses = iter(statuses)
+
+    def check_targets(client, targets, *args):
+        status = next(statuses)
+        return [CheckResult(target, status, error=None if status == 'up' else 'timeout') for target in targets]
+    return check_targets
+
+
+@mock.patch('src.monitor.update_status')
+@mock.patch('securedrop.build_pages', return_value=False)
+@mock.patch('src.daemon.create_metrics')
+@mock.patch('src.daemon.create_history')
+@mock.patch('src.daemon.create_history_store', return_value=DynamoHistory(FakeDynamoDB(), 'MonitorHistory-CODE'))
+@mock.patch('src.daemon.create_dispatcher')
+@mock.patch('src.daemon.create_probe_client')
+@mock.patch('src.daemon.create_config', side_effect=lambda *args, **kwargs: dict(CONFIG))
+class TestLambdaMonitor(unittest.TestCase):
+    def monitor(self, **kwargs) -> LambdaMonitor:
+        monitor = LambdaMonitor(None, 'CODE', interval=300, **kwargs)
+        monitor.load()
+        return monitor
+
+    def test_warm_invocations_reuse_the_container(self, config, client, dispatcher, *mocks):
+        update_status = mocks[-1]
+        monitor = self.monitor()
+        with mock.patch('src.monitor.check_targets', side_effect=results('up', 'up')):
+            self.assertEqual({'done': True, 'healthy': True, 'attempts': 1, 'confirmed': True}, monitor.step({}))
+            monitor.step({})
+        self.assertEqual(1, config.call_count)
+        self.assertEqual(1, client.call_count)
+        self.assertEqual(2, update_status.call_count)
+        # queued notifications are delivered before the container can be frozen
+        self.assertEqual(2, dispatcher.return_value.close.call_count)
+
+    def test_retries_are_handed_back(self, *mocks):
+        update_status = mocks[-1]
+        monitor = self.monitor()
+        with mock.patch('src.monitor.check_targets', side_effect=results('down', 'up')):
+            response = monitor.step({})
+            self.assertFalse(response['done'])
+            self.assertGreater(response['wait'], 0)
+            update_status.assert_not_called()
+            # the state machine passes the response back in, after a round trip through JSON
+            response = monitor.step(json.loads(json.dumps(response)))
+        self.assertEqual({'done': True, 'healthy': True, 'attempts': 2, 'confirmed': True}, response)
+        update_status.assert_called_once()
+
+    def test_configuration_expires(self, config, *_):
+        now = [0.0]
+        monitor = self.monitor(clock=lambda: now[0])
+        self.assertFalse(monitor.is_stale())
+        now[0] += CONFIG_TTL
+        self.assertTrue(monitor.is_stale())
+        monitor.reload()
+        self.assertFalse(monitor.is_stale())
+        self.assertEqual(mock.call(None, 'CODE', refresh=True), config.call_args)
+
+
+if __name__ == '__main__':
+    unittest.main()
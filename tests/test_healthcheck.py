@@ -0,0 +1,160 @@
+import datetime
+import json
+import time
+import unittest
+from unittest import mock
+
+from benchmarks.fakes import FakeSite, FakeTorProxy
+from src.healthcheck import (HealthcheckPolicy, Signal, check_certificate, combine, evaluate, parse_version,
+                             policy_from_config, quorum_reached)
+from src.monitor import check_targets
+from src.probe import ProbeResponse, QuorumClient, TorClient
+
+ONION = 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion'
+PAGE = '<html><head><title>The Guardian | SecureDrop</title></head><body>' + 'x' * 200000 + '</body></html>'
+METADATA = json.dumps({'sd_version': '2.6.0', 'v3_source_url': f'http://{ONION}', 'server_os': '20.04'})
+
+
+def response(**kwargs) -> ProbeResponse:
+    kwargs.setdefault('status_code', 200)
+    kwargs.setdefault('text', '<title>The Guardian | SecureDrop</title>')
+    kwargs.setdefault('elapsed', 2.0)
+    return ProbeResponse(ONION, **kwargs)
+
+
+class TestEvaluate(unittest.TestCase):
+    def test_up(self):
+        result = evaluate(response(), metadata=ProbeResponse(ONION, 200, METADATA))
+        self.assertEqual('up', result.status)
+        self.assertTrue(result)
+        self.assertEqual(('reachable', 'status', 'content', 'latency', 'metadata', 'certificate'),
+                         tuple(signal.name for signal in result.signals))
+
+    def test_down(self):
+        self.assertEqual('reachable', evaluate(response(status_code=None, error='socks')).problems[0])
+        self.assertEqual('socks', evaluate(ProbeResponse(ONION, error='socks')).failure)
+        self.assertEqual('http', evaluate(response(status_code=502)).failure)
+        wrong = evaluate(response(text='<title>Index of /</title>', truncated=True))
+        self.assertEqual(('down', ('content',)), (wrong.status, wrong.problems))
+        self.assertFalse(evaluate(None))
+
+    def test_degraded_is_still_healthy(self):
+        slow = evaluate(response(elapsed=30.0))
+        self.assertEqual(('degraded', ('latency',)), (slow.status, slow.problems))
+        self.assertTrue(slow.healthy)
+        self.assertIsNone(slow.failure)
+
+    def test_metadata(self):
+        policy = HealthcheckPolicy(min_version='2.7.0')
+        old = evaluate(response(), policy, ProbeResponse(ONION, 200, METADATA))
+        self.assertEqual(('degraded', ('metadata',)), (old.status, old.problems))
+        missing = evaluate(response(), metadata=ProbeResponse(ONION, 404, 'Not Found'))
+        self.assertEqual('degraded', missing.status)
+        elsewhere = evaluate(response(), metadata=ProbeResponse(ONION, 200, json.dumps({'sd_version': '2.6.0', 'v3_source_url': 'http://other.onion'})))
+        self.assertEqual('degraded', elsewhere.status)
+
+    def test_extra_signals(self):
+        result = evaluate(response(), extra=(Signal('descriptor', 'failed', 'stale'),))
+        self.assertEqual(('degraded', ('descriptor',)), (result.status, result.problems))
+
+    def test_certificate(self):
+        now = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        with mock.patch('src.healthcheck.certificate_expiry', return_value=now + datetime.timedelta(days=7)):
+            signal = check_certificate(response(certificate=b'der'), HealthcheckPolicy(), now)
+        self.assertEqual(('failed', 'expires in 7 days'), signal[1:])
+        self.assertEqual('skipped', check_certificate(response(), HealthcheckPolicy()).status)
+
+    def test_parse_version(self):
+        self.assertLess(parse_version('2.5.2'), parse_version('2.6.0~rc1'))
+        self.assertEqual((2, 6, 0), parse_version('2.6.0~rc1'))
+
+    def test_policy_from_config(self):
+        policy = policy_from_config({'HEALTHCHECK_SLOW': '5', 'SECUREDROP_MIN_VERSION': '2.6.0'})
+        self.assertEqual((5.0, '2.6.0', True), (policy.slow, policy.min_version, policy.check_metadata))
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self) -> None:
+        self.proxy = FakeTorProxy({
+            ONION: FakeSite(body=PAGE, metadata=METADATA),
+            'chunked.onion': FakeSite(body=PAGE, chunked=True),
+            'small.onion': FakeSite(metadata=json.dumps({'sd_version': '2.6.0'})),
+        })
+        self.proxy.start()
+        self.client = TorClient(self.proxy.address)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.proxy.stop()
+
+    def test_stops_at_marker(self):
+        for target in (ONION, 'chunked.onion'):
+            page = self.client.get(target, marker=b'The Guardian | SecureDrop', max_bytes=64 * 1024)
+            self.assertTrue(page.truncated)
+            self.assertLess(len(page.text), 64 * 1024)
+            self.assertEqual('up', evaluate(page).status)
+
+    def test_byte_cap(self):
+        page = self.client.get(ONION, marker=b'not on the page', max_bytes=1024)
+        self.assertEqual((True, 1024), (page.truncated, len(page.text)))
+        result = evaluate(page, HealthcheckPolicy(marker='not on the page'))
+        self.assertEqual(('down', 'marker not in the first 1024 characters'), (result.status, result.signals[-1].detail))
+
+    def test_small_pages_keep_the_connection(self):
+        results = check_targets(self.client, ['small.onion'], HealthcheckPolicy())
+        self.assertEqual('up', results[0].status)
+        self.assertEqual('metadata', results[0].signals[4].name)
+        self.assertEqual('2.6.0', results[0].signals[4].detail)
+        self.assertEqual(1, self.proxy.connections)
+
+    def test_check_targets(self):
+        results = check_targets(self.client, [ONION, 'gone.onion'], HealthcheckPolicy())
+        self.assertEqual(['up', 'down'], [result.status for result in results])
+        self.assertEqual('ok', results[0].signals[4].status)
+
+
+class TestQuorum(unittest.TestCase):
+    up = evaluate(response())
+    wrong = evaluate(response(status_code=503))
+    timeout = evaluate(ProbeResponse(ONION, error='timeout'))
+    no_tor = evaluate(ProbeResponse(ONION, error='proxy'))
+
+    def test_up(self):
+        result = combine([self.timeout, self.up, self.up], 2)
+        self.assertEqual('up', result.status)
+        self.assertAlmostEqual(0.667, result.confidence)
+        self.assertEqual(Signal('quorum', 'ok', '2 up, 1 down, 0 abstained'), result.signals[-1])
+
+    def test_confirmed_only_when_agreed(self):
+        self.assertEqual('http', combine([self.wrong, self.wrong, self.up], 2).failure)
+        # one wrong page is not enough to be sure, so it is retried
+        self.assertEqual('timeout', combine([self.wrong, self.timeout, self.up], 2).failure)
+        self.assertEqual(1.0, combine([self.wrong, self.timeout, self.timeout], 2).confidence)
+
+    def test_abstains_without_tor(self):
+        result = combine([self.no_tor, self.up, self.timeout], 2)
+        self.assertEqual(('down', 'inconclusive', 0.0), (result.status, result.failure, result.confidence))
+        # the Tor restart policy still applies when no vantage point can reach Tor
+        self.assertEqual('proxy', combine([self.no_tor] * 3, 2).failure)
+
+    def test_quorum_reached(self):
+        self.assertTrue(quorum_reached([self.up, self.up], 2))
+        self.assertTrue(quorum_reached([self.wrong, self.wrong], 2))
+        self.assertFalse(quorum_reached([self.timeout, self.timeout, self.up], 2))
+
+    def test_check_targets(self):
+        slow = FakeTorProxy({ONION: FakeSite(body=PAGE, delay=3)})
+        healthy = FakeTorProxy({ONION: FakeSite(body=PAGE, metadata=METADATA)})
+        with slow, healthy, QuorumClient(2, 3, [slow.address, healthy.address, healthy.address]) as client:
+            start = time.monotonic()
+            result, = check_targets(client, [ONION], HealthcheckPolicy())
+            # the verdict does not wait for the slow vantage point
+            self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual('up', result.status)
+        self.assertEqual(('metadata', 'ok'), result.signals[4][:2])
+        self.assertEqual('2 up, 0 down, 1 abstained', result.signals[-1].detail)
+        self.assertEqual(2, len(set(healthy.credentials)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.fakes import FakeDynamoDB
+from src.dynamo import ATTEMPT_HISTORY_KEY
+from src.history import DynamoHistory, HistoryStore, HistorySummary, ResultSink, SQLiteHistory
+from src.monitor import create_attempt_item, create_item
+
+TABLE_NAME = 'MonitorHistory-DEV'
+NOW = 1570701600
+
+
+class TestSQLiteHistory(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.sqlite3')
+        self.now = NOW
+        self.store = self.open()
+
+    def tearDown(self) -> None:
+        self.store.close()
+        self.directory.cleanup()
+
+    def open(self) -> SQLiteHistory:
+        return SQLiteHistory(self.path, clock=lambda: self.now)
+
+    def test_wal_mode(self):
+        self.assertEqual('wal', self.store.connection.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_latest(self):
+        self.store.write([create_item(NOW - 1800 * index, index % 2 == 0, {'Latency': 1.5}) for index in range(5)])
+        self.store.write([create_attempt_item(NOW, 1, True, None)])
+        latest = self.store.latest(limit=2)
+        self.assertEqual([(NOW, 'True'), (NOW - 1800, 'False')], [(item['CheckTime'], item['Outcome']) for item in latest])
+        self.assertEqual(1.5, latest[0]['Latency'])
+        # attempts are kept apart from the verdicts
+        self.assertEqual(['True#1'], [item['Outcome'] for item in self.store.latest(history_key=ATTEMPT_HISTORY_KEY)])
+
+    def test_replaces_same_key(self):
+        self.store.write([create_item(NOW, True, {'Attempts': 1})])
+        self.store.write([create_item(NOW, True, {'Attempts': 2})])
+        self.assertEqual([2], [item['Attempts'] for item in self.store.latest()])
+
+    def test_range_queries(self):
+        self.store.write([create_item(NOW - 60 * index, index != 1, {'Latency': float(index)} if index != 1 else {})
+                          for index in range(10)])
+        items = self.store.between(NOW - 180, NOW - 60)
+        self.assertEqual([NOW - 60, NOW - 120, NOW - 180], [item['CheckTime'] for item in items])
+        summary = self.store.summary(NOW - 180, NOW)
+        self.assertEqual(HistorySummary(4, 3, 5 / 3, 3.0), summary)
+        self.assertEqual(75.0, summary.availability)
+        self.assertIsNone(self.store.summary(0, 1).availability)
+
+    def test_ttl_pruning(self):
+        self.store.write([create_item(NOW - 8 * 24 * 3600, True), create_item(NOW, True)])
+        self.assertEqual([NOW], [item['CheckTime'] for item in self.store.between(0, NOW)])
+        self.now += 8 * 24 * 3600
+        self.assertEqual([], self.store.latest())
+        self.assertEqual(1, self.store.prune())
+
+    def test_persists(self):
+        self.store.write([create_item(NOW, False)])
+        self.store.close()
+        self.store = self.open()
+        self.assertEqual('False', self.store.latest(1)[0]['Outcome'])
+
+    def test_sink_retries_locked_database(self):
+        sink = ResultSink(self.store, sleep=lambda seconds: None)
+        sink.add(create_item(NOW, True))
+        writes = iter([sqlite3.OperationalError('database is locked')])
+        write = self.store.write
+
+        def flaky_write(items):
+            error = next(writes, None)
+            if error:
+                raise error
+            write(items)
+        self.store.write = flaky_write
+        self.assertTrue(sink.close())
+        self.assertEqual(1, len(self.store.latest()))
+
+
+class TestDynamoHistory(unittest.TestCase):
+    def test_range_queries(self):
+        dynamodb = FakeDynamoDB()
+        store = DynamoHistory(dynamodb, TABLE_NAME)
+        store.write([create_item(NOW - 60 * index, True, {'Latency': 2.0}) for index in range(5)])
+        self.assertEqual(1, dynamodb.Table(TABLE_NAME).calls['batch_write_item'])
+        self.assertEqual([NOW, NOW - 60], [item['CheckTime'] for item in store.between(NOW - 60, NOW)])
+        self.assertEqual(HistorySummary(5, 5, 2.0, 2.0), store.summary(0, NOW))
+        self.assertEqual([NOW], [item['CheckTime'] for item in store.latest(1)])
+
+
+class TestHistoryStore(unittest.TestCase):
+    def test_incomplete_backend(self):
+        class WriteOnly(HistoryStore):
+            def write(self, items):
+                pass
+
+        with self.assertRaises(TypeError):
+            WriteOnly()
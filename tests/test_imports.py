@@ -0,0 +1,24 @@
+import unittest
+
+from benchmarks.bench_imports import HEAVY_MODULES, loaded_modules
+
+
+class TestImports(unittest.TestCase):
+    # only what is loaded, the time it takes is measured by benchmarks/bench_imports.py
+    def assertLazy(self, module: str):
+        modules = loaded_modules(module)
+        self.assertIn(module, modules)
+        self.assertEqual([], [name for name in HEAVY_MODULES if name in modules])
+
+    def test_monitor(self):
+        self.assertLazy('src.monitor')
+
+    def test_notifications(self):
+        self.assertLazy('src.notifications')
+
+    def test_config(self):
+        self.assertLazy('src.config')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+
+from src.metrics import MetricsRecorder, RingBuffer, RollingAggregator, emf_document, percentile
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_overwrites_oldest(self):
+        buffer = RingBuffer(capacity=3)
+        for index in range(5):
+            buffer.append(index, index / 10, index % 2 == 0)
+        self.assertEqual(3, len(buffer))
+        self.assertEqual([2, 3, 4], [row[0] for row in buffer.rows()])
+
+    def test_round_trip(self):
+        buffer = RingBuffer(capacity=3)
+        for index in range(4):
+            buffer.append(index, math.nan if index == 3 else 0.5, index != 1)
+        restored = RingBuffer.from_bytes(buffer.to_bytes())
+        self.assertEqual(3, restored.capacity)
+        rows = list(restored.rows())
+        self.assertEqual([(1, 0.5, False), (2, 0.5, True)], rows[:2])
+        self.assertTrue(math.isnan(rows[2][1]))
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            RingBuffer.from_bytes(b'XXXX' + bytes(8))
+
+
+class TestRollingAggregator(unittest.TestCase):
+    def setUp(self):
+        self.time = 10 * 24 * 3600
+        self.aggregator = RollingAggregator(clock=lambda: self.time)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(1, percentile([1], 99))
+        self.assertIsNone(percentile([], 50))
+
+    def test_windows(self):
+        # a day old failure only counts towards the longer windows
+        self.aggregator.record(False, None, self.time - 2 * 3600)
+        for latency in (1.0, 2.0, 3.0):
+            self.aggregator.record(True, latency)
+        hour, day, week = self.aggregator.summary()
+        self.assertEqual(('1h', 3, 100.0, 2.0, 3.0, 3.0), hour)
+        self.assertEqual(4, day.checks)
+        self.assertEqual(75.0, day.availability)
+        # checks without a response have no latency
+        self.assertEqual(2.0, week.p50)
+
+    def test_empty_window(self):
+        self.aggregator.record(True, 1.0, self.time - 8 * 24 * 3600)
+        self.assertEqual(('7d', 0, None, None, None, None), self.aggregator.stats('7d', 7 * 24 * 3600))
+
+
+class TestMetricsRecorder(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'metrics.bin')
+
+    def test_emf_document(self):
+        document = emf_document('SecureContact', {'Stage': 'CODE'},
+                                {'Latency': (12.5, 'Milliseconds'), 'Availability1h': (None, 'Percent')}, 1.5)
+        self.assertEqual({
+            '_aws': {
+                'Timestamp': 1500,
+                'CloudWatchMetrics': [{
+                    'Namespace': 'SecureContact',
+                    'Dimensions': [['Stage']],
+                    'Metrics': [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+                }]
+            },
+            'Stage': 'CODE',
+            'Latency': 12.5
+        }, document)
+
+    def test_record_check(self):
+        recorder = MetricsRecorder('CODE', path=self.path)
+        with self.assertLogs('securecontact.metrics.emf') as logs:
+            recorder.record_check(False, None, attempts=3, restarts=1, status='down', failure='timeout')
+        document = json.loads(logs.records[0].getMessage())
+        self.assertEqual(0, document['Healthy'])
+        self.assertEqual(1, document['TorRestarts'])
+        self.assertEqual('timeout', document['Failure'])
+        self.assertNotIn('Latency', document)
+        self.assertEqual(0.0, document['Availability1h'])
+
+        # the rolling windows survive a restart
+        recorder = MetricsRecorder('CODE', path=self.path)
+        with self.assertLogs('securecontact.metrics.emf') as logs:
+            recorder.record_check(True, 1.25, attempts=1, restarts=0, status='up')
+        document = json.loads(logs.records[0].getMessage())
+        self.assertEqual(1250.0, document['Latency'])
+        self.assertEqual(50.0, document['Availability1h'])
+
+    def test_ignores_unreadable_file(self):
+        with open(self.path, 'wb') as fobj:
+            fobj.write(b'garbage')
+        recorder = MetricsRecorder('CODE', path=self.path)
+        self.assertEqual(0, len(recorder.aggregator.buffer))
@@ -1,5 +1,15 @@
+import itertools
+import re
+import tempfile
 import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from urllib.parse import urljoin, urlparse
 
+from benchmarks.bench_cycle import working_directory
+from benchmarks.fakes import FakeDynamoDB, FakeS3, FakeSession
+from src.dynamo import read_latest_outcomes
+from src.publish import variant_key
 from src.monitor import *
 
 
@@ -22,10 +32,161 @@ class TestMonitor(unittest.TestCase):
         expected = {
             'CheckTime': 1570701600,
             'ExpirationTime': 1571306400,
-            'Outcome': 'True'
+            'Outcome': 'True',
+            'HistoryKey': 'securedrop'
         }
         self.assertEqual(expected, create_item(1570701600, True))
 
+    def test_state_has_changed(self):
+        history = [create_item(1570701600, False), create_item(1570703400, True)]
+        self.assertTrue(state_has_changed(True, []))
+        self.assertFalse(state_has_changed(True, history))
+        self.assertTrue(state_has_changed(False, history))
+        self.assertTrue(state_has_changed(True, history[:1]))
+
+    @mock.patch('src.monitor.upload_website_index')
+    @mock.patch('src.monitor.hour_is_0900', return_value=False)
+    def test_update_status_only_publishes_on_change(self, _, upload):
+        dynamodb = FakeDynamoDB()
+        notifier = mock.Mock()
+        config = {'TABLE_NAME': 'MonitorHistory-DEV', 'PRODMON_REDEPLOY_URL': 'https://riffraff'}
+        with tempfile.TemporaryDirectory() as directory:
+            history = CachedHistory(DynamoHistory(dynamodb, config['TABLE_NAME']), StateCache(os.path.join(directory, 'cache.json'), clock=lambda: 1570705200))
+            with mock.patch('src.monitor.time.time', side_effect=[1570701600, 1570703400, 1570705200]):
+                update_status(None, config, history, True, notifier)
+                update_status(None, config, history, True, notifier)
+                update_status(None, config, history, False, notifier)
+
+        self.assertEqual([mock.call(None, config, True), mock.call(None, config, False)], upload.call_args_list)
+        notifications = [call.args[0] for call in notifier.notify.call_args_list]
+        self.assertEqual(['status#True', 'status#False', 'failure#1570705200'],
+                         [notification.key for notification in notifications])
+        latest = read_latest_outcomes(dynamodb, config['TABLE_NAME'], limit=2)
+        self.assertEqual(['False', 'True'], [item['Outcome'] for item in latest])
+        self.assertEqual(0, dynamodb.Table(config['TABLE_NAME']).calls.get('scan', 0))
+
+    @mock.patch('src.monitor.upload_website_index')
+    @mock.patch('src.monitor.hour_is_0900', return_value=False)
+    def test_every_outage_is_emailed(self, _, upload):
+        email, chat = mock.Mock(), mock.Mock()
+        config = {'TABLE_NAME': 'MonitorHistory-DEV', 'PRODMON_REDEPLOY_URL': 'https://riffraff'}
+        with tempfile.TemporaryDirectory() as directory:
+            history = CachedHistory(DynamoHistory(FakeDynamoDB(), config['TABLE_NAME']),
+                                    StateCache(os.path.join(directory, 'cache.json'), clock=lambda: 1570702800))
+            notifier = NotificationDispatcher({'email': email, 'chat': chat}, suppress_for=3600, coalesce_for=0,
+                                              state_path=os.path.join(directory, 'notifications.json'))
+            # down, back up and down again within the hour
+            with notifier, mock.patch('src.monitor.time.time', side_effect=[1570701600, 1570702200, 1570702800]):
+                for healthy in (False, True, False):
+                    update_status(None, config, history, healthy, notifier)
+        self.assertEqual(2, email.send.call_count)
+        self.assertEqual(3, chat.send.call_count)
+
+    @mock.patch('src.monitor.upload_website_index')
+    @mock.patch('src.monitor.hour_is_0900', return_value=True)
+    def test_update_status_publishes_daily(self, _, upload):
+        notifier = mock.Mock()
+        config = {'TABLE_NAME': 'MonitorHistory-DEV', 'PRODMON_REDEPLOY_URL': 'https://riffraff'}
+        with tempfile.TemporaryDirectory() as directory:
+            history = CachedHistory(DynamoHistory(FakeDynamoDB(), config['TABLE_NAME']),
+                                    StateCache(os.path.join(directory, 'cache.json'), clock=lambda: 1570705200))
+            with mock.patch('src.monitor.time.time', side_effect=[1570701600, 1570703400]):
+                update_status(None, config, history, False, notifier)
+                update_status(None, config, history, False, notifier)
+        # the unchanged page is published again, so that it never reaches the bucket's expiry
+        self.assertEqual([mock.call(None, config, False)] * 2, upload.call_args_list)
+        self.assertEqual(['status#False', 'failure#1570701600'], [call.args[0].key for call in notifier.notify.call_args_list])
+
+    @mock.patch('src.monitor.upload_website_index')
+    @mock.patch('src.monitor.hour_is_0900', return_value=False)
+    def test_unconfirmed_failures_leave_the_status(self, _, upload):
+        notifier = mock.Mock()
+        config = {'TABLE_NAME': 'MonitorHistory-DEV', 'PRODMON_REDEPLOY_URL': 'https://riffraff',
+                  'SECUREDROP_URL': 'main.onion'}
+        unconfirmed = Outcome(False, 2, False, 0, 15.0)
+        result = CheckResult('main.onion', 'timeout', error='timeout')
+        with tempfile.TemporaryDirectory() as directory:
+            history = CachedHistory(DynamoHistory(FakeDynamoDB(), config['TABLE_NAME']),
+                                    StateCache(os.path.join(directory, 'cache.json'), clock=lambda: 1570705200))
+            with mock.patch('src.monitor.time.time', side_effect=itertools.count(1570701600, 1800)):
+                report_outcome(None, config, history, notifier, Outcome(True, 1, True, 0, 1.0), CheckResult('main.onion', 'up'))
+                # a blip, and then the onion is back
+                report_outcome(None, config, history, notifier, unconfirmed, result)
+                self.assertEqual(UNCONFIRMED_OUTCOME, history.latest(1)[0]['Outcome'])
+                report_outcome(None, config, history, notifier, Outcome(True, 1, True, 0, 1.0), CheckResult('main.onion', 'up'))
+                self.assertEqual([mock.call(None, config, True)], upload.call_args_list)
+                # two in a row are an outage
+                report_outcome(None, config, history, notifier, unconfirmed, result)
+                report_outcome(None, config, history, notifier, unconfirmed, result)
+        self.assertEqual([mock.call(None, config, True), mock.call(None, config, False)], upload.call_args_list)
+        self.assertEqual(['status#True', 'status#False', 'failure#1570712400'],
+                         [call.args[0].key for call in notifier.notify.call_args_list])
+
+    def test_switch_uploads_missing_pages(self):
+        s3 = FakeS3()
+        config = {'BUCKET_NAME': 'securedrop-public', 'STAGE': 'PROD', 'PUBLISH_MODE': 'redirect'}
+        with working_directory():
+            os.makedirs('build/static')
+            for healthy, body in ((True, b'<html>up</html>'), (False, b'<html>down</html>')):
+                with open(PAGE_FILES[healthy], 'wb') as fobj:
+                    fobj.write(body)
+            result = upload_website_index(FakeSession(s3=s3), config, False)
+        self.assertTrue(result.succeeded)
+        # both pages were uploaded ahead of the switch
+        self.assertEqual(3, s3.calls['put_object'])
+        location = s3.objects[('securedrop-public', 'index2.html')]['WebsiteRedirectLocation']
+        self.assertEqual('/securedrop/' + variant_key(b'<html>down</html>'), location)
+
+    def test_refresh_rewrites_what_the_page_points_at(self):
+        s3 = FakeS3()
+        config = {'BUCKET_NAME': 'securedrop-public', 'STAGE': 'CODE', 'PUBLISH_MODE': 'copy'}
+        with working_directory():
+            os.makedirs('build/static')
+            with open('build/static/site.0123456789abcdef.css', 'w') as fobj:
+                fobj.write('body {}')
+            for healthy, body in ((True, b'<html>up</html>'), (False, b'<html>down</html>')):
+                with open(PAGE_FILES[healthy], 'wb') as fobj:
+                    fobj.write(body)
+            upload_website_index(FakeSession(s3=s3), config, True)
+            # a few days without a change
+            for stored in s3.objects.values():
+                stored['LastModified'] -= timedelta(days=3)
+            self.assertTrue(refresh_website_index(FakeSession(s3=s3), config, True).succeeded)
+        stale = [key for (_, key), stored in s3.objects.items()
+                 if datetime.now(timezone.utc) - stored['LastModified'] > timedelta(days=1)]
+        self.assertEqual([], stale)
+        self.assertEqual(4, len(s3.objects))
+
+    def test_redirected_pages_load_their_assets(self):
+        from securedrop import build_pages
+        for stage, prefix in (('PROD', '/securedrop/'), ('CODE', '/')):
+            with working_directory():
+                build_pages('main.onion', 'main.securedrop.tor.onion', stage)
+                with open(PAGE_FILES[True], 'rb') as fobj:
+                    body = fobj.read()
+                # as a browser would, after following index2.html to the variant
+                page = urljoin('https://www.theguardian.com', redirect_location({'STAGE': stage}, body))
+                links = re.findall(r'(?:href|src)="([^"]*static/[^"]*)"', body.decode())
+                self.assertTrue(links)
+                for link in links:
+                    path = urlparse(urljoin(page, link)).path
+                    self.assertTrue(path.startswith(prefix + 'static/'), path)
+                    # the key of the published asset, which the website serves from the bucket root
+                    self.assertTrue(os.path.exists(os.path.join('build', path[len(prefix):])), path)
+
+    def test_publish_mode(self):
+        self.assertEqual('upload', publish_mode({}))
+        self.assertEqual('copy', publish_mode({'PUBLISH_MODE': 'copy'}))
+        self.assertEqual('upload', publish_mode({'PUBLISH_MODE': 'unknown'}))
+
+    def test_quorum_client(self):
+        with create_probe_client({'TOR_QUORUM': '2/3', 'TOR_PROXIES': '9050, 9052'}) as client:
+            self.assertEqual(2, client.quorum)
+            self.assertEqual([9050, 9052, 9050], [vantage.proxy[1] for vantage in client.clients])
+        # agreeing vantage points confirm a failure in a single round
+        self.assertEqual(1, create_scheduler({'TOR_QUORUM': '2/3'}).confirm_failures)
+        self.assertEqual(2, create_scheduler({}).confirm_failures)
+
 
 if __name__ == '__main__':
     unittest.main()
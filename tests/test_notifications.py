@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.notifications import DeliveryError, EmailChannel, Notification, NotificationDispatcher, create_email
+from benchmarks.fakes import client_error
+
+
+class FakeChannel:
+    def __init__(self, *failures: DeliveryError):
+        self.failures = list(failures)
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def send(self, payload):
+        self.release.wait(5)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append(payload)
+
+    def combine(self, notifications):
+        return {'text': ', '.join(notification.summary for notification in notifications)}
+
+
+def alert(key: str, channel: str = 'chat') -> Notification:
+    return Notification(channel, key, f'summary of {key}', {'text': key})
+
+
+class TestNotificationDispatcher(unittest.TestCase):
+    def setUp(self) -> None:
+        self.time = 1000.0
+        self.sleeps = []
+        self.channel = FakeChannel()
+
+    def dispatcher(self, **kwargs) -> NotificationDispatcher:
+        kwargs.setdefault('coalesce_for', 0)
+        return NotificationDispatcher({'chat': self.channel}, clock=lambda: self.time, sleep=self.sleeps.append,
+                                      **kwargs)
+
+    def test_delivers_in_the_background(self):
+        self.channel.release.clear()
+        with self.dispatcher() as dispatcher:
+            # notify does not wait for the channel
+            self.assertTrue(dispatcher.notify(alert('status#False')))
+            self.assertEqual([], self.channel.sent)
+            self.channel.release.set()
+        self.assertEqual([{'text': 'status#False'}], self.channel.sent)
+        self.assertEqual(1, dispatcher.delivered)
+
+    def test_closed_dispatchers_are_not_kept_until_exit(self):
+        with mock.patch('src.notifications.atexit') as atexit:
+            dispatcher = self.dispatcher()
+            atexit.register.assert_not_called()
+            dispatcher.notify(alert('status#False'))
+            dispatcher.close()
+        atexit.register.assert_called_once_with(dispatcher.close)
+        atexit.unregister.assert_called_once_with(dispatcher.close)
+
+    def test_suppresses_duplicates_within_window(self):
+        with self.dispatcher(suppress_for=3600) as dispatcher:
+            self.assertTrue(dispatcher.notify(alert('status#True')))
+            self.time += 1800
+            self.assertFalse(dispatcher.notify(alert('status#True')))
+            self.assertTrue(dispatcher.notify(alert('status#False')))
+            self.assertTrue(dispatcher.notify(alert('status#True')))
+            self.time += 3600
+            self.assertTrue(dispatcher.notify(alert('status#True')))
+        self.assertEqual(1, dispatcher.suppressed)
+
+    def test_coalesces_bursts(self):
+        with self.dispatcher(coalesce_for=0.5) as dispatcher:
+            for key in ('status#False', 'status#True', 'status#False'):
+                dispatcher.notify(alert(key))
+        self.assertEqual([{'text': 'summary of status#False, summary of status#True, summary of status#False'}],
+                         self.channel.sent)
+
+    def test_retries_with_backoff(self):
+        self.channel.failures = [DeliveryError('timed out'), DeliveryError('503')]
+        with self.dispatcher(retries=3) as dispatcher:
+            dispatcher.notify(alert('status#False'))
+        self.assertEqual(1, len(self.channel.sent))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertLess(self.sleeps[0], self.sleeps[1])
+
+    def test_failed_delivery_does_not_suppress(self):
+        self.channel.failures = [DeliveryError('forbidden', retryable=False)]
+        with self.dispatcher() as dispatcher:
+            dispatcher.notify(alert('status#False'))
+        self.assertEqual((0, 1, []), (dispatcher.delivered, dispatcher.failed, self.sleeps))
+        with self.dispatcher() as dispatcher:
+            self.assertTrue(dispatcher.notify(alert('status#False')))
+        self.assertEqual(1, len(self.channel.sent))
+
+    def test_suppression_spans_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.json')
+            with self.dispatcher(state_path=path) as dispatcher:
+                dispatcher.notify(alert('status#True'))
+            with self.dispatcher(state_path=path) as dispatcher:
+                self.assertFalse(dispatcher.notify(alert('status#True')))
+
+    def test_unknown_channel(self):
+        with self.dispatcher() as dispatcher:
+            self.assertFalse(dispatcher.notify(alert('failure', channel='email')))
+
+
+class FakeSES:
+    def __init__(self, error=None):
+        self.error = error
+        self.messages = []
+
+    def send_email(self, **kwargs):
+        if self.error:
+            raise self.error
+        self.messages.append(kwargs)
+        return {'MessageId': str(len(self.messages))}
+
+
+class TestEmailChannel(unittest.TestCase):
+    def test_send(self):
+        client = FakeSES()
+        EmailChannel(client, 'sender@example.com', 'alerts@example.com').send(create_email('subject', 'heading', 'text'))
+        self.assertEqual(['alerts@example.com'], client.messages[0]['Destination']['ToAddresses'])
+
+    def test_throttling_is_retryable(self):
+        channel = EmailChannel(FakeSES(client_error('Throttling', 'SendEmail')), 'a', 'b')
+        with self.assertRaises(DeliveryError) as context:
+            channel.send(create_email('subject', 'heading', 'text'))
+        self.assertTrue(context.exception.retryable)
+
+    def test_combine(self):
+        channel = EmailChannel(FakeSES(), 'a', 'b')
+        notifications = [Notification('email', 'failure', f'failure {n}', create_email('Alert', 'heading', 'text'))
+                         for n in range(3)]
+        self.assertEqual('Alert (+2 more)', channel.combine(notifications)['Subject']['Data'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import time
+import unittest
+
+from benchmarks.fakes import FakeSite, FakeTorProxy
+from src.monitor import healthcheck
+from src.probe import (QuorumClient, TorClient, parse_proxy, parse_quorum, probe_targets, response_charset,
+                       split_target)
+
+
+class TestProbe(unittest.TestCase):
+    def setUp(self) -> None:
+        self.proxy = FakeTorProxy({
+            'up.onion': FakeSite(),
+            'slow.onion': FakeSite(delay=0.3),
+            'broken.onion': FakeSite(status=500, body='Internal Server Error'),
+            'gone.onion': FakeSite(socks_error=4),
+        })
+        self.proxy.start()
+
+    def tearDown(self) -> None:
+        self.proxy.stop()
+
+    def test_split_target(self):
+        self.assertEqual(('http', 'abc.onion', 80, '/'), split_target('abc.onion'))
+        self.assertEqual(('https', 'abc.onion', 443, '/'), split_target('https://abc.onion'))
+        self.assertEqual(('http', 'abc.onion', 8080, '/metadata?x=1'), split_target('http://abc.onion:8080/metadata?x=1'))
+
+    def test_healthy_target(self):
+        response, = probe_targets(['up.onion'], proxy=self.proxy.address)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(healthcheck(response))
+
+    def test_failures_are_classified(self):
+        broken, gone = probe_targets(['broken.onion', 'gone.onion'], proxy=self.proxy.address)
+        self.assertEqual(500, broken.status_code)
+        self.assertFalse(healthcheck(broken))
+        self.assertEqual('socks', gone.error)
+        self.assertFalse(healthcheck(gone))
+
+    def test_content_type_parameters(self):
+        self.proxy.sites.update({
+            'flowed.onion': FakeSite(body='café', content_type='text/html; charset=UTF-8; format=flowed'),
+            'latin.onion': FakeSite(body='café', content_type='text/html; format=flowed; charset="latin-1"'),
+            'unknown.onion': FakeSite(body='café', content_type='text/html; charset=x-martian'),
+        })
+        flowed, latin, unknown = probe_targets(['flowed.onion', 'latin.onion', 'unknown.onion'], proxy=self.proxy.address)
+        self.assertEqual('café', flowed.text)
+        self.assertEqual('cafÃ©', latin.text)
+        # an unknown charset falls back to utf-8
+        self.assertEqual('café', unknown.text)
+        self.assertEqual('utf-8', response_charset('text/html'))
+
+    def test_malformed_framing(self):
+        self.proxy.sites.update({
+            'length.onion': FakeSite(framing='twelve'),
+            'negative.onion': FakeSite(framing='-1'),
+            'chunk.onion': FakeSite(chunked=True, framing='zz'),
+        })
+        responses = probe_targets(['length.onion', 'negative.onion', 'chunk.onion', 'up.onion'], proxy=self.proxy.address)
+        # the rest of the sweep is unaffected
+        self.assertEqual(['protocol', 'protocol', 'protocol', None], [response.error for response in responses])
+        self.assertTrue(healthcheck(responses[-1]))
+
+    def test_timeout(self):
+        response, = probe_targets(['slow.onion'], proxy=self.proxy.address, timeouts={'slow.onion': 0.05})
+        self.assertEqual('timeout', response.error)
+
+    def test_proxy_unavailable(self):
+        response, = probe_targets(['up.onion'], proxy=('127.0.0.1', 1))
+        self.assertEqual('proxy', response.error)
+
+    def test_sweep_is_concurrent(self):
+        targets = [f'mirror{i}.onion' for i in range(5)]
+        self.proxy.sites.update({target: FakeSite(delay=0.3) for target in targets})
+        start = time.monotonic()
+        results = probe_targets(targets, proxy=self.proxy.address)
+        self.assertTrue(all(results))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_overall_limit(self):
+        targets = [f'mirror{i}.onion' for i in range(4)]
+        self.proxy.sites.update({target: FakeSite(delay=0.2) for target in targets})
+        start = time.monotonic()
+        probe_targets(targets, proxy=self.proxy.address, limit=1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.8)
+
+    def test_connections_are_reused(self):
+        with TorClient(self.proxy.address) as client:
+            first = client.get('up.onion')
+            second = client.get('http://up.onion/metadata')
+        self.assertFalse(first.reused)
+        self.assertTrue(second.reused)
+        self.assertEqual(1, self.proxy.connections)
+        self.assertEqual(2, self.proxy.requests)
+        self.assertGreater(first.timings.connect, 0)
+        self.assertEqual(0, second.timings.connect)
+        self.assertGreaterEqual(second.timings.total, second.timings.first_byte)
+
+    def test_closed_idle_connection_is_replaced(self):
+        with TorClient(self.proxy.address) as client:
+            client.get('up.onion')
+            self.proxy.stop()
+            self.proxy = FakeTorProxy({'up.onion': FakeSite()})
+            self.proxy.start()
+            client.proxy = self.proxy.address
+            self.assertTrue(client.get('up.onion'))
+
+    def test_target_isolation(self):
+        self.proxy.sites['other.onion'] = FakeSite()
+        with TorClient(self.proxy.address, isolation='target') as client:
+            client.sweep(['up.onion', 'other.onion'])
+            client.rotate_circuits()
+            client.get('up.onion')
+        self.assertEqual(3, self.proxy.connections)
+        usernames = [username for username, _ in self.proxy.credentials]
+        self.assertEqual({'securecontact-up.onion', 'securecontact-other.onion'}, set(usernames))
+        # rotating the circuits changes the credentials even for the same target
+        self.assertEqual(3, len(set(self.proxy.credentials)))
+
+    def test_shared_mode_sends_no_credentials(self):
+        with TorClient(self.proxy.address) as client:
+            client.get('up.onion')
+        self.assertEqual([], self.proxy.credentials)
+
+    def test_unknown_isolation_mode(self):
+        with self.assertRaises(ValueError):
+            TorClient(isolation='everything')
+
+    def test_parse_quorum(self):
+        self.assertEqual((2, 3), parse_quorum('2/3'))
+        with self.assertRaises(ValueError):
+            parse_quorum('1/2')
+        self.assertEqual(('127.0.0.1', 9052), parse_proxy('9052'))
+        self.assertEqual(('tor', 9050), parse_proxy(' tor:9050'))
+
+    def test_vantage_points(self):
+        with QuorumClient(2, 3, [self.proxy.address]) as client:
+            sweeps = client.sweep_all(['up.onion', 'broken.onion'])
+        self.assertEqual([[200, 500]] * 3, [[response.status_code for response in sweep] for sweep in sweeps])
+        # every vantage point is on circuits of its own
+        self.assertEqual(3, len({password for _, password in self.proxy.credentials}))
+
+
+if __name__ == '__main__':
+    unittest.main()
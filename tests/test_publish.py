@@ -0,0 +1,148 @@
+import gzip
+import os
+import tempfile
+import unittest
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+
+from benchmarks.fakes import FakeS3, client_error
+from src.publish import (ASSET_CACHE_CONTROL, DIGEST_METADATA, PAGE_CACHE_CONTROL, compress, content_digest,
+                         publish_assets, publish_object, publish_variants, switch_pointer, variant_key)
+
+BUCKET = 'securedrop-public'
+PAGE = b'<html><title>The Guardian | SecureDrop</title></html>'
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3()
+
+    def publish(self, body: bytes = PAGE, **kwargs):
+        return publish_object(self.client, BUCKET, 'index2.html', body, 'text/html; charset=utf-8', **kwargs)
+
+    def test_compress_is_deterministic(self):
+        self.assertEqual(compress(PAGE), compress(PAGE))
+        self.assertEqual(PAGE, gzip.decompress(compress(PAGE)))
+
+    def test_uploads_new_content(self):
+        result = self.publish()
+        self.assertTrue(result.published)
+        self.assertTrue(result.succeeded)
+        stored = self.client.objects[(BUCKET, 'index2.html')]
+        self.assertEqual('gzip', stored['ContentEncoding'])
+        self.assertEqual('public, max-age=60', stored['CacheControl'])
+        self.assertEqual(content_digest(PAGE), stored['Metadata'][DIGEST_METADATA])
+        self.assertEqual(PAGE, gzip.decompress(stored['Body']))
+
+    def test_skips_identical_content(self):
+        self.publish()
+        result = self.publish()
+        self.assertFalse(result.published)
+        self.assertTrue(result.succeeded)
+        self.assertEqual(1, self.client.calls['put_object'])
+        self.assertEqual(2, self.client.calls['head_object'])
+
+    def test_matches_on_etag_without_metadata(self):
+        self.client.put_object(Bucket=BUCKET, Key='index2.html', Body=compress(PAGE))
+        self.assertFalse(self.publish().published)
+
+    def test_rewrites_content_before_it_expires(self):
+        self.publish()
+        stored = self.client.objects[(BUCKET, 'index2.html')]
+        stored['LastModified'] -= timedelta(days=2)
+        self.assertTrue(self.publish().published)
+        self.assertEqual(2, self.client.calls['put_object'])
+        self.assertFalse(self.publish().published)
+
+    def test_uploads_changed_content(self):
+        self.publish()
+        result = self.publish(b'<html>maintenance</html>')
+        self.assertTrue(result.published)
+        self.assertEqual(2, self.client.calls['put_object'])
+
+    def test_uncompressed(self):
+        self.publish(gzipped=False)
+        stored = self.client.objects[(BUCKET, 'index2.html')]
+        self.assertNotIn('ContentEncoding', stored)
+        self.assertEqual(PAGE, stored['Body'])
+
+    def test_reports_failed_upload(self):
+        def denied(**kwargs):
+            raise client_error('AccessDenied', 'PutObject', 403)
+        self.client.put_object = denied
+        result = self.publish()
+        self.assertFalse(result.published)
+        self.assertFalse(result.succeeded)
+
+    def test_publish_assets(self):
+        with tempfile.TemporaryDirectory() as static_dir:
+            for name, content in (('site.0123456789ab.css', b'.a{}'), ('favicon.ico', b'\0')):
+                with open(os.path.join(static_dir, name), 'wb') as fobj:
+                    fobj.write(content)
+            results = publish_assets(self.client, BUCKET, static_dir)
+        self.assertTrue(all(result.succeeded for result in results))
+        stylesheet = self.client.objects[(BUCKET, 'static/site.0123456789ab.css')]
+        self.assertEqual(ASSET_CACHE_CONTROL, stylesheet['CacheControl'])
+        self.assertEqual('text/css', stylesheet['ContentType'])
+        self.assertEqual('gzip', stylesheet['ContentEncoding'])
+        icon = self.client.objects[(BUCKET, 'static/favicon.ico')]
+        self.assertEqual('public, max-age=60', icon['CacheControl'])
+        self.assertNotIn('ContentEncoding', icon)
+
+
+class TestPointer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeS3()
+        self.directory = tempfile.TemporaryDirectory()
+        self.pages = []
+        for name, content in (('index.html', PAGE), ('maintenance.html', b'<html>maintenance</html>')):
+            self.pages.append(os.path.join(self.directory.name, name))
+            with open(self.pages[-1], 'wb') as fobj:
+                fobj.write(content)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_variants_are_uploaded_once(self):
+        results = publish_variants(self.client, BUCKET, self.pages)
+        self.assertTrue(all(result.published for result in results.values()))
+        variant = self.client.objects[(BUCKET, variant_key(PAGE))]
+        self.assertTrue(variant_key(PAGE).startswith('pages/'))
+        self.assertEqual(ASSET_CACHE_CONTROL, variant['CacheControl'])
+        self.assertFalse(any(result.published for result in publish_variants(self.client, BUCKET, self.pages).values()))
+        self.assertEqual(2, self.client.calls['put_object'])
+
+    def test_copy(self):
+        publish_variants(self.client, BUCKET, self.pages)
+        result = switch_pointer(self.client, BUCKET, 'index2.html', PAGE)
+        self.assertTrue(result.published)
+        self.assertTrue(result.succeeded)
+        stored = self.client.objects[(BUCKET, 'index2.html')]
+        self.assertEqual(PAGE, gzip.decompress(stored['Body']))
+        # the status page is not cached for as long as the variant
+        self.assertEqual(PAGE_CACHE_CONTROL, stored['CacheControl'])
+        self.assertEqual('gzip', stored['ContentEncoding'])
+        self.assertEqual(content_digest(PAGE), stored['Metadata'][DIGEST_METADATA])
+        self.assertFalse(switch_pointer(self.client, BUCKET, 'index2.html', PAGE).published)
+        self.assertEqual(1, self.client.calls['copy_object'])
+
+    def test_redirect(self):
+        publish_variants(self.client, BUCKET, self.pages)
+        location = '/' + variant_key(PAGE)
+        self.assertTrue(switch_pointer(self.client, BUCKET, 'index2.html', PAGE, redirect=location).published)
+        stored = self.client.objects[(BUCKET, 'index2.html')]
+        self.assertEqual(b'', stored['Body'])
+        self.assertEqual(location, stored['WebsiteRedirectLocation'])
+        self.assertFalse(switch_pointer(self.client, BUCKET, 'index2.html', PAGE, redirect=location).published)
+
+    def test_missing_variant(self):
+        with self.assertRaises(ClientError):
+            switch_pointer(self.client, BUCKET, 'index2.html', PAGE)
+        with self.assertRaises(ClientError):
+            switch_pointer(self.client, BUCKET, 'index2.html', PAGE, redirect='/' + variant_key(PAGE))
+        self.assertNotIn((BUCKET, 'index2.html'), self.client.objects)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import random
+import unittest
+
+from src.scheduler import Backoff, RetryScheduler, TorRestartPolicy, budget_from_interval
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+        self.sleeps = []
+
+    def now(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.time += seconds
+
+
+def scripted(clock: FakeClock, *results, duration: float = 1.0):
+    results = list(results)
+
+    def check():
+        clock.time += duration
+        return results.pop(0)
+    return check
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.restarts = 0
+
+    def restart_tor(self):
+        self.restarts += 1
+
+    def scheduler(self, budget: float = 900, **kwargs) -> RetryScheduler:
+        return RetryScheduler(budget, clock=self.clock, rng=random.Random(1), **kwargs)
+
+    def test_budget_from_interval(self):
+        self.assertEqual(900, budget_from_interval(1800))
+        # the daemon's interval is far too short to retry within
+        self.assertEqual(300, budget_from_interval(30))
+
+    def test_transient_failure_is_retried_at_short_intervals(self):
+        # probes timing out after 15s, then the onion answering
+        check = scripted(self.clock, (False, 'timeout'), (False, 'timeout'), (True, None), duration=15)
+        outcome = self.scheduler(budget_from_interval(30)).run(check)
+        self.assertEqual((True, 3), (outcome.healthy, outcome.attempts))
+
+    def test_backoff_is_exponential_and_capped(self):
+        backoff = Backoff(initial=5, factor=2, maximum=30, jitter=0)
+        rng = random.Random(1)
+        self.assertEqual([5, 10, 20, 30, 30], [backoff.delay(attempt, rng) for attempt in range(1, 6)])
+
+    def test_backoff_jitter(self):
+        backoff = Backoff(initial=10, jitter=0.2)
+        delays = [backoff.delay(1, random.Random(seed)) for seed in range(20)]
+        self.assertTrue(all(8 <= delay <= 12 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_healthy_on_first_attempt(self):
+        outcome = self.scheduler().run(scripted(self.clock, (True, None)))
+        self.assertTrue(outcome.healthy)
+        self.assertEqual(1, outcome.attempts)
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_recovers_after_transient_failures(self):
+        check = scripted(self.clock, (False, 'timeout'), (False, 'socks'), (True, None))
+        outcome = self.scheduler().run(check)
+        self.assertTrue(outcome.healthy)
+        self.assertEqual(3, outcome.attempts)
+        self.assertEqual(2, len(self.clock.sleeps))
+
+    def test_confirmed_failure_exits_in_seconds(self):
+        check = scripted(self.clock, (False, 'http'), (False, 'http'))
+        outcome = self.scheduler().run(check)
+        self.assertFalse(outcome.healthy)
+        self.assertTrue(outcome.confirmed)
+        self.assertEqual(2, outcome.attempts)
+        self.assertLess(outcome.elapsed, 10)
+
+    def test_budget_is_respected(self):
+        check = scripted(self.clock, *[(False, 'timeout')] * 100, duration=15)
+        outcome = self.scheduler(budget=300, restart=TorRestartPolicy(enabled=False)).run(check)
+        self.assertFalse(outcome.healthy)
+        self.assertFalse(outcome.confirmed)
+        self.assertLessEqual(outcome.elapsed, 300)
+
+    def test_restarts_tor_on_repeated_proxy_failures(self):
+        check = scripted(self.clock, (False, 'proxy'), (False, 'proxy'), (True, None))
+        outcome = self.scheduler(restart=TorRestartPolicy(proxy_failures=2, settle=30)).run(check, self.restart_tor)
+        self.assertTrue(outcome.healthy)
+        self.assertEqual(1, self.restarts)
+        self.assertEqual(1, outcome.restarts)
+        self.assertGreaterEqual(self.clock.sleeps[-1], 30)
+
+    def test_restart_policy(self):
+        policy = TorRestartPolicy(proxy_failures=2, circuit_failures=3, max_restarts=1)
+        self.assertFalse(policy.should_restart('proxy', 1, 0))
+        self.assertTrue(policy.should_restart('proxy', 2, 0))
+        self.assertFalse(policy.should_restart('socks', 2, 0))
+        self.assertTrue(policy.should_restart('timeout', 3, 0))
+        self.assertFalse(policy.should_restart('http', 10, 0))
+        self.assertFalse(policy.should_restart('proxy', 2, 1))
+        self.assertFalse(TorRestartPolicy(enabled=False).should_restart('proxy', 10, 0))
+        self.assertTrue(policy.should_restart('tor', 2, 0))
+
+    def test_renewing_circuits_settles_quickly(self):
+        check = scripted(self.clock, (False, 'timeout'), (False, 'timeout'), (True, None))
+        policy = TorRestartPolicy(circuit_failures=2, settle=30, renew_settle=5)
+        outcome = self.scheduler(restart=policy).run(check, lambda: False)
+        self.assertTrue(outcome.healthy)
+        self.assertEqual((0, 1), (outcome.restarts, outcome.renewals))
+        self.assertLess(self.clock.sleeps[-1], 30)
+
+    def test_missing_descriptor_is_confirmed(self):
+        outcome = self.scheduler().run(scripted(self.clock, (False, 'descriptor'), (False, 'descriptor')))
+        self.assertFalse(outcome.healthy)
+        self.assertTrue(outcome.confirmed)
+        self.assertEqual(2, outcome.attempts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import securedrop
+from securedrop import FINGERPRINT_FILE, build_pages
+
+ONION = 'xp44cagis447k3lpb4wwhcqukix6cgqokbuys24vmxmbzmaq2gjvc2yd.onion'
+HUMAN = 'theguardian.securedrop.tor.onion'
+
+
+class TestBuildPages(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.build_dir = os.path.join(self.directory.name, 'build')
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_builds_both_pages(self):
+        self.assertTrue(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+        with open(os.path.join(self.build_dir, 'index.html')) as fobj:
+            index = fobj.read()
+        with open(os.path.join(self.build_dir, 'maintenance.html')) as fobj:
+            maintenance = fobj.read()
+        self.assertIn(ONION, index)
+        self.assertIn('service is available', index)
+        self.assertIn('temporarily unavailable', maintenance)
+        self.assertEqual(
+            ['.fingerprint', 'index.html', 'maintenance.html', 'static'], sorted(os.listdir(self.build_dir))
+        )
+
+    def test_unchanged_inputs_skip_rendering(self):
+        build_pages(ONION, HUMAN, 'CODE', self.build_dir)
+        with mock.patch.object(securedrop, 'render_page') as render:
+            self.assertFalse(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+        render.assert_not_called()
+
+    def test_changed_inputs_rebuild(self):
+        build_pages(ONION, HUMAN, 'CODE', self.build_dir)
+        self.assertTrue(build_pages(ONION, HUMAN, 'PROD', self.build_dir))
+        self.assertTrue(build_pages('other.onion', HUMAN, 'PROD', self.build_dir))
+
+    def test_missing_output_rebuilds(self):
+        build_pages(ONION, HUMAN, 'CODE', self.build_dir)
+        os.remove(os.path.join(self.build_dir, 'maintenance.html'))
+        self.assertTrue(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+
+    def test_missing_assets_rebuild(self):
+        build_pages(ONION, HUMAN, 'CODE', self.build_dir)
+        static = os.path.join(self.build_dir, 'static')
+        stylesheet = next(name for name in os.listdir(static) if name.endswith('.css'))
+        os.remove(os.path.join(static, stylesheet))
+        self.assertTrue(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+        self.assertIn(stylesheet, os.listdir(static))
+
+        shutil.rmtree(static)
+        self.assertTrue(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+        self.assertFalse(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+
+    def test_interrupted_build_is_redone(self):
+        with mock.patch.object(securedrop, 'write_atomic', side_effect=[None, OSError('disk full')]):
+            with self.assertRaises(OSError):
+                build_pages(ONION, HUMAN, 'CODE', self.build_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.build_dir, FINGERPRINT_FILE)))
+        self.assertTrue(build_pages(ONION, HUMAN, 'CODE', self.build_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
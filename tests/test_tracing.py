@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.notifications import Notification, NotificationDispatcher
+from src.tracing import PROFILE_VARIABLE, current_span, read_spans, span, summarise, traced
+
+
+def spans_from(logs) -> list:
+    return [json.loads(output.split(':', 2)[2]) for output in logs.output]
+
+
+class TestTracing(unittest.TestCase):
+    def test_nested_spans(self):
+        with self.assertLogs('securecontact.trace') as logs:
+            with span('cycle', stage='DEV') as cycle:
+                with span('attempt', attempt=1) as attempt:
+                    attempt.set(status='up')
+                    self.assertIs(attempt, current_span())
+                self.assertIs(cycle, current_span())
+        self.assertIsNone(current_span())
+
+        attempt, cycle = spans_from(logs)
+        self.assertEqual(cycle['trace'], attempt['trace'])
+        self.assertEqual(cycle['span'], attempt['parent'])
+        self.assertIsNone(cycle['parent'])
+        self.assertEqual({'attempt': 1, 'status': 'up'}, attempt['attributes'])
+        self.assertGreaterEqual(cycle['duration'], attempt['duration'])
+        self.assertEqual('ok', cycle['status'])
+
+    def test_error_status(self):
+        @traced('publish')
+        def publish():
+            raise OSError('no route to host')
+
+        with self.assertLogs('securecontact.trace') as logs, self.assertRaises(OSError):
+            publish()
+        record, = spans_from(logs)
+        self.assertEqual(('publish', 'error', 'OSError: no route to host'),
+                         (record['name'], record['status'], record['error']))
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(os.environ, {PROFILE_VARIABLE: directory}):
+            with self.assertLogs('securecontact.trace') as logs:
+                with span('cycle'):
+                    with span('probe'):
+                        pass
+            probe, cycle = spans_from(logs)
+            # only the root of a trace is profiled
+            self.assertNotIn('profile', probe['attributes'])
+            self.assertEqual(os.path.join(directory, f'{cycle["trace"]}.prof'), cycle['attributes']['profile'])
+            self.assertTrue(os.path.exists(cycle['attributes']['profile']))
+
+    def test_notifications_join_the_trace(self):
+        sender = mock.Mock()
+        dispatcher = NotificationDispatcher({'chat': sender}, coalesce_for=0)
+        with self.assertLogs('securecontact.trace') as logs:
+            with span('cycle') as cycle:
+                dispatcher.notify(Notification('chat', 'up', 'up', {}))
+                dispatcher.close()
+        notify = next(record for record in spans_from(logs) if record['name'] == 'notify')
+        self.assertEqual((cycle.trace_id, cycle.span_id), (notify['trace'], notify['parent']))
+        self.assertEqual({'channel': 'chat', 'notifications': 1}, notify['attributes'])
+
+
+class TestSummary(unittest.TestCase):
+    def log(self, runs: int) -> list:
+        lines = ['10-10 10:00 securecontact.monitor INFO     Healthcheck: passed on attempt 1']
+        for run in range(runs):
+            trace = f'trace{run}'
+            records = [
+                {'trace': trace, 'span': 'probe', 'parent': 'cycle', 'name': 'probe', 'start': run + 0.1,
+                 'duration': 1.0 + run, 'status': 'ok', 'error': None, 'attributes': {}},
+                {'trace': trace, 'span': 'publish', 'parent': 'cycle', 'name': 'publish', 'start': run + 0.2,
+                 'duration': 0.5, 'status': 'error' if run else 'ok', 'error': None, 'attributes': {}},
+                {'trace': trace, 'span': 'cycle', 'parent': None, 'name': 'cycle', 'start': run,
+                 'duration': 2.0 + run, 'status': 'ok', 'error': None, 'attributes': {}},
+            ]
+            lines += [f'10-10 10:00 securecontact.trace INFO     {json.dumps(record)}' for record in records]
+        return lines
+
+    def test_read_spans(self):
+        spans = read_spans(self.log(2) + ['10-10 10:00 securecontact.trace INFO     {truncated'])
+        self.assertEqual(6, len(spans))
+
+    def test_slowest_stages_of_the_last_runs(self):
+        summaries = summarise(read_spans(self.log(5)), runs=3)
+        self.assertEqual(['cycle', 'probe', 'publish'], [summary.name for summary in summaries])
+        probe = summaries[1]
+        # runs 2, 3 and 4
+        self.assertEqual((3, 3, 12.0, 4.0, 5.0), (probe.count, probe.runs, probe.total, probe.p50, probe.max))
+        self.assertEqual(3, summaries[2].errors)
+        self.assertEqual([], summarise(read_spans(self.log(5)), root='load'))
+
+
+if __name__ == '__main__':
+    unittest.main()